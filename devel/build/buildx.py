@@ -0,0 +1,212 @@
+import os
+import re
+import subprocess
+import sys
+from typing import Dict, List, Optional
+
+from dt_shell import dtslogger
+from utils.docker_utils import sanitize_docker_baseurl
+
+BUILDX_BUILDER_NAME = "dts-buildx"
+BUILDX_CACHE_MODE = "max"
+
+# lines of the `--progress=plain` output of buildx
+VERTEX_STEP_PATTERN = re.compile(r"^#(\d+) \[(?:(.+) )?(\d+)/(\d+)\] (.*)$")
+VERTEX_CACHED_PATTERN = re.compile(r"^#(\d+) CACHED$")
+VERTEX_DONE_PATTERN = re.compile(r"^#(\d+) DONE ([0-9.]+)s$")
+VERTEX_ERROR_PATTERN = re.compile(r"^#(\d+) ERROR: (.*)$")
+
+
+class BuildxError(Exception):
+    pass
+
+
+class BuildStep:
+    def __init__(self, stage: str, index: int, total: int, command: str):
+        self.stage = stage
+        self.index = index
+        self.total = total
+        self.command = command
+        self.cached = False
+        self.duration = None
+        self.layer = None
+
+
+class BuildxLog:
+    """
+    Collects the steps of a buildx build from its plain progress output.
+    """
+
+    def __init__(self):
+        self._vertices: Dict[str, BuildStep] = {}
+        self._last_stage = None
+        self.lines: List[str] = []
+        self.error = None
+
+    def feed(self, line: str):
+        self.lines.append(line)
+        line = line.rstrip("\n")
+        match = VERTEX_STEP_PATTERN.match(line)
+        if match:
+            vertex, stage, index, total, command = match.groups()
+            if vertex not in self._vertices:
+                self._vertices[vertex] = BuildStep(stage or "", int(index), int(total), command)
+                self._last_stage = stage or ""
+            return
+        match = VERTEX_CACHED_PATTERN.match(line)
+        if match and match.group(1) in self._vertices:
+            self._vertices[match.group(1)].cached = True
+            return
+        match = VERTEX_DONE_PATTERN.match(line)
+        if match and match.group(1) in self._vertices:
+            self._vertices[match.group(1)].duration = float(match.group(2))
+            return
+        match = VERTEX_ERROR_PATTERN.match(line)
+        if match:
+            self.error = match.group(2)
+
+    @property
+    def steps(self) -> List[BuildStep]:
+        # the final stage is the one that finishes last, it depends on all the others
+        steps = [s for s in self._vertices.values() if s.stage == self._last_stage]
+        return sorted(steps, key=lambda s: s.index)
+
+    def to_legacy(self, history: List[dict], image: str):
+        """
+        Turns the buildx steps and the image history into the (buildlog, historylog) pair produced by
+        the legacy builder, so that they can be fed to the ImageAnalyzer.
+        """
+        # BuildKit images do not expose the IDs of the intermediate layers, we make them up
+        historylog = [(f"{i:012x}", layer["Size"]) for i, layer in enumerate(history)]
+        steps = self.steps
+        # match the steps with the history entries, both from the newest to the oldest
+        cursor = 0
+        for step in reversed(steps[1:]):
+            for i in range(cursor, len(history)):
+                if _same_command(step.command, history[i].get("CreatedBy", "")):
+                    step.layer = historylog[i][0]
+                    cursor = i + 1
+                    break
+        # everything older than the first step of the final stage belongs to the base image
+        if steps and historylog:
+            steps[0].layer = historylog[min(cursor, len(historylog) - 1)][0]
+        buildlog = []
+        for i, step in enumerate(steps):
+            buildlog.append(f"Step {i + 1}/{len(steps)} : {step.command}\n")
+            if step.cached:
+                buildlog.append(" ---> Using cache\n")
+            if step.layer:
+                buildlog.append(f" ---> {step.layer}\n")
+        buildlog.append(f"Successfully tagged {image}\n")
+        return buildlog, historylog
+
+
+def _normalize_command(command: str) -> str:
+    command = re.sub(r"\s+# buildkit$", "", command.strip())
+    instruction, _, arguments = command.partition(" ")
+    # drop the build args prepended to RUN, the flags (e.g., --mount, --from) and the shell
+    arguments = re.sub(r"^\|\d+( \S+=\S*)* ", "", arguments)
+    arguments = re.sub(r"^(--\S+ )+", "", arguments)
+    arguments = re.sub(r"^/bin/sh -c ", "", arguments)
+    return re.sub(r"\s+", " ", f"{instruction.upper()} {arguments}").strip()
+
+
+def _same_command(step_command: str, created_by: str) -> bool:
+    a, b = _normalize_command(step_command), _normalize_command(created_by)
+    # long commands might be truncated in the progress output
+    return a == b or (len(a) > 32 and b.startswith(a)) or (len(b) > 32 and a.startswith(b))
+
+
+def buildx_env(machine: Optional[str]) -> dict:
+    env = dict(os.environ)
+    if machine is not None:
+        env["DOCKER_HOST"] = sanitize_docker_baseurl(machine)
+    return env
+
+
+def is_buildx_available(machine: Optional[str] = None) -> bool:
+    try:
+        subprocess.check_output(
+            ["docker", "buildx", "version"], env=buildx_env(machine), stderr=subprocess.STDOUT
+        )
+        return True
+    except (OSError, subprocess.CalledProcessError):
+        return False
+
+
+def ensure_builder(machine: Optional[str]) -> str:
+    # the default `docker` driver cannot export the cache, a `docker-container` builder is needed
+    name = BUILDX_BUILDER_NAME
+    if machine is not None:
+        # builders are bound to the endpoint they were created on
+        name += "-" + re.sub(r"[^a-zA-Z0-9]+", "-", machine).strip("-")
+    env = buildx_env(machine)
+    inspect = subprocess.run(
+        ["docker", "buildx", "inspect", name], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    if inspect.returncode != 0:
+        dtslogger.info(f"Creating buildx builder '{name}'...")
+        subprocess.check_call(
+            ["docker", "buildx", "create", "--name", name, "--driver", "docker-container"],
+            env=env,
+            stdout=subprocess.DEVNULL,
+        )
+    return name
+
+
+def cache_spec(value: str, export: bool = False) -> str:
+    # plain image references are registry caches
+    if "type=" in value:
+        return value
+    spec = f"type=registry,ref={value}"
+    if export:
+        spec += f",mode={BUILDX_CACHE_MODE}"
+    return spec
+
+
+def buildx_build(
+    machine: Optional[str],
+    path: str,
+    tag: str,
+    buildargs: Dict[str, str],
+    labels: Dict[str, str],
+    pull: bool = False,
+    nocache: bool = False,
+    cache_from: Optional[List[str]] = None,
+    cache_to: Optional[str] = None,
+    builder: Optional[str] = None,
+) -> BuildxLog:
+    cmd = ["docker", "buildx", "build", "--progress=plain", "--load", "--tag", tag]
+    if builder:
+        cmd += ["--builder", builder]
+    for key, value in buildargs.items():
+        cmd += ["--build-arg", f"{key}={value}"]
+    for key, value in labels.items():
+        cmd += ["--label", f"{key}={value}"]
+    if pull:
+        cmd += ["--pull"]
+    if nocache:
+        cmd += ["--no-cache"]
+    for source in cache_from or []:
+        cmd += ["--cache-from", cache_spec(source)]
+    if cache_to:
+        cmd += ["--cache-to", cache_spec(cache_to, export=True)]
+    cmd += [path]
+    dtslogger.debug(" $ %s" % " ".join(cmd))
+    log = BuildxLog()
+    # buildx writes its progress to stderr
+    proc = subprocess.Popen(
+        cmd,
+        env=buildx_env(machine),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+        errors="replace",
+    )
+    for line in proc.stdout:
+        log.feed(line)
+        sys.stdout.write(line)
+        sys.stdout.flush()
+    if proc.wait() != 0:
+        raise BuildxError(log.error or f"docker buildx exited with code {proc.returncode}")
+    return log
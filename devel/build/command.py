@@ -6,8 +6,7 @@ import os
 import sys
 import time
 from pathlib import Path
-from shutil import which
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, mkdtemp
 from types import SimpleNamespace
 
 from docker.errors import APIError, ContainerError, ImageNotFound
@@ -22,10 +21,12 @@ from utils.docker_utils import (
     DOCKER_INFO,
     get_client,
     get_endpoint_architecture,
+    get_endpoint_info,
     get_endpoint_ncpus,
     get_registry_to_use,
     login_client,
     pull_image,
+    transfer_image,
 )
 from utils.dtproject_utils import (
     BUILD_COMPATIBILITY_MAP,
@@ -33,15 +34,21 @@ from utils.dtproject_utils import (
     CLOUD_BUILDERS,
     DISTRO_KEY,
     dtlabel,
-    DTProject,
     get_cloud_builder,
+    get_project,
 )
 from utils.duckietown_utils import DEFAULT_OWNER
 from utils.misc_utils import human_size, human_time, sanitize_hostname
-from utils.multi_command_utils import MultiCommand
+from utils.multi_command_utils import MultiCommand, ThreadedOutput
 from utils.pip_utils import get_pip_index_url
+from .buildx import BuildxError, buildx_build, ensure_builder, is_buildx_available
+from .history import load_history, print_comparison, record_build
 from .image_analyzer import EXTRA_INFO_SEPARATOR, ImageAnalyzer
 
+ENGINE_DOCKER = "docker"
+ENGINE_BUILDX = "buildx"
+BUILD_ENGINES = [ENGINE_DOCKER, ENGINE_BUILDX]
+
 
 class DTCommand(DTCommandAbs):
     help = "Builds the current project"
@@ -57,8 +64,8 @@ class DTCommand(DTCommandAbs):
             "-a",
             "--arch",
             default=None,
-            choices=set(CANONICAL_ARCH.values()),
-            help="Target architecture for the image to build",
+            help="Target architecture(s) for the image to build, comma-separated (e.g., amd64,arm64v8) "
+            "to build them concurrently and push a multi-arch manifest",
         )
         parser.add_argument(
             "-H", "--machine", default=None, help="Docker socket or hostname where to build the image"
@@ -78,6 +85,28 @@ class DTCommand(DTCommandAbs):
             action="store_true",
             help="Whether to force Docker to use an old version of the same " "image as cache",
         )
+        parser.add_argument(
+            "--engine",
+            default=ENGINE_DOCKER,
+            choices=BUILD_ENGINES,
+            help="Build engine to use, 'buildx' runs the build through BuildKit",
+        )
+        parser.add_argument(
+            "--cache-from",
+            default=[],
+            action="append",
+            help="(buildx only) Additional image to import the build cache from (can be repeated)",
+        )
+        parser.add_argument(
+            "--cache-to",
+            default=None,
+            help="(buildx only) Image to export the build cache to",
+        )
+        parser.add_argument(
+            "--builder",
+            default=None,
+            help="(buildx only) Name of the buildx builder to use",
+        )
         parser.add_argument(
             "--no-multiarch",
             default=False,
@@ -155,6 +184,15 @@ class DTCommand(DTCommandAbs):
         parser.add_argument(
             "--ncpus", default=None, type=int, help="Value to pass as build-arg `NCPUS` to docker build."
         )
+        parser.add_argument(
+            "--compare",
+            default=False,
+            action="store_true",
+            help="Compare the timing and caching of each step against the previous build",
+        )
+        parser.add_argument(
+            "--report", default=None, help="File where to write the analysis of the build as JSON"
+        )
         parser.add_argument("-v", "--verbose", default=False, action="store_true", help="Be verbose")
         parser.add_argument(
             "--tag", default=None, help="Overrides 'version' (usually taken to be branch name)"
@@ -173,6 +211,20 @@ class DTCommand(DTCommandAbs):
 
             if remaining:
                 dtslogger.info(f"I do not know about these arguments: {remaining}")
+            # validate architectures
+            if parsed.arch is not None:
+                archs = [a.strip() for a in parsed.arch.split(",") if a.strip()]
+                unknown = [a for a in archs if a not in set(CANONICAL_ARCH.values())]
+                if unknown:
+                    parser.error(
+                        f"argument -a/--arch: invalid choice(s) {', '.join(unknown)} "
+                        f"(choose from {', '.join(sorted(set(CANONICAL_ARCH.values())))})"
+                    )
+                # fan-out builds
+                if len(archs) > 1:
+                    _build_multiarch(shell, args, parsed, archs)
+                    return
+                parsed.arch = archs[0]
         # ---
 
         # define build-args
@@ -187,7 +239,7 @@ class DTCommand(DTCommandAbs):
         dtslogger.info("Project workspace: {}".format(parsed.workdir))
         # show info about project
         shell.include.devel.info.command(shell, args)
-        project = DTProject(parsed.workdir)
+        project = get_project(parsed.workdir)
 
         # tag
         version = project.version_name
@@ -323,7 +375,7 @@ class DTCommand(DTCommandAbs):
 
         # get info about docker endpoint
         dtslogger.info("Retrieving info about Docker endpoint...")
-        epoint = docker.info()
+        epoint = get_endpoint_info(parsed.machine)
         if "ServerErrors" in epoint:
             dtslogger.error("\n".join(epoint["ServerErrors"]))
             return
@@ -422,7 +474,18 @@ class DTCommand(DTCommandAbs):
             docker_build_args[key] = value
 
         # cache
-        if not parsed.no_cache:
+        if parsed.engine == ENGINE_BUILDX:
+            if not is_buildx_available(parsed.machine):
+                dtslogger.error("The buildx plugin is not available on the Docker endpoint. Aborting...")
+                exit(9)
+            if not parsed.no_cache:
+                # BuildKit fetches from the registry only the cache layers that are actually reused
+                cache_from = parsed.cache_from + [image]
+                # embed the cache metadata in the image, it becomes a cache source once pushed
+                docker_build_args["BUILDKIT_INLINE_CACHE"] = "1"
+            if parsed.cache_to and not parsed.builder:
+                parsed.builder = ensure_builder(parsed.machine)
+        elif not parsed.no_cache:
             # check if the endpoint contains an image with the same name
             try:
                 docker.images.get(image)
@@ -475,6 +538,12 @@ class DTCommand(DTCommandAbs):
                     )
                 except BaseException as e:
                     dtslogger.warning(f"Cannot fetch image metadata. Reason: {str(e)}")
+                if image_labels is None:
+                    # the image is not available locally, ask the registry
+                    remote = project.remote_images(
+                        [parsed.arch], owner=parsed.username, registry=registry_to_use, version=version
+                    )[parsed.arch]
+                    image_labels = remote.labels if remote is not None else None
                 if image_labels is None:
                     dtslogger.warning(f"Cannot fetch image metadata for '{image}'.")
                     image_labels = {}
@@ -515,26 +584,53 @@ class DTCommand(DTCommandAbs):
         dtslogger.debug("Build arguments:\n%s\n" % json.dumps(buildargs, sort_keys=True, indent=4))
 
         # build image
-        buildlog = []
-        try:
-            for line in docker.api.build(**buildargs, decode=True):
-                line = _build_line(line)
-                if not line:
-                    continue
-                try:
-                    sys.stdout.write(line)
-                    buildlog.append(line)
-                except UnicodeEncodeError:
-                    pass
-                sys.stdout.flush()
-
-        except APIError as e:
-            dtslogger.error(f"An error occurred while building the project image:\n{str(e)}")
-            exit(1)
-        except ProjectBuildError:
-            dtslogger.error(f"An error occurred while building the project image.")
-            exit(2)
-        dimage = docker.images.get(image)
+        analyzer = ImageAnalyzer()
+        historylog = None
+        if parsed.engine == ENGINE_BUILDX:
+            try:
+                buildxlog = buildx_build(
+                    parsed.machine,
+                    parsed.workdir,
+                    image,
+                    docker_build_args,
+                    labels,
+                    pull=parsed.pull,
+                    nocache=parsed.no_cache,
+                    cache_from=cache_from,
+                    cache_to=parsed.cache_to,
+                    builder=parsed.builder,
+                )
+            except BuildxError as e:
+                dtslogger.error(f"An error occurred while building the project image:\n{str(e)}")
+                exit(2)
+            dimage = docker.images.get(image)
+            # the analyzer understands the log of the legacy builder
+            buildlog, historylog = buildxlog.to_legacy(dimage.history(), image)
+            for line in buildlog:
+                analyzer.feed(line)
+            # BuildKit knows how long each step took
+            for step, buildx_step in zip(analyzer.steps, buildxlog.steps):
+                step.duration = buildx_step.duration
+        else:
+            try:
+                for line in docker.api.build(**buildargs, decode=True):
+                    line = _build_line(line)
+                    if not line:
+                        continue
+                    try:
+                        sys.stdout.write(line)
+                        analyzer.feed(line)
+                    except UnicodeEncodeError:
+                        pass
+                    sys.stdout.flush()
+
+            except APIError as e:
+                dtslogger.error(f"An error occurred while building the project image:\n{str(e)}")
+                exit(1)
+            except ProjectBuildError:
+                dtslogger.error(f"An error occurred while building the project image.")
+                exit(2)
+            dimage = docker.images.get(image)
 
         # tag release images
         if project.is_release():
@@ -545,7 +641,7 @@ class DTCommand(DTCommandAbs):
             )
             dimage.tag(*rimage.split(":"))
             msg = f"Successfully tagged {rimage}"
-            buildlog.append(msg)
+            analyzer.feed(msg)
             print(msg)
 
         # build code docs
@@ -556,7 +652,8 @@ class DTCommand(DTCommandAbs):
             shell.include.devel.docs.build.command(shell, args + docs_args)
 
         # get image history
-        historylog = [(layer["Id"], layer["Size"]) for layer in dimage.history()]
+        if historylog is None:
+            historylog = [(layer["Id"], layer["Size"]) for layer in dimage.history()]
 
         # round up extra info
         extra_info = []
@@ -577,9 +674,17 @@ class DTCommand(DTCommandAbs):
         # compile extra info
         extra_info = "\n".join(extra_info)
         # run docker image analysis
-        _, _, final_image_size = ImageAnalyzer.process(
-            buildlog, historylog, codens=100, extra_info=extra_info, nocolor=parsed.ci
+        report = analyzer.analyze(
+            historylog, codens=100, extra_info=extra_info, nocolor=parsed.ci, report_file=parsed.report
+        )
+        final_image_size = report["final_image_size"]
+        # record per-step timing and caching
+        previous_build = (load_history(project.name, parsed.arch) or [None])[-1]
+        current_build = record_build(
+            project.name, parsed.arch, image, parsed.engine, time.time() - stime, report
         )
+        if parsed.compare:
+            print_comparison(previous_build, current_build, nocolor=parsed.ci)
         # pull image (if the destination is different from the builder machine)
         if parsed.destination and parsed.machine != parsed.destination:
             _transfer_image(
@@ -653,14 +758,98 @@ class ProjectBuildError(Exception):
     pass
 
 
+def _build_multiarch(shell: DTShell, args, parsed, archs):
+    project = get_project(os.path.abspath(parsed.workdir))
+    registry_to_use = get_registry_to_use()
+    version = parsed.tag or project.version_name
+    images = {
+        arch: project.image(
+            arch=arch,
+            loop=parsed.loop,
+            owner=parsed.username,
+            registry=registry_to_use,
+            version=version,
+        )
+        for arch in archs
+    }
+    logs_dir = mkdtemp(prefix="dts-devel-build-")
+    dtslogger.info(f"Building for {', '.join(archs)} concurrently. Logs are in {logs_dir}")
+    results = {}
+
+    def _build(arch: str, sub_parsed):
+        try:
+            DTCommand.command(shell, args, parsed=sub_parsed)
+            results[arch] = 0
+        except SystemExit as e:
+            results[arch] = e.code if isinstance(e.code, int) else 1
+        except BaseException as e:
+            dtslogger.error(str(e))
+            results[arch] = 1
+
+    logs = []
+    workers = []
+    with ThreadedOutput() as output:
+        for arch in archs:
+            sub_parsed = copy.deepcopy(parsed)
+            sub_parsed.arch = arch
+            if parsed.report:
+                root, ext = os.path.splitext(parsed.report)
+                sub_parsed.report = f"{root}-{arch}{ext}"
+            log = open(os.path.join(logs_dir, f"{arch}.log"), "wt")
+            logs.append(log)
+            workers.append(output.thread(arch, _build, args=(arch, sub_parsed), log=log))
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    for log in logs:
+        log.close()
+    # report
+    failed = [arch for arch in archs if results.get(arch, 1) != 0]
+    for arch in archs:
+        status = colored("Failed", "red") if arch in failed else colored("Built", "green")
+        print(f" - {arch}: {status} ({images[arch]})")
+    if failed:
+        dtslogger.error(
+            f"The build failed for {', '.join(failed)}. "
+            f"Check the logs in {logs_dir} for more details."
+        )
+        exit(min(results[arch] for arch in failed) or 1)
+    # the architecture images are now in the registry, bundle them into a manifest list
+    if parsed.push and not parsed.loop:
+        manifests = {_manifest_name(images[archs[0]], archs[0]): list(images.values())}
+        if project.is_release():
+            release_images = [
+                project.image_release(arch=arch, owner=parsed.username, registry=registry_to_use)
+                for arch in archs
+            ]
+            manifests[_manifest_name(release_images[0], archs[0])] = release_images
+        for manifest, members in manifests.items():
+            dtslogger.info(f"Pushing multi-arch manifest {manifest}...")
+            try:
+                start_command_in_subprocess(
+                    ["docker", "manifest", "create", "--amend", manifest] + members, shell=False
+                )
+                start_command_in_subprocess(["docker", "manifest", "push", "--purge", manifest], shell=False)
+            except Exception as e:
+                dtslogger.error(
+                    f"Could not push the manifest {manifest}, make sure the Docker CLI is logged in "
+                    f"to the registry.\n{str(e)}"
+                )
+                exit(1)
+            dtslogger.info("Manifest successfully pushed!")
+
+
+def _manifest_name(image: str, arch: str) -> str:
+    # a manifest list is named after its images, without the architecture suffix
+    suffix = f"-{arch}"
+    return image[: -len(suffix)] if image.endswith(suffix) else image
+
+
 def _transfer_image(origin, destination, image, image_size):
-    monitor_info = "" if which("pv") else " (install `pv` to see the progress)"
-    dtslogger.info(f'Transferring image "{image}": [{origin}] -> [{destination}]{monitor_info}...')
-    data_source = ["docker", "-H=%s" % origin, "save", image]
-    data_destination = ["docker", "-H=%s" % destination, "load"]
-    progress_monitor = ["|", "pv", "-cN", "image", "-s", image_size] if which("pv") else []
-    cmd = data_source + progress_monitor + data_destination
-    start_command_in_subprocess(cmd, nostdout=True)
+    dtslogger.info(f'Transferring image "{image}": [{origin}] -> [{destination}]...')
+    dtslogger.debug(f"The image is {human_size(image_size)} in total.")
+    transfer_image(image, origin=origin, destination=destination, progress=True)
 
 
 def _build_line(line):
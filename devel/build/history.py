@@ -0,0 +1,124 @@
+import json
+import os
+import time
+from os.path import expanduser
+from typing import List, Optional
+
+import termcolor as tc
+
+from dt_shell import dtslogger
+
+BUILD_HISTORY_DIR = os.path.join(expanduser("~"), ".dt-shell", "builds")
+BUILD_HISTORY_LENGTH = 50
+# steps that get slower than this (in seconds and relative terms) are highlighted
+SLOWER_STEP_THRESHOLD_SECS = 5.0
+SLOWER_STEP_THRESHOLD_RATIO = 0.2
+COMMAND_WIDTH = 48
+
+
+def history_file(project: str, arch: str) -> str:
+    return os.path.join(BUILD_HISTORY_DIR, project, f"{arch}.jsonl")
+
+
+def load_history(project: str, arch: str) -> List[dict]:
+    records = []
+    try:
+        with open(history_file(project, arch), "rt") as fin:
+            for line in fin:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except OSError:
+        pass
+    return records
+
+
+def record_build(project: str, arch: str, image: str, engine: str, duration: float, report: dict) -> dict:
+    """
+    Appends the timing and caching record of a build to the history of the project and arch.
+    Only the last BUILD_HISTORY_LENGTH builds are kept.
+    """
+    record = {
+        "time": time.time(),
+        "image": image,
+        "engine": engine,
+        "duration": duration,
+        "final_image_size": report["final_image_size"],
+        "steps": [
+            {key: step[key] for key in ["step", "command", "duration", "cached", "size"]}
+            for step in report["steps"]
+        ],
+    }
+    records = load_history(project, arch)[-(BUILD_HISTORY_LENGTH - 1) :] + [record]
+    fpath = history_file(project, arch)
+    try:
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with open(f"{fpath}.tmp", "wt") as fout:
+            for r in records:
+                fout.write(json.dumps(r, sort_keys=True) + "\n")
+        os.replace(f"{fpath}.tmp", fpath)
+    except OSError as e:
+        dtslogger.warning(f"Could not write the build history. Reason: {str(e)}")
+    return record
+
+
+def _fmt_duration(value: Optional[float]) -> str:
+    return "ND" if value is None else f"{value:.1f}s"
+
+
+def _fmt_cached(value: Optional[bool]) -> str:
+    return "-" if value is None else ("Y" if value else "N")
+
+
+def print_comparison(previous: Optional[dict], current: dict, nocolor: bool = False):
+    """
+    Prints the steps of the current build next to the same steps of the previous build.
+    Steps are matched by command, the same command can appear more than once in a Dockerfile.
+    """
+    colored = (lambda s, *_: s) if nocolor else tc.colored
+    print()
+    if previous is None:
+        print("No previous build to compare against.")
+        print()
+        return
+    then = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(previous["time"]))
+    print(f"Build comparison (previous build: {then})")
+    print("-" * 84)
+    print(f"{'Step':<6}{'Command':<{COMMAND_WIDTH}}{'Before':>9}{'Now':>9}{'Delta':>9}  Cache")
+    print("-" * 84)
+    previous_steps = {}
+    for step in previous["steps"]:
+        previous_steps.setdefault(step["command"], []).append(step)
+    for step in current["steps"]:
+        matches = previous_steps.get(step["command"], [])
+        before = matches.pop(0) if matches else None
+        command = step["command"]
+        if len(command) > COMMAND_WIDTH - 2:
+            command = command[: COMMAND_WIDTH - 5] + "..."
+        delta_str = ""
+        color = None
+        if before is not None and before["duration"] is not None and step["duration"] is not None:
+            delta = step["duration"] - before["duration"]
+            delta_str = f"{delta:+.1f}s"
+            slower = delta > SLOWER_STEP_THRESHOLD_SECS
+            if slower and delta > SLOWER_STEP_THRESHOLD_RATIO * before["duration"]:
+                color = "red"
+            elif -delta > SLOWER_STEP_THRESHOLD_SECS:
+                color = "green"
+        elif before is None:
+            delta_str = "new"
+        cache = f"{_fmt_cached(before['cached'] if before else None)} -> {_fmt_cached(step['cached'])}"
+        line = (
+            f"{step['step']:<6}{command:<{COMMAND_WIDTH}}"
+            f"{_fmt_duration(before['duration'] if before else None):>9}"
+            f"{_fmt_duration(step['duration']):>9}{delta_str:>9}  {cache}"
+        )
+        print(colored(line, color) if color else line)
+    print("-" * 84)
+    total_delta = current["duration"] - previous["duration"]
+    print(
+        f"Total: {_fmt_duration(previous['duration'])} -> {_fmt_duration(current['duration'])} "
+        f"({total_delta:+.1f}s)"
+    )
+    print()
@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 
+import json
 import re
+import time
+from typing import List, Optional
 
 import termcolor as tc
 
@@ -11,8 +14,131 @@ SEPARATORS_LENGTH_HALF = 25
 
 EXTRA_INFO_SEPARATOR = "-" * SEPARATORS_LENGTH_HALF
 
+# RegEx patterns
+STEP_PATTERN = re.compile("Step ([0-9]+)/([0-9]+) : (.*)")
+LAYER_PATTERN = re.compile(" ---> ([0-9a-z]{12})")
+CACHE_STRING = " ---> Using cache"
+FINAL_LAYER_PATTERN = re.compile("Successfully tagged (.*)")
+
+
+class BuildStepInfo(object):
+    def __init__(self, number: int, total: int, command: str, started: float):
+        self.number = number
+        self.total = total
+        self.command = command
+        self.started = started
+        self.committed = None
+        self.duration = None
+        self.layer = None
+        self.cache_hits = 0
+
 
 class ImageAnalyzer(object):
+    """
+    Consumes the lines of a build log as they arrive and keeps only one record per build step.
+    Once the build is over, the image history is used to attribute a size to every step.
+    """
+
+    def __init__(self):
+        self.steps: List[BuildStepInfo] = []
+        self.image_names: List[str] = []
+        self._last = None
+
+    def feed(self, line: str, timestamp: Optional[float] = None):
+        timestamp = time.time() if timestamp is None else timestamp
+        line = line.strip("\n")
+        if line.startswith("Step "):
+            match = STEP_PATTERN.match(line)
+            if match:
+                self._close_step(timestamp)
+                number, total, command = match.groups()
+                self._last = BuildStepInfo(int(number), int(total), re.sub(" +", " ", command), timestamp)
+                self.steps.append(self._last)
+                self.image_names = []
+                return
+        elif line.startswith(" ---> ") and self._last is not None:
+            if line == CACHE_STRING:
+                self._last.cache_hits += 1
+            elif self._last.layer is None:
+                match = LAYER_PATTERN.match(line)
+                if match:
+                    # the step is over as soon as its layer is committed
+                    self._last.layer = match.group(1)
+                    self._last.committed = timestamp
+                    self._close_step(timestamp)
+            self.image_names = []
+            return
+        match = FINAL_LAYER_PATTERN.match(line) if line.startswith("Successfully tagged") else None
+        if match:
+            self._close_step(timestamp)
+            self.image_names.append(match.group(1))
+        else:
+            self.image_names = []
+
+    def _close_step(self, timestamp: float):
+        if self._last is not None and self._last.duration is None:
+            self._last.duration = timestamp - self._last.started
+
+    @property
+    def succeeded(self) -> bool:
+        # a successful build log ends with the names of the image
+        return len(self.image_names) > 0
+
+    def report(self, historylog) -> dict:
+        """
+        Returns the analysis of the build as a JSON-serializable dictionary.
+        """
+        if not self.steps and not self.image_names:
+            raise ValueError("The build log is empty")
+        if not historylog:
+            raise ValueError("The image history is empty")
+        # sanitize history log
+        historylog = [
+            (lid[7:19] if lid.startswith("sha256:") else lid, int(size)) for (lid, size) in historylog
+        ]
+        # create map {layerid: size_bytes}
+        layer_to_size_bytes = {lid: size for lid, size in historylog if "missing" not in lid}
+        # for each Step, find whether it was cached
+        steps = []
+        first_layer = None
+        cached_layers = 0
+        for step in self.steps:
+            cached = first_layer is None or step.cache_hits == 1
+            cached_layers += int(cached)
+            if step.layer is not None and step.command.startswith("FROM"):
+                first_layer = step.layer
+                cached_layers += 1
+            steps.append(
+                {
+                    "step": step.number,
+                    "total": step.total,
+                    "command": step.command,
+                    "layer": step.layer,
+                    "size": layer_to_size_bytes.get(step.layer),
+                    "cached": cached,
+                    "duration": step.duration,
+                }
+            )
+        # get info about layers
+        tot_layers = len(steps)
+        cached_layers = min(tot_layers, cached_layers)
+        # compute size of base and final image
+        first_layer_idx = [i for i, (lid, _) in enumerate(historylog) if lid == first_layer][0]
+        base_image_size = sum([size for _, size in historylog[first_layer_idx:]])
+        final_image_size = sum([size for _, size in historylog])
+        return {
+            "images": list(self.image_names),
+            "steps": steps,
+            "layers": {
+                "total": tot_layers,
+                "built": tot_layers - cached_layers,
+                "cached": cached_layers,
+            },
+            "base_image_size": base_image_size,
+            "final_image_size": final_image_size,
+            "added_size": final_image_size - base_image_size,
+        }
+
     @staticmethod
     def about():
         print()
@@ -33,94 +159,30 @@ class ImageAnalyzer(object):
         return f"%.{precision}f%s%s".format(num, "Yi", suffix)
 
     @staticmethod
-    def process(buildlog, historylog, codens=0, extra_info=None, nocolor=False):
-        lines = buildlog
+    def print_report(report: dict, extra_info=None, nocolor=False):
         size_fmt = ImageAnalyzer.size_fmt
-
-        # return if the log is empty
-        if not lines:
-            raise ValueError("The build log is empty")
-
-        # return if the image history is empty
-        if not historylog:
-            raise ValueError("The image history is empty")
-
         if nocolor:
             tc.colored = lambda s, *_: s
 
-        # define RegEx patterns
-        step_pattern = re.compile("Step ([0-9]+)/([0-9]+) : (.*)")
-        layer_pattern = re.compile(" ---> ([0-9a-z]{12})")
-        cache_string = " ---> Using cache"
-        final_layer_pattern = re.compile("Successfully tagged (.*)")
-
-        # sanitize log
-        lines = list(map(lambda s: s.strip("\n"), lines))
-
-        # check if the build process succeded
-        if not final_layer_pattern.match(lines[-1]):
-            exit(codens + 2)
-        image_names = []
-        for line in reversed(lines):
-            match = final_layer_pattern.match(line)
-            if match:
-                image_names.append(match.group(1))
-            else:
-                break
-
         print()
         ImageAnalyzer.about()
 
-        # find "Step XY/TOT" lines
-        steps_idx = [i for i in range(len(lines)) if step_pattern.match(lines[i])] + [len(lines)]
-
-        # sanitize history log
-        historylog = [(lid[7:19] if lid.startswith("sha256:") else lid, size) for (lid, size) in historylog]
-
-        # create map {layerid: size_bytes}
-        layer_to_size_bytes = dict()
-        for layerid, layersize in historylog:
-            if "missing" in layerid:
-                continue
-            layer_to_size_bytes[layerid] = int(layersize)
-
-        # for each Step, find the layer ID
-        first_layer = None
-        cached_layers = 0
-        for i, j in zip(steps_idx, steps_idx[1:]):
+        for step in report["steps"]:
             indent_str = "|"
             layerid_str = "Layer ID:"
             size_str = "Size:"
-            cur_step_lines = lines[i:j]
-            open_layers = [layer_pattern.match(line) for line in cur_step_lines if layer_pattern.match(line)]
-            # check for cached layers
-            step_cache = tc.colored("No", "red")
-            if first_layer is None or len(list(filter(lambda s: s == cache_string, cur_step_lines))) == 1:
-                cached_layers += 1
-                step_cache = tc.colored("Yes", "green")
-            # get Step info
+            step_cache = tc.colored("Yes", "green") if step["cached"] else tc.colored("No", "red")
             print("-" * SEPARATORS_LENGTH)
-            stepline = lines[i]
-            stepno = step_pattern.match(stepline).group(1)
-            steptot = step_pattern.match(stepline).group(2)
-            stepcmd = re.sub(" +", " ", step_pattern.match(stepline).group(3))
             # get info about layer ID and size
-            layerid = None
             layersize = "ND"
             bg_color = "white"
             fg_color = "grey"
-            if len(open_layers) > 0:
-                layerid = open_layers[0].group(1)
-                if stepcmd.startswith("FROM"):
-                    first_layer = layerid
-                    cached_layers += 1
-            # ---
-            if layerid in layer_to_size_bytes:
-                layersize = size_fmt(layer_to_size_bytes[layerid])
+            if step["size"] is not None:
+                layersize = size_fmt(step["size"])
                 fg_color = "white"
-                bg_color = "yellow" if layer_to_size_bytes[layerid] > LAYER_SIZE_YELLOW else "green"
-                bg_color = "red" if layer_to_size_bytes[layerid] > LAYER_SIZE_RED else bg_color
-                bg_color = "blue" if stepcmd.startswith("FROM") else bg_color
+                bg_color = "yellow" if step["size"] > LAYER_SIZE_YELLOW else "green"
+                bg_color = "red" if step["size"] > LAYER_SIZE_RED else bg_color
+                bg_color = "blue" if step["command"].startswith("FROM") else bg_color
 
             indent_str = tc.colored(indent_str, fg_color, "on_" + bg_color)
             size_str = tc.colored(size_str, fg_color, "on_" + bg_color)
@@ -130,15 +192,15 @@ class ImageAnalyzer(object):
                 "%s %s\n%sStep: %s/%s\n%sCached: %s\n%sCommand: \n%s\t%s\n%s%s %s"
                 % (
                     layerid_str,
-                    layerid,
+                    step["layer"],
                     indent_str,
-                    stepno,
-                    steptot,
+                    step["step"],
+                    step["total"],
                     indent_str,
                     step_cache,
                     indent_str,
                     indent_str,
-                    stepcmd,
+                    step["command"],
                     indent_str,
                     size_str,
                     layersize,
@@ -146,15 +208,6 @@ class ImageAnalyzer(object):
             )
             print()
 
-        # get info about layers
-        tot_layers = len(steps_idx) - 1
-        cached_layers = min(tot_layers, cached_layers)
-
-        # compute size of base and final image
-        first_layer_idx = [i for i in range(len(historylog)) if historylog[i][0] == first_layer][0]
-        base_image_size = sum([int(line[1]) for line in historylog[first_layer_idx:]])
-        final_image_size = sum([int(line[1]) for line in historylog])
-
         # print info about the whole image
         print()
         print(
@@ -174,14 +227,14 @@ class ImageAnalyzer(object):
         )
         print()
         print("=" * SEPARATORS_LENGTH)
-        print("Final image name: %s" % ("\n" + " " * 18).join(image_names))
-        print("Base image size: %s" % size_fmt(base_image_size))
-        print("Final image size: %s" % size_fmt(final_image_size))
-        print("Your image added %s to the base image." % size_fmt(final_image_size - base_image_size))
+        print("Final image name: %s" % ("\n" + " " * 18).join(report["images"]))
+        print("Base image size: %s" % size_fmt(report["base_image_size"]))
+        print("Final image size: %s" % size_fmt(report["final_image_size"]))
+        print("Your image added %s to the base image." % size_fmt(report["added_size"]))
         print(EXTRA_INFO_SEPARATOR)
-        print("Layers total: {:d}".format(tot_layers))
-        print(" - Built: {:d}".format(tot_layers - cached_layers))
-        print(" - Cached: {:d}".format(cached_layers))
+        print("Layers total: {:d}".format(report["layers"]["total"]))
+        print(" - Built: {:d}".format(report["layers"]["built"]))
+        print(" - Cached: {:d}".format(report["layers"]["cached"]))
         if extra_info is not None and len(extra_info) > 0:
             print(EXTRA_INFO_SEPARATOR)
             print(extra_info)
@@ -191,5 +244,28 @@ class ImageAnalyzer(object):
             tc.colored("IMPORTANT", "white", "on_blue") + ": Always ask yourself, can I do better than that?"
         )
         print()
-        # ---
-        return image_names, base_image_size, final_image_size
+
+    def analyze(self, historylog, codens=0, extra_info=None, nocolor=False, report_file=None):
+        # return if the image history is empty
+        if not historylog:
+            raise ValueError("The image history is empty")
+        # check if the build process succeded
+        if not self.succeeded:
+            exit(codens + 2)
+        report = self.report(historylog)
+        self.print_report(report, extra_info=extra_info, nocolor=nocolor)
+        if report_file is not None:
+            with open(report_file, "wt") as fout:
+                json.dump(report, fout, indent=4, sort_keys=True)
+        return report
+
+    @staticmethod
+    def process(buildlog, historylog, codens=0, extra_info=None, nocolor=False):
+        # return if the log is empty
+        if not buildlog:
+            raise ValueError("The build log is empty")
+        analyzer = ImageAnalyzer()
+        for line in buildlog:
+            analyzer.feed(line)
+        report = analyzer.analyze(historylog, codens=codens, extra_info=extra_info, nocolor=nocolor)
+        return report["images"], report["base_image_size"], report["final_image_size"]
@@ -3,7 +3,7 @@ import os
 
 from dt_shell import DTCommandAbs, dtslogger
 from utils.cli_utils import start_command_in_subprocess
-from utils.dtproject_utils import DTProject
+from utils.dtproject_utils import get_project
 
 
 class DTCommand(DTCommandAbs):
@@ -41,7 +41,7 @@ class DTCommand(DTCommandAbs):
         # show info about project
         dtslogger.info("Project workspace: {}".format(parsed.workdir))
         shell.include.devel.info.command(shell, args)
-        project = DTProject(parsed.workdir)
+        project = get_project(parsed.workdir)
         # check if the index is clean
         if project.is_dirty():
             dtslogger.warning("Your index is not clean (some files are not committed).")
@@ -5,7 +5,7 @@ import subprocess
 
 from dt_shell import DTCommandAbs, DTShell, dtslogger
 from utils.docker_utils import DEFAULT_MACHINE, get_endpoint_architecture, get_registry_to_use
-from utils.dtproject_utils import DTProject
+from utils.dtproject_utils import get_project
 from utils.duckietown_utils import DEFAULT_OWNER
 
 
@@ -52,7 +52,7 @@ class DTCommand(DTCommandAbs):
 
         # show info about project
         shell.include.devel.info.command(shell, args)
-        project = DTProject(parsed.workdir)
+        project = get_project(parsed.workdir)
 
         registry_to_use = get_registry_to_use()
 
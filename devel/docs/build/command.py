@@ -5,17 +5,16 @@ import pathlib
 import sys
 import tarfile
 
-import docker
-
 from dt_shell import DTCommandAbs, dtslogger
 from utils.cli_utils import start_command_in_subprocess
 from utils.docker_utils import (
     build_logs_to_string,
+    get_client,
     get_endpoint_architecture,
     get_registry_to_use,
     login_client,
 )
-from utils.dtproject_utils import DTProject
+from utils.dtproject_utils import get_project
 
 
 class DTCommand(DTCommandAbs):
@@ -87,7 +86,7 @@ class DTCommand(DTCommandAbs):
         # show info about project
         if not parsed.quiet:
             shell.include.devel.info.command(shell, args)
-        project = DTProject(parsed.workdir)
+        project = get_project(parsed.workdir)
         # check if the index is clean
         if project.is_dirty():
             dtslogger.warning("Your index is not clean (some files are not committed).")
@@ -126,7 +125,7 @@ class DTCommand(DTCommandAbs):
         dtslogger.info("Done!")
 
         # Get a docker client
-        dclient = docker.from_env()
+        dclient = get_client()
 
         login_client(dclient, shell.shell_config, registry_to_use, raise_on_error=False)
 
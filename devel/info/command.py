@@ -4,7 +4,9 @@ import os
 import termcolor as tc
 
 from dt_shell import DTCommandAbs, DTShell
-from utils.dtproject_utils import DTProject
+from utils.docker_utils import get_registry_to_use
+from utils.dtproject_utils import CANONICAL_ARCH, dtlabel, get_project
+from utils.duckietown_utils import DEFAULT_OWNER
 
 PROJECT_INFO = """
 {project}
@@ -20,6 +22,12 @@ PROJECT_INFO = """
 {end}
 """
 
+REMOTE_INFO = """
+{remote}
+{images}
+{end}
+"""
+
 nocolor = lambda s, *_: s
 
 
@@ -42,6 +50,12 @@ class DTCommand(DTCommandAbs):
             action="store_true",
             help="Overwrites configuration for CI (Continuous Integration)",
         )
+        parser.add_argument(
+            "--remote",
+            default=False,
+            action="store_true",
+            help="Check whether the images of the project on the registry are up to date",
+        )
         parsed, _ = parser.parse_known_args(args=args)
         if "parsed" in kwargs:
             parsed.__dict__.update(kwargs["parsed"].__dict__)
@@ -50,7 +64,7 @@ class DTCommand(DTCommandAbs):
             # disable coloring
             tc.colored = nocolor
         parsed.workdir = os.path.abspath(parsed.workdir)
-        project = DTProject(parsed.workdir)
+        project = get_project(parsed.workdir)
         info = {
             "project": tc.colored("Project:", "grey", "on_white"),
             "name": project.name,
@@ -66,6 +80,33 @@ class DTCommand(DTCommandAbs):
             "end": tc.colored("________", "grey", "on_white"),
         }
         print(PROJECT_INFO.format(**info))
+        # remote images
+        if getattr(parsed, "remote", False):
+            registry_to_use = get_registry_to_use()
+            archs = sorted(set(CANONICAL_ARCH.values()))
+            # all the architectures are checked at once
+            remote = project.remote_images(archs, owner=DEFAULT_OWNER, registry=registry_to_use)
+            images = []
+            for arch in archs:
+                image = project.image(arch=arch, owner=DEFAULT_OWNER, registry=registry_to_use)
+                if remote[arch] is None:
+                    status = tc.colored("Not found", "red")
+                else:
+                    remote_sha = remote[arch].labels.get(dtlabel("code.sha"), "ND")
+                    remote_time = remote[arch].labels.get(dtlabel("time"), "ND")
+                    if project.is_clean() and remote_sha == project.sha:
+                        status = tc.colored("Up to date", "green")
+                    else:
+                        status = f"Outdated (code: {remote_sha[:8]}, built: {remote_time})"
+                        status = tc.colored(status, "yellow")
+                images.append(f"{info['space']}{image}: {status}")
+            print(
+                REMOTE_INFO.format(
+                    remote=tc.colored("Remote images:", "grey", "on_white"),
+                    images="\n".join(images),
+                    end=info["end"],
+                )
+            )
 
     @staticmethod
     def complete(shell, word, line):
@@ -14,7 +14,7 @@ from utils.docker_utils import (
     login_client,
     push_image,
 )
-from utils.dtproject_utils import DTProject
+from utils.dtproject_utils import get_project
 
 
 class DTCommand(DTCommandAbs):
@@ -79,7 +79,7 @@ class DTCommand(DTCommandAbs):
 
         # show info about project
         shell.include.devel.info.command(shell, [], parsed=parsed)
-        project = DTProject(parsed.workdir)
+        project = get_project(parsed.workdir)
 
         registry_to_use = get_registry_to_use()
 
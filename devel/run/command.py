@@ -1,25 +1,24 @@
 import argparse
-import json
 import os
 import shutil
 import subprocess
+from types import SimpleNamespace
 
 from dt_shell import DTCommandAbs, dtslogger
-from utils.cli_utils import check_program_dependency
 from utils.docker_utils import (
     DEFAULT_MACHINE,
     DOCKER_INFO,
     get_endpoint_architecture,
+    get_endpoint_info,
     get_registry_to_use,
 )
-from utils.dtproject_utils import BUILD_COMPATIBILITY_MAP, CANONICAL_ARCH, DTProject
+from utils.dtproject_utils import BUILD_COMPATIBILITY_MAP, CANONICAL_ARCH, get_project
 from utils.misc_utils import human_size, sanitize_hostname
 from utils.multi_command_utils import MultiCommand
 
 LAUNCHER_FMT = "dt-launcher-%s"
 DEFAULT_MOUNTS = ["/var/run/avahi-daemon/socket", "/data"]
 DEFAULT_NETWORK_MODE = "host"
-DEFAULT_REMOTE_USER = "duckie"
 
 
 class DTCommand(DTCommandAbs):
@@ -192,7 +191,7 @@ class DTCommand(DTCommandAbs):
         # show info about project
         shell.include.devel.info.command(shell, args)
         # get info about project
-        project = DTProject(parsed.workdir)
+        project = get_project(parsed.workdir)
         # container name
         if not parsed.name:
             parsed.name = "dts-run-{:s}".format(project.name)
@@ -264,7 +263,7 @@ class DTCommand(DTCommandAbs):
                 if not os.path.isdir(project_path):
                     dtslogger.error('The path "{:s}" is not a Duckietown project'.format(project_path))
                 # get project info
-                proj = DTProject(project_path)
+                proj = get_project(project_path)
                 # get local and remote paths to code and launchfile
                 local_src, destination_src = proj.code_paths()
                 local_launch, destination_launch = proj.launch_paths()
@@ -297,12 +296,7 @@ class DTCommand(DTCommandAbs):
         )
         # get info about docker endpoint
         dtslogger.info("Retrieving info about Docker endpoint...")
-        epoint = _run_cmd(
-            ["docker", "-H=%s" % parsed.machine, "info", "--format", "{{json .}}"],
-            get_output=True,
-            print_output=False,
-        )
-        epoint = json.loads(epoint)
+        epoint = get_endpoint_info(parsed.machine)
         if "ServerErrors" in epoint:
             dtslogger.error("\n".join(epoint["ServerErrors"]))
             return
@@ -395,27 +389,11 @@ class DTCommand(DTCommandAbs):
         parsed.docker_args = [a.replace(" ", "\\ ") for a in parsed.docker_args]
         # sync
         if parsed.sync:
-            # TODO: this can just become a call to devel.sync
-            # only allowed when mounting remotely
-            if parsed.machine == DEFAULT_MACHINE:
-                dtslogger.error("The option -s/--sync can only be used together with -H/--machine")
-                exit(2)
-            # make sure rsync is installed
-            check_program_dependency("rsync")
-            dtslogger.info(f"Syncing code with {parsed.machine.replace('.local', '')}...")
-            remote_path = f"{DEFAULT_REMOTE_USER}@{parsed.machine}:/code/"
-            # get projects' locations
-            projects_to_sync = [parsed.workdir] if parsed.mount is True else []
-            # sync secondary projects
-            if isinstance(parsed.mount, str):
-                projects_to_sync.extend(
-                    [os.path.abspath(os.path.join(os.getcwd(), p.strip())) for p in parsed.mount.split(",")]
-                )
-            # run rsync
-            for project_path in projects_to_sync:
-                cmd = f"rsync --archive {project_path} {remote_path}"
-                _run_cmd(cmd, shell=True)
-            dtslogger.info(f"Code synced!")
+            shell.include.devel.sync.command(
+                shell,
+                [],
+                parsed=SimpleNamespace(workdir=parsed.workdir, machine=parsed.machine, mount=parsed.mount),
+            )
         # run
         exitcode = _run_cmd(
             [parsed.runtime, "-H=%s" % parsed.machine, "run", "-it"]
@@ -1,14 +1,29 @@
 import argparse
 import os
+import re
 import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Set
 
 from dt_shell import DTCommandAbs, dtslogger
 from utils.cli_utils import check_program_dependency
 from utils.docker_utils import DEFAULT_MACHINE
 from utils.misc_utils import sanitize_hostname
 from utils.multi_command_utils import MultiCommand
+from utils.pip_utils import import_or_install
+from utils.progress_bar import StatusLines
 
 DEFAULT_REMOTE_USER = "duckie"
+DEFAULT_REMOTE_PATH = "/code/"
+DEFAULT_FLEET_WORKERS = 8
+SSH_CONTROL_PERSIST = "10m"
+WATCH_DEBOUNCE_SECS = 0.5
+WATCH_POLL_SECS = 0.1
+# rsync exit codes: 0 (ok), 24 (some source files vanished before they could be transferred)
+RSYNC_OK_CODES = [0, 24]
 
 
 class DTCommand(DTCommandAbs):
@@ -25,7 +40,8 @@ class DTCommand(DTCommandAbs):
             "-H",
             "--machine",
             default=None,
-            help="Docker socket or hostname where to run the image",
+            help="Hostname(s) of the machine(s) to sync the code with, "
+            "comma-separated or as a range (e.g., 'robot{1-20}')",
         )
         parser.add_argument(
             "-M",
@@ -38,33 +54,42 @@ class DTCommand(DTCommandAbs):
             help="Whether to mount the current project into the container. "
             "Pass a comma-separated list of paths to mount multiple projects",
         )
+        parser.add_argument(
+            "-w",
+            "--watch",
+            default=False,
+            action="store_true",
+            help="Keep watching the projects and sync the files as they change",
+        )
+        parser.add_argument(
+            "--workers",
+            default=DEFAULT_FLEET_WORKERS,
+            type=int,
+            help="Number of machines to sync with at the same time",
+        )
         # get pre-parsed or parse arguments
         parsed = kwargs.get("parsed", None)
-        if not parsed:
-            # try to interpret it as a multi-command
-            multi = MultiCommand(DTCommand, shell, [("-H", "--machine")], args)
-            if multi.is_multicommand:
-                multi.execute()
-                return
         if not parsed:
             parsed, _ = parser.parse_known_args(args=args)
         # ---
         parsed.workdir = os.path.abspath(parsed.workdir)
-        # sanitize hostname
-        if parsed.machine is not None:
-            parsed.machine = sanitize_hostname(parsed.machine)
-        else:
-            parsed.machine = DEFAULT_MACHINE
+        watch = getattr(parsed, "watch", False)
+        workers = getattr(parsed, "workers", DEFAULT_FLEET_WORKERS)
+        # sanitize hostnames (the local Docker socket is not a machine we can sync with)
+        machines = []
+        if parsed.machine not in [None, DEFAULT_MACHINE]:
+            # commas inside braces belong to the range (e.g., 'robot{1,3,5}')
+            for machine in re.split(r",(?![^{]*})", parsed.machine):
+                # noinspection PyProtectedMember
+                machines.extend(map(sanitize_hostname, MultiCommand._parse_values(machine.strip()) or []))
         # ---
         # sync
-        if parsed.machine == DEFAULT_MACHINE:
+        if not machines:
             # only allowed when mounting remotely
             dtslogger.error("The option -s/--sync can only be used together with -H/--machine")
             exit(2)
         # make sure rsync is installed
         check_program_dependency("rsync")
-        dtslogger.info(f"Syncing code with {parsed.machine.replace('.local', '')}...")
-        remote_path = f"{DEFAULT_REMOTE_USER}@{parsed.machine}:/code/"
         # get projects' locations
         projects_to_sync = [parsed.workdir] if parsed.mount is True else []
         # sync secondary projects
@@ -72,36 +97,207 @@ class DTCommand(DTCommandAbs):
             projects_to_sync.extend(
                 [os.path.abspath(os.path.join(os.getcwd(), p.strip())) for p in parsed.mount.split(",")]
             )
-        # run rsync
-        for project_path in projects_to_sync:
-            cmd = f"rsync --archive {project_path} {remote_path}"
-            _run_cmd(cmd, shell=True)
-        dtslogger.info(f"Code synced!")
+        names = [m.replace(".local", "") for m in machines]
+        dtslogger.info(f"Syncing code with {', '.join(names)}...")
+        status = StatusLines(names)
+        with tempfile.TemporaryDirectory(prefix="dts-sync-") as tmpdir:
+            filters = {p: _rsync_filters(p, tmpdir) for p in projects_to_sync}
+            remotes = [RemoteSync(m, n, filters, tmpdir, status) for m, n in zip(machines, names)]
+            try:
+                # full sync first
+                failed = _fan_out(remotes, lambda r: r.sync_all(), workers)
+                if failed and not watch:
+                    dtslogger.error(f"Could not sync the code with {', '.join(r.name for r in failed)}.")
+                    exit(1)
+                if not watch:
+                    dtslogger.info(f"Code synced!")
+                    return
+                # then only what changes
+                _watch(projects_to_sync, remotes, workers)
+            finally:
+                for remote in remotes:
+                    remote.close()
 
     @staticmethod
     def complete(shell, word, line):
         return []
 
 
-def _run_cmd(cmd, get_output=False, print_output=False, suppress_errors=False, shell=False):
-    if shell and isinstance(cmd, (list, tuple)):
-        cmd = " ".join([str(s) for s in cmd])
-    dtslogger.debug("$ %s" % cmd)
-    if get_output:
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=shell)
-        proc.wait()
-        if proc.returncode != 0:
-            if not suppress_errors:
-                msg = "The command {} returned exit code {}".format(cmd, proc.returncode)
-                dtslogger.error(msg)
-                raise RuntimeError(msg)
-        out = proc.stdout.read().decode("utf-8").rstrip()
-        if print_output:
-            print(out)
-        return out
-    else:
-        try:
-            subprocess.check_call(cmd, shell=shell)
-        except subprocess.CalledProcessError as e:
-            if not suppress_errors:
-                raise e
+class RemoteSync(object):
+    """
+    Syncs projects with one machine, all the transfers go through the same (multiplexed) SSH connection.
+    """
+
+    def __init__(self, machine: str, name: str, filters: Dict[str, List[str]], tmpdir: str, status):
+        self.machine = machine
+        self.name = name
+        self._filters = filters
+        self._status = status
+        self._remote = f"{DEFAULT_REMOTE_USER}@{machine}"
+        self._ssh = [
+            "ssh",
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            f"ControlPath={os.path.join(tmpdir, '%r@%h:%p')}",
+            "-o",
+            f"ControlPersist={SSH_CONTROL_PERSIST}",
+        ]
+
+    def _rsync(self, project_path: str, extra: List[str], files: List[str] = None) -> bool:
+        cmd = ["rsync", "--archive", "-e", " ".join(self._ssh)] + self._filters[project_path] + extra
+        source = project_path if files is None else os.path.dirname(project_path) + "/"
+        cmd += [source, f"{self._remote}:{DEFAULT_REMOTE_PATH}"]
+        dtslogger.debug("$ %s" % " ".join(cmd))
+        proc = subprocess.run(
+            cmd,
+            input="\n".join(files) if files is not None else None,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        if proc.returncode not in RSYNC_OK_CODES:
+            dtslogger.debug(f"[{self.name}] rsync exited with code {proc.returncode}:\n{proc.stderr}")
+            self._status.update(self.name, f"error (rsync exited with code {proc.returncode})")
+            return False
+        return True
+
+    def sync_all(self) -> bool:
+        self._status.update(self.name, "syncing...")
+        stime = time.time()
+        for project_path in self._filters:
+            if not self._rsync(project_path, []):
+                return False
+        self._status.update(self.name, f"synced ({time.time() - stime:.1f}s) at {time.strftime('%H:%M:%S')}")
+        return True
+
+    def sync_files(self, changes: Dict[str, Set[str]]) -> bool:
+        self._status.update(self.name, "syncing...")
+        stime = time.time()
+        nfiles = 0
+        for project_path, paths in changes.items():
+            # the list is relative to the parent directory, the remote copy is /code/<project>/...
+            project = os.path.basename(project_path)
+            files = sorted(os.path.join(project, p) for p in paths)
+            # files that do not exist anymore are deleted on the remote side
+            extra = ["--files-from=-", "--recursive", "--delete-missing-args"]
+            if not self._rsync(project_path, extra, files):
+                return False
+            nfiles += len(files)
+        self._status.update(
+            self.name,
+            f"synced {nfiles} file(s) ({time.time() - stime:.1f}s) at {time.strftime('%H:%M:%S')}",
+        )
+        return True
+
+    def close(self):
+        # stop the SSH master connection (if any)
+        subprocess.run(
+            self._ssh + ["-O", "exit", self._remote], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+
+
+def _fan_out(remotes: List[RemoteSync], fcn, workers: int) -> List[RemoteSync]:
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(remotes)))) as executor:
+        results = list(executor.map(fcn, remotes))
+    return [r for r, ok in zip(remotes, results) if not ok]
+
+
+def _rsync_filters(project_path: str, tmpdir: str) -> List[str]:
+    # .gitignore files can be anywhere in the project, rsync understands them (mostly)
+    filters = ["--filter=:- .gitignore"]
+    dockerignore = os.path.join(project_path, ".dockerignore")
+    if not os.path.isfile(dockerignore):
+        return filters
+    # .dockerignore rules are anchored to the project and the last matching rule wins,
+    # rsync rules are anchored to the transfer root and the first matching rule wins
+    project = os.path.basename(project_path)
+    rules = []
+    with open(dockerignore, "rt") as fin:
+        for line in fin:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            include = line.startswith("!")
+            pattern = line.lstrip("!").strip().strip("/")
+            if pattern.startswith("./"):
+                pattern = pattern[2:]
+            if include:
+                rules.append([f"+ /{project}/{pattern}", f"+ /{project}/{pattern}/**"])
+                # the parents of an included path need to be traversed
+                parts = pattern.split("/")[:-1]
+                rules[-1] += [f"+ /{project}/{'/'.join(parts[: i + 1])}/" for i in range(len(parts))]
+            else:
+                # an excluded directory excludes its content, even where the parent is re-included
+                rules.append([f"- /{project}/{pattern}", f"- /{project}/{pattern}/**"])
+    merge_file = os.path.join(tmpdir, f"{project}.rsync-filter")
+    with open(merge_file, "wt") as fout:
+        for rule in reversed(rules):
+            fout.write("\n".join(rule) + "\n")
+    return filters + [f"--filter=merge {merge_file}"]
+
+
+class _ChangesCollector(object):
+    def __init__(self, projects: List[str]):
+        # longest paths first, projects can be nested
+        self._projects = sorted(projects, key=len, reverse=True)
+        self._changes: Dict[str, Set[str]] = {}
+        self._last_event = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, path: str):
+        for project in self._projects:
+            if path.startswith(project + os.sep):
+                relpath = os.path.relpath(path, project)
+                # git internals change all the time (e.g., index refresh), they are synced in full only
+                if relpath == ".git" or relpath.startswith(".git" + os.sep):
+                    return
+                with self._lock:
+                    self._changes.setdefault(project, set()).add(relpath)
+                    self._last_event = time.time()
+                return
+
+    def take(self, debounce: float) -> Dict[str, Set[str]]:
+        # changes come in bursts (e.g., git checkout, save-all), wait for things to settle down
+        with self._lock:
+            if not self._changes or time.time() - self._last_event < debounce:
+                return {}
+            changes, self._changes = self._changes, {}
+            return changes
+
+
+def _watch(projects: List[str], remotes: List[RemoteSync], workers: int):
+    import_or_install("watchdog", "watchdog")
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+
+    collector = _ChangesCollector(projects)
+
+    class _Handler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            if event.event_type not in ["created", "modified", "deleted", "moved"]:
+                return
+            # a directory is modified when its content changes, the content has its own events
+            if event.is_directory and event.event_type == "modified":
+                return
+            collector.add(event.src_path)
+            if getattr(event, "dest_path", None):
+                collector.add(event.dest_path)
+
+    observer = Observer()
+    handler = _Handler()
+    for project in projects:
+        observer.schedule(handler, project, recursive=True)
+    observer.start()
+    dtslogger.info("Watching for changes, press Ctrl-C to stop...")
+    try:
+        while True:
+            time.sleep(WATCH_POLL_SECS)
+            changes = collector.take(WATCH_DEBOUNCE_SECS)
+            if changes:
+                _fan_out(remotes, lambda r: r.sync_files(changes), workers)
+    except KeyboardInterrupt:
+        dtslogger.info("Stopped watching.")
+    finally:
+        observer.stop()
+        observer.join()
@@ -3,7 +3,7 @@ import os
 import subprocess
 
 from dt_shell import DTCommandAbs, DTShell, dtslogger
-from utils.dtproject_utils import DTProject
+from utils.dtproject_utils import get_project
 
 
 class DTCommand(DTCommandAbs):
@@ -34,7 +34,7 @@ class DTCommand(DTCommandAbs):
         # show info about project
         shell.include.devel.info.command(shell, args)
         # get info about current project
-        project = DTProject(code_dir)
+        project = get_project(code_dir)
         # check if the index is clean
         if project.is_dirty():
             dtslogger.warning("Your index is not clean.")
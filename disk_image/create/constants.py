@@ -7,6 +7,10 @@ DATA_STORAGE_DISK_IMAGE_DIR = "disk_image"
 DEFAULT_STACK = "duckietown"
 AUTOBOOT_STACKS_DIR = "/data/autoboot/"
 DEFAULT_DEVICE_ARCH = "arm32v7"
+DIND_IMAGE = "docker:dind"
+DIND_CONTAINER_NAME = "dts-disk-image-aux-docker"
+DIND_STARTUP_TIMEOUT_SECS = 60
+DEFAULT_DOCKER_PULL_WORKERS = 4
 DOCKER_IMAGE_TEMPLATE = (
     lambda owner, module, tag=None, version=None, arch=DEFAULT_DEVICE_ARCH: f"{owner}/{module}:"
     + (f"{version}-{arch}" if tag is None else tag)
@@ -38,7 +42,6 @@ CLI_TOOLS_NEEDED = [
     "sudo",
     "cp",
     "sha256sum",
-    "strings",
     "grep",
     "stat",
     "udevadm",
@@ -9,14 +9,15 @@ import os
 import shutil
 import subprocess
 import time
-import docker
 import socket
 import getpass
 from datetime import datetime
 
 from utils.cli_utils import ask_confirmation
+from utils.docker_utils import get_client
 from utils.duckietown_utils import get_distro_version
-from utils.misc_utils import human_time
+from utils.misc_utils import human_time, human_size
+from utils.sparse_image_utils import SPARSE_IMAGE_COMPRESSIONS, SPARSE_IMAGE_EXTENSION, write_sparse_image
 
 from disk_image.create.constants import (
     PARTITION_MOUNTPOINT,
@@ -28,12 +29,20 @@ from disk_image.create.constants import (
     DATA_STORAGE_DISK_IMAGE_DIR,
     AUTOBOOT_STACKS_DIR,
     DEFAULT_STACK,
+    DIND_IMAGE,
+    DIND_CONTAINER_NAME,
+    DEFAULT_DOCKER_PULL_WORKERS,
 )
 
 from disk_image.create.utils import (
     VirtualSDCard,
+    StepCache,
+    clone_file,
     check_cli_tools,
     pull_docker_image,
+    pull_docker_images,
+    load_docker_archives,
+    wait_for_docker_engine,
     disk_template_partitions,
     disk_template_objects,
     find_placeholders_on_disk,
@@ -46,7 +55,6 @@ from disk_image.create.utils import (
     transfer_file,
     replace_in_file,
     list_files,
-    copy_file,
     get_validator_fcn,
 )
 
@@ -154,7 +162,41 @@ class DTCommand(DTCommandAbs):
             "--cache-record",
             type=str,
             default=None,
-            help="Step to cache",
+            help="Step to cache, any step can be recorded this way "
+            "(default: all the steps that can be resumed, see --no-step-cache)",
+        )
+        parser.add_argument(
+            "--no-step-cache",
+            default=False,
+            action="store_true",
+            help="Do not reuse nor record the disk image produced by each step. Recording takes a "
+            "full copy of the disk image per step (cheap only on copy-on-write filesystems, e.g., "
+            "btrfs, XFS) and a sync of the disk image after each step",
+        )
+        parser.add_argument(
+            "--pull-workers",
+            type=int,
+            default=DEFAULT_DOCKER_PULL_WORKERS,
+            help="Number of Docker images to pull in parallel (docker step)",
+        )
+        parser.add_argument(
+            "--registry-mirror",
+            type=str,
+            default=None,
+            help="Registry mirror to pull the Docker images from (docker step)",
+        )
+        parser.add_argument(
+            "--docker-archives",
+            type=str,
+            default=None,
+            help="Directory containing `docker save` archives (.tar) to seed the images from (docker step)",
+        )
+        parser.add_argument(
+            "--sparse-compression",
+            type=str,
+            default="zlib",
+            choices=SPARSE_IMAGE_COMPRESSIONS,
+            help="Compression used for the frames of the sparse disk image (compress step)",
         )
         parser.add_argument(
             "--push",
@@ -226,9 +268,6 @@ class DTCommand(DTCommandAbs):
         output_image_name = input_image_name.replace(JETPACK_VERSION, DISK_IMAGE_VERSION)
         out_file_name = lambda ex: f"dt-{output_image_name}.{ex}"
         out_file_path = lambda ex: os.path.join(parsed.output, out_file_name(ex))
-        cached_step_file_path = lambda step, ex: os.path.join(
-            parsed.output, "cache", out_file_name(ex) + f".{step}"
-        )
         # get version
         distro = get_distro_version(shell)
         # create a virtual SD card object
@@ -268,24 +307,56 @@ class DTCommand(DTCommandAbs):
             "stamp_human": datetime.now().isoformat(),
         }
 
+        # create step cache, each step is keyed on its own inputs and on the steps performed before it
+        step_cache = StepCache(os.path.join(parsed.output, "cache"), out_file_name("img"))
+        step_inputs = {
+            "create": [stats["input_url"], DISK_IMAGE_SIZE_GB, DISK_IMAGE_PARTITION_TABLE],
+            "fix": [],
+            "resize": [ROOT_PARTITION],
+            "upgrade": [APT_PACKAGES_TO_INSTALL, APT_PACKAGES_TO_HOLD],
+            "docker": [distro, stats["modules"]],
+            "setup": [distro, DISK_IMAGE_VERSION, DEVICE_ARCH, DISK_TEMPLATE_DIR, STACKS_DIR],
+        }
+        for step in SUPPORTED_STEPS:
+            if step in step_inputs and step in parsed.steps:
+                step_cache.add_step(step, *step_inputs[step])
+
         # create caching function
         def cache_step(step):
-            if step != parsed.cache_record:
+            # an explicit request to record a step is always honored
+            if parsed.cache_record is not None and step != parsed.cache_record:
+                return
+            if parsed.cache_record is None and (parsed.no_step_cache or step not in step_cache.steps):
                 return
             # cache step
             dtslogger.info(f"Caching step '{step}'...")
-            cache_file_path = cached_step_file_path(step, "img")
-            copy_file(out_file_path("img"), cache_file_path)
+            state = {"surgery_plan": surgery_plan, "template": stats["template"]}
+            step_cache.record(step, out_file_path("img"), state)
             dtslogger.info(f"Step '{step}' cached.")
 
+        # resume from the longest sequence of steps whose inputs did not change
+        if parsed.cache_target is None and not parsed.no_step_cache and "create" in parsed.steps:
+            parsed.cache_target = step_cache.longest_prefix()
+            if parsed.cache_target is not None:
+                dtslogger.info(f"Inputs unchanged up to step '{parsed.cache_target}', resuming from cache.")
+
         # use cached step
         if parsed.cache_target is not None:
-            disk_image_origin = cached_step_file_path(parsed.cache_target, "img")
+            disk_image_origin = step_cache.image_path(parsed.cache_target)
             if not os.path.isfile(disk_image_origin):
                 dtslogger.error(f"No cached artifact found for step `{parsed.cache_target}`")
                 return
+            if not step_cache.is_valid(parsed.cache_target):
+                dtslogger.warning(
+                    f"The inputs of step `{parsed.cache_target}` changed since it was cached, "
+                    f"the cached artifact is used anyway."
+                )
+            # restore the state built by the cached steps
+            state = step_cache.state(parsed.cache_target)
+            surgery_plan.extend(state.get("surgery_plan", []))
+            stats["template"] = state.get("template", stats["template"])
             for step in SUPPORTED_STEPS[: SUPPORTED_STEPS.index(parsed.cache_target) + 1]:
-                if step in MANDATORY_STEPS:
+                if step in MANDATORY_STEPS or step not in parsed.steps:
                     continue
                 parsed.steps.remove(step)
             using_cached_step = True
@@ -411,16 +482,19 @@ class DTCommand(DTCommandAbs):
                 )
                 dtslogger.info("Empty disk image created!")
             # make copy of the disk image
-            dtslogger.info(f"Copying [{disk_image_origin}] -> [{out_file_path('img')}]")
-            run_cmd(
-                [
-                    "dd",
-                    f"if={disk_image_origin}",
-                    f"of={out_file_path('img')}",
-                    f"bs={1024 * 1024}",
-                    "" if using_cached_step else "conv=notrunc",
-                ]
-            )
+            if using_cached_step:
+                clone_file(disk_image_origin, out_file_path("img"))
+            else:
+                dtslogger.info(f"Copying [{disk_image_origin}] -> [{out_file_path('img')}]")
+                run_cmd(
+                    [
+                        "dd",
+                        f"if={disk_image_origin}",
+                        f"of={out_file_path('img')}",
+                        f"bs={1024 * 1024}",
+                        "conv=notrunc",
+                    ]
+                )
             # flush buffer
             dtslogger.info("Flushing I/O buffer...")
             run_cmd(["sync"])
@@ -626,44 +700,55 @@ class DTCommand(DTCommandAbs):
                 # mount device
                 sd_card.mount_partition(ROOT_PARTITION)
                 # get local docker client
-                local_docker = docker.from_env()
+                local_docker = get_client()
                 # pull dind image
-                pull_docker_image(local_docker, "docker:dind")
+                pull_docker_image(local_docker, DIND_IMAGE)
                 # run auxiliary Docker engine
                 remote_docker_dir = os.path.join(PARTITION_MOUNTPOINT(ROOT_PARTITION), "var", "lib", "docker")
+                dind_args = []
+                if parsed.registry_mirror:
+                    dind_args.append(f"--registry-mirror={parsed.registry_mirror}")
+                    if parsed.registry_mirror.startswith("http://"):
+                        mirror_host = parsed.registry_mirror[len("http://") :].rstrip("/")
+                        dind_args.append(f"--insecure-registry={mirror_host}")
                 remote_docker_engine_container = local_docker.containers.run(
-                    image="docker:dind",
+                    image=DIND_IMAGE,
                     detach=True,
                     remove=True,
                     auto_remove=True,
                     publish_all_ports=True,
                     privileged=True,
-                    name="dts-disk-image-aux-docker",
+                    name=DIND_CONTAINER_NAME,
                     volumes={remote_docker_dir: {"bind": "/var/lib/docker", "mode": "rw"}},
-                    entrypoint=["dockerd", "--host=tcp://0.0.0.0:2375", "--bridge=none"],
+                    entrypoint=["dockerd", "--host=tcp://0.0.0.0:2375", "--bridge=none"] + dind_args,
                 )
-                dtslogger.info("Waiting 20 seconds for DIND to start...")
-                time.sleep(20)
                 # get IP address of the container
-                container_info = local_docker.api.inspect_container("dts-disk-image-aux-docker")
+                container_info = local_docker.api.inspect_container(DIND_CONTAINER_NAME)
                 container_ip = container_info["NetworkSettings"]["IPAddress"]
                 # create remote docker client
                 endpoint_url = f"tcp://{container_ip}:2375"
-                dtslogger.info(f"DIND should now be up, using endpoint URL `{endpoint_url}`.")
-                remote_docker = docker.DockerClient(base_url=endpoint_url)
+                remote_docker = get_client(endpoint_url)
+                dtslogger.info(f"Waiting for DIND to start on endpoint URL `{endpoint_url}`...")
+                wait_for_docker_engine(remote_docker)
+                dtslogger.info("DIND is up!")
                 # from this point on, if anything weird happens, stop container and unmount disk
                 try:
                     dtslogger.info("Transferring Docker images...")
+                    # seed images from local archives (if any)
+                    if parsed.docker_archives:
+                        load_docker_archives(remote_docker, parsed.docker_archives)
                     # pull images inside the disk image
-                    for module in MODULES_TO_LOAD:
-                        image = DOCKER_IMAGE_TEMPLATE(
+                    images = [
+                        DOCKER_IMAGE_TEMPLATE(
                             owner=module["owner"],
                             module=module["module"],
                             version=distro,
                             tag=module["tag"] if "tag" in module else None,
                             arch=DEVICE_ARCH,
                         )
-                        pull_docker_image(remote_docker, image)
+                        for module in MODULES_TO_LOAD
+                    ]
+                    pull_docker_images(remote_docker, images, parsed.pull_workers)
                     # ---
                     dtslogger.info("Docker images successfully transferred!")
                 except Exception as e:
@@ -882,6 +967,18 @@ class DTCommand(DTCommandAbs):
             dtslogger.info("Step BEGIN: compress")
             dtslogger.info("Compressing disk image...")
             run_cmd(["zip", "-j", out_file_path("zip"), out_file_path("img"), out_file_path("json")])
+            # only the non-zero blocks end up in the sparse image, compressed in parallel
+            dtslogger.info("Creating sparse disk image...")
+            stored = write_sparse_image(
+                out_file_path("img"),
+                out_file_path(SPARSE_IMAGE_EXTENSION),
+                files=[out_file_path("json")],
+                compression=parsed.sparse_compression,
+            )
+            dtslogger.info(
+                f"Stored {human_size(stored)} out of {human_size(os.path.getsize(out_file_path('img')))} "
+                f"in {out_file_path(SPARSE_IMAGE_EXTENSION)}"
+            )
             dtslogger.info("Done!")
             cache_step("compress")
             dtslogger.info("Step END: compress\n")
@@ -896,15 +993,16 @@ class DTCommand(DTCommandAbs):
                 return
             dtslogger.info("Step BEGIN: push")
             dtslogger.info("Pushing disk image...")
-            shell.include.data.push.command(
-                shell,
-                [],
-                parsed=SimpleNamespace(
-                    file=[out_file_path("zip")],
-                    object=[os.path.join(DATA_STORAGE_DISK_IMAGE_DIR, out_file_name("zip"))],
-                    space="public",
-                ),
-            )
+            for ext in ["zip", SPARSE_IMAGE_EXTENSION]:
+                shell.include.data.push.command(
+                    shell,
+                    [],
+                    parsed=SimpleNamespace(
+                        file=[out_file_path(ext)],
+                        object=[os.path.join(DATA_STORAGE_DISK_IMAGE_DIR, out_file_name(ext))],
+                        space="public",
+                    ),
+                )
             dtslogger.info("Done!")
             dtslogger.info("Step END: push\n")
         # Step: push
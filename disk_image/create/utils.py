@@ -1,8 +1,10 @@
 import collections
 import fnmatch
 import glob
+import hashlib
 import itertools
 import json
+import mmap
 import os
 import re
 import shutil
@@ -16,6 +18,7 @@ import yaml
 from disk_image.create.constants import (
     CLI_TOOLS_NEEDED,
     DEFAULT_DEVICE_ARCH,
+    DIND_STARTUP_TIMEOUT_SECS,
     DOCKER_IMAGE_TEMPLATE,
     FILE_PLACEHOLDER_SIGNATURE,
     MODULES_TO_LOAD,
@@ -23,9 +26,10 @@ from disk_image.create.constants import (
 )
 from dt_shell import dtslogger
 from utils.cli_utils import check_program_dependency
+from utils.docker_utils import pull_image, pull_images
 from utils.duckietown_utils import get_distro_version
 from utils.misc_utils import sudo_open
-from utils.progress_bar import ProgressBar
+from utils.sparse_image_utils import data_extents
 
 
 class VirtualSDCard:
@@ -210,6 +214,97 @@ class VirtualSDCard:
         return f"/dev/disk/by-label/{partition}"
 
 
+class StepCache:
+    """
+    Content-addressed cache of the disk image produced by each step.
+
+    The key of a step is the hash of its own inputs chained to the key of the previous step,
+    so that a change in the inputs of a step invalidates that step and all the steps after it.
+    A single artifact is kept per step, cloned (copy-on-write where the filesystem supports it)
+    from the disk image being built.
+    """
+
+    def __init__(self, cache_dir, disk_image_name):
+        self._cache_dir = cache_dir
+        self._disk_image_name = disk_image_name
+        self._keys = collections.OrderedDict()
+
+    @property
+    def steps(self):
+        return list(self._keys.keys())
+
+    def add_step(self, step, *inputs):
+        previous = list(self._keys.values())[-1] if self._keys else ""
+        digest = hashlib.sha256(previous.encode("utf-8"))
+        digest.update(step.encode("utf-8"))
+        for i in inputs:
+            if isinstance(i, str) and os.path.isdir(i):
+                _hash_directory(i, digest)
+            else:
+                digest.update(json.dumps(i, sort_keys=True, default=str).encode("utf-8"))
+        self._keys[step] = digest.hexdigest()
+
+    def key(self, step):
+        return self._keys.get(step, None)
+
+    def image_path(self, step):
+        return os.path.join(self._cache_dir, f"{self._disk_image_name}.{step}")
+
+    def _metadata_path(self, step):
+        return f"{self.image_path(step)}.json"
+
+    def metadata(self, step):
+        if not os.path.isfile(self._metadata_path(step)):
+            return None
+        with open(self._metadata_path(step), "rt") as fin:
+            return json.load(fin)
+
+    def is_valid(self, step):
+        if step not in self._keys or not os.path.isfile(self.image_path(step)):
+            return False
+        metadata = self.metadata(step)
+        return metadata is not None and metadata["key"] == self._keys[step]
+
+    def longest_prefix(self):
+        # keys are chained, a valid step implies that all the steps before it are valid as well
+        for step in reversed(self.steps):
+            if self.is_valid(step):
+                return step
+        return None
+
+    def record(self, step, disk_image, state=None):
+        # make sure the content written through the loop device reached the disk image
+        run_cmd(["sync"])
+        os.makedirs(self._cache_dir, exist_ok=True)
+        # invalidate the old artifact before replacing it
+        if os.path.isfile(self._metadata_path(step)):
+            os.remove(self._metadata_path(step))
+        clone_file(disk_image, self.image_path(step))
+        metadata = {
+            "step": step,
+            "key": self._keys.get(step, None),
+            "state": state or {},
+            "stamp": time.time(),
+        }
+        with open(self._metadata_path(step), "wt") as fout:
+            json.dump(metadata, fout, indent=4, sort_keys=True)
+
+    def state(self, step):
+        metadata = self.metadata(step)
+        return metadata["state"] if metadata else {}
+
+
+def _hash_directory(path, digest):
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+            fpath = os.path.join(root, f)
+            digest.update(os.path.relpath(fpath, path).encode("utf-8"))
+            with open(fpath, "rb") as fin:
+                for chunk in iter(lambda: fin.read(1024 * 1024), b""):
+                    digest.update(chunk)
+
+
 def check_cli_tools(*args):
     clis = CLI_TOOLS_NEEDED + list(args)
     for cli_tool in clis:
@@ -217,23 +312,50 @@ def check_cli_tools(*args):
 
 
 def pull_docker_image(client, image):
-    repository, tag = image.split(":")
-    pbar = ProgressBar()
-    total_layers = set()
-    completed_layers = set()
     dtslogger.info(f"Pulling image {image}...")
-    for step in client.api.pull(repository, tag, stream=True, decode=True):
-        if "status" not in step or "id" not in step:
-            continue
-        total_layers.add(step["id"])
-        if step["status"] in ["Download complete", "Pull complete"]:
-            completed_layers.add(step["id"])
-        # compute progress
-        if len(total_layers) > 0:
-            progress = int(100 * len(completed_layers) / len(total_layers))
-            pbar.update(progress)
-    pbar.update(100)
-    dtslogger.info(f"Image pulled: {image}")
+    status = pull_image(image, endpoint=client)
+    dtslogger.info(f"Image pulled: {image} ({status.summary()})")
+
+
+def wait_for_docker_engine(client, timeout=DIND_STARTUP_TIMEOUT_SECS):
+    stime = time.time()
+    while True:
+        # noinspection PyBroadException
+        try:
+            if client.ping():
+                return
+        except Exception:
+            pass
+        if time.time() - stime > timeout:
+            raise TimeoutError(f"The Docker engine did not become ready within {timeout} seconds")
+        time.sleep(0.5)
+
+
+def load_docker_archives(client, archives_dir):
+    # seed the engine with images exported with `docker save`
+    archives = sorted(glob.glob(os.path.join(archives_dir, "*.tar")))
+    for archive in archives:
+        dtslogger.info(f"Loading images from archive [{archive}]...")
+        with open(archive, "rb") as fin:
+            for _ in client.api.load_image(fin):
+                pass
+    return len(archives)
+
+
+def pull_docker_images(client, images, workers):
+    # images already in the engine (e.g., loaded from an archive) are not pulled again
+    missing = []
+    for image in images:
+        try:
+            client.images.get(image)
+            dtslogger.info(f"Image {image} already present, skipping.")
+        except Exception:
+            missing.append(image)
+    if not missing:
+        return
+    dtslogger.info(f"Pulling {len(missing)} images using {workers} workers...")
+    pull_images(missing, client, workers=workers)
+    dtslogger.info(f"Images pulled: {missing}")
 
 
 def disk_template_partitions(disk_template_dir):
@@ -268,24 +390,24 @@ def disk_template_objects(disk_template_dir, partition, filter_type):
 
 
 def find_placeholders_on_disk(disk_image):
-    matches = run_cmd(
-        ["strings", "-t", "d", disk_image, "|", "grep", f'"{FILE_PLACEHOLDER_SIGNATURE}"'],
-        get_output=True,
-        shell=True,
-    ).splitlines()
-    # parse matches
-    matches = map(lambda m: m.split(" ")[::-1], matches)
-    matches = list(map(lambda m: (m[0], int(m[1])), matches))
-    # fix offset for strings attached to content from contiguous page
-    placeholders = {}
-    for string, offset in matches:
-        idx = string.index(FILE_PLACEHOLDER_SIGNATURE)
-        string = string[idx:]
-        placeholders[string] = offset + idx
-        dtslogger.debug(
-            f"Found placeholder {string} at position {placeholders[string]} "
-            f"(match was at {offset} w/ correction of {idx} bytes)."
-        )
+    signature = FILE_PLACEHOLDER_SIGNATURE.encode("ascii")
+    # a placeholder extends until the first non-printable character (same as `strings`)
+    printable = re.compile(rb"[\x20-\x7e\t]*")
+    matches = []
+    with open(disk_image, "rb") as fin:
+        size = os.fstat(fin.fileno()).st_size
+        with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as disk:
+            if hasattr(disk, "madvise"):
+                disk.madvise(mmap.MADV_SEQUENTIAL)
+            # skip the holes of the (sparse) disk image, they can only contain zeros
+            for start, end in data_extents(fin.fileno(), size):
+                offset = disk.find(signature, start, min(size, end + len(signature)))
+                while offset >= 0:
+                    string = printable.match(disk, offset).group().decode("ascii")
+                    matches.append((string, offset))
+                    dtslogger.debug(f"Found placeholder {string} at position {offset}.")
+                    offset = disk.find(signature, offset + len(signature), min(size, end + len(signature)))
+    placeholders = dict(matches)
     # make sure matches are unique
     if len(placeholders) != len(matches):
         pholders = map(lambda m: m[0], matches)
@@ -432,6 +554,15 @@ def copy_file(origin, destination):
     run_cmd(["cp", origin, destination])
 
 
+def clone_file(origin, destination):
+    # create destination directory
+    os.makedirs(os.path.dirname(os.path.abspath(destination)), exist_ok=True)
+    # share the blocks with the origin where supported (btrfs, xfs), keep holes otherwise
+    dtslogger.info(f"Cloning [{origin}] -> [{destination}]")
+    run_cmd(["cp", "--reflink=auto", "--sparse=always", origin, f"{destination}.part"])
+    os.replace(f"{destination}.part", destination)
+
+
 def transfer_file(disk_template_dir, partition, location):
     _local_filepath = os.path.join(disk_template_dir, partition, *location)
     _remote_filepath = os.path.join(PARTITION_MOUNTPOINT(partition), *location)
@@ -1,7 +1,5 @@
 import argparse
 
-import docker
-
 from dt_shell import DTCommandAbs, DTShell, dtslogger
 from dt_shell.env_checks import check_docker_environment
 from utils.avahi_utils import wait_for_service
@@ -10,6 +8,7 @@ from utils.docker_utils import (
     bind_avahi_socket,
     bind_duckiebot_data_dir,
     default_env,
+    get_client,
     get_endpoint_architecture,
     pull_if_not_exist,
     remove_if_running,
@@ -163,7 +162,7 @@ class DTCommand(DTCommandAbs):
         if parsed.local:
             duckiebot_client = check_docker_environment()
         else:
-            duckiebot_client = docker.DockerClient("tcp://" + duckiebot_ip + ":2375")
+            duckiebot_client = get_client(duckiebot_ip)
 
         container_name = "demo_%s" % parsed.demo_name
         remove_if_running(duckiebot_client, container_name)
@@ -4,11 +4,10 @@ import platform
 import socket
 import subprocess
 
-import docker
 from dt_shell import DTCommandAbs, DTShell, dtslogger
 from dt_shell.env_checks import check_docker_environment
 from utils.cli_utils import start_command_in_subprocess
-from utils.docker_utils import remove_if_running, pull_if_not_exist
+from utils.docker_utils import get_client, remove_if_running, pull_if_not_exist
 from utils.networking_utils import get_duckiebot_ip
 
 
@@ -136,7 +135,7 @@ def run_cli_controller(hostname, image, duckiebot_ip, network_mode, sim):
     if sim:
         duckiebot_client = check_docker_environment()
     else:
-        duckiebot_client = docker.DockerClient("tcp://" + duckiebot_ip + ":2375")
+        duckiebot_client = get_client(duckiebot_ip)
     container_name = "joystick_cli_%s" % hostname
     remove_if_running(duckiebot_client, container_name)
     env = set_default_env(hostname, duckiebot_ip)
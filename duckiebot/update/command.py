@@ -1,6 +1,7 @@
 import argparse
 
 from docker.errors import NotFound
+from docker.utils import parse_repository_tag
 
 from dt_shell import DTCommandAbs, DTShell, dtslogger
 from utils.docker_utils import (
@@ -12,6 +13,7 @@ from utils.docker_utils import (
 )
 from utils.duckietown_utils import get_distro_version
 from utils.misc_utils import sanitize_hostname
+from utils.registry_utils import get_registry_client
 from utils.robot_utils import log_event_on_robot
 
 DEFAULT_STACK = "duckietown"
@@ -66,8 +68,20 @@ class DTCommand(DTCommandAbs):
         )
         if not success:
             return
+        # find out which non-active images are outdated, all at once
+        refs = {image: _remote_ref(image, arch) for image in images}
+        remote = get_registry_client().inspect_many(list(refs.values()))
         # update non-active images
         for image in images:
+            remote_image = remote[refs[image]]
+            if remote_image is not None:
+                try:
+                    # the ID of an image is the digest of its config
+                    if client.images.get(image).id == remote_image.config_digest:
+                        dtslogger.info(f"Image `{image}` is up to date.")
+                        continue
+                except NotFound:
+                    pass
             dtslogger.info(f"Pulling image `{image}`...")
             try:
                 pull_image(image, client)
@@ -77,3 +91,9 @@ class DTCommand(DTCommandAbs):
         # clean duckiebot (again)
         if not parsed.no_clean:
             shell.include.duckiebot.clean.command(shell, [parsed.robot, "--all", "--yes", "--untagged"])
+
+
+def _remote_ref(image: str, arch: str) -> tuple:
+    # untagged images are `latest`, registries can have a port (e.g., `host:5000/image`)
+    repository, tag = parse_repository_tag(image)
+    return repository, tag or "latest", arch
@@ -29,7 +29,7 @@ from utils.docker_utils import (
     get_registry_to_use,
     get_remote_client,
     pull_if_not_exist,
-    pull_image,
+    pull_images,
     remove_if_running,
 )
 from utils.exceptions import InvalidUserInput
@@ -386,12 +386,10 @@ class DTCommand(DTCommandAbs):
 
         # ALL the pulling is done here. Don't start anything until we now
         if parsed.pull:
-            for image in local_images:
-                dtslogger.info(f"Pulling {image}")
-                pull_image(image, local_client)
-            for image in agent_images:
-                dtslogger.info(f"Pulling {image}")
-                pull_image(image, agent_client)
+            pull_images(
+                [(image, local_client) for image in local_images]
+                + [(image, agent_client) for image in agent_images]
+            )
         else:
             for image in local_images:
                 pull_if_not_exist(local_client, image)
@@ -1,16 +1,17 @@
 import argparse
-import json
+import asyncio
+import importlib.util
 import logging
 import os
-import time
 from collections import defaultdict
-from typing import List, Set
+from typing import Optional
 
 from dt_shell import DTCommandAbs, dtslogger
 from utils.duckietown_utils import get_robot_types
 from utils.table_utils import fill_cell, format_matrix
 
-REFRESH_HZ = 1.0
+# at most 4 redraws per second
+MIN_REDRAW_INTERVAL_SECS = 0.25
 
 usage = """
 
@@ -25,115 +26,89 @@ usage = """
 """
 
 
-class DiscoverListener:
-    services = defaultdict(dict)
-    supported_services = [
-        "DT::ONLINE",
-        "DT::PRESENCE",
-        "DT::BOOTING",
-        "DT::ROBOT_TYPE",
-        "DT::ROBOT_CONFIGURATION",
-        "DT::DASHBOARD",
+SUPPORTED_SERVICES = [
+    "DT::ONLINE",
+    "DT::PRESENCE",
+    "DT::BOOTING",
+    "DT::ROBOT_TYPE",
+    "DT::ROBOT_CONFIGURATION",
+    "DT::DASHBOARD",
+]
+
+
+def render_fleet(fleet, filter_type: Optional[str] = None) -> str:
+    # create hostname -> robot_type map
+    hostname_to_type = defaultdict(lambda: "ND")
+    for device_hostname in fleet.hostnames(["DT::ROBOT_TYPE"]):
+        txt = fleet.txt("DT::ROBOT_TYPE", device_hostname)
+        if "type" in txt:
+            hostname_to_type[device_hostname] = txt["type"]
+    # create hostname -> robot_configuration map
+    hostname_to_config = defaultdict(lambda: "ND")
+    for device_hostname in fleet.hostnames(["DT::ROBOT_CONFIGURATION"]):
+        txt = fleet.txt("DT::ROBOT_CONFIGURATION", device_hostname)
+        if "configuration" in txt:
+            hostname_to_config[device_hostname] = txt["configuration"]
+    # prepare table
+    columns = [
+        "Status",  # Booting [yellow], Ready [green]
+        # TODO: Internet check is kind of unstable at this time, disabling it
+        # "Internet",  # No [grey], Yes [green]
+        "Dashboard",  # Down [grey], Up [green]
+        # TODO: Busy is not used at this time, disabling it
+        # "Busy",  # No [grey], Yes [green]
     ]
+    columns = list(map(lambda c: " %s " % c, columns))
+    header = ["Type", "Model"] + columns + ["Hostname"]
+    data = []
+
+    for device_hostname in fleet.hostnames(SUPPORTED_SERVICES):
+        # filter by robot type
+        robot_type = hostname_to_type[device_hostname]
+        robot_configuration = hostname_to_config[device_hostname]
+        if filter_type and robot_type != filter_type:
+            continue
+        # prepare status list
+        statuses = []
+        for column in columns:
+            text, color, bg_color = column_to_text_and_color(column, device_hostname, fleet)
+            column_txt = fill_cell(text, len(column), color, bg_color)
+            statuses.append(column_txt)
+        # prepare row
+        row = (
+            [device_hostname, robot_type, robot_configuration] + statuses + [str(device_hostname) + ".local"]
+        )
+        data.append(row)
 
-    def __init__(self, args):
-        self.args = args
-
-    def process_service_name(self, name):
-        name = name.replace("._duckietown._tcp.local.", "")
-        service_parts = name.split("::")
-        if len(service_parts) != 3 or service_parts[0] != "DT":
-            return None, None
-        name = "{}::{}".format(service_parts[0], service_parts[1])
-        server = service_parts[2]
-        return name, server
-
-    def remove_service(self, zeroconf, type, name):
-        dtslogger.debug("SERVICE_REM: %s (%s)" % (str(name), str(type)))
-        name, server = self.process_service_name(name)
-        if not name:
-            return
-        del self.services[name][server]
+    # render table
+    return (
+        "NOTE: Only devices flashed using duckietown-shell-commands v4.1.0+ are supported.\n\n"
+        + format_matrix(header, data, "{:^{}}", "{:<{}}", "{:>{}}", "\n", " | ")
+    )
 
-    def add_service(self, zeroconf, type, sname):
-        dtslogger.debug("SERVICE_ADD: %s (%s)" % (str(sname), str(type)))
-        name, server = self.process_service_name(sname)
-        if not name:
-            return
-        dtslogger.debug("SERVICE_ADD: %s (%s)" % (str(name), str(server)))
-        info = zeroconf.get_service_info(type, sname)
-        if info is None:
-            return
-        dtslogger.debug("SERVICE_ADD: %s" % (str(info)))
-        txt = json.loads(list(info.properties.keys())[0].decode("utf-8")) if len(info.properties) else dict()
-        self.services[name][server] = {"port": info.port, "txt": txt}
-
-    def update_service(self, *args, **kwargs):
-        pass
-
-    def print(self):
-        # clear terminal
-        os.system("cls" if os.name == "nt" else "clear")
-        # get all discovered hostnames
-        hostnames: Set[str] = set()
-
-        for service in self.supported_services:
-            hostnames_for_service: List[str] = list(self.services[service])
-            hostnames.update(hostnames_for_service)
-        # create hostname -> robot_type map
-        hostname_to_type = defaultdict(lambda: "ND")
-        for device_hostname in self.services["DT::ROBOT_TYPE"]:
-            dev = self.services["DT::ROBOT_TYPE"][device_hostname]
-            if len(dev["txt"]) and "type" in dev["txt"]:
-                try:
-                    hostname_to_type[device_hostname] = dev["txt"]["type"]
-                except:  # XXX: complain a bit
-                    pass
-        # create hostname -> robot_configuration map
-        hostname_to_config = defaultdict(lambda: "ND")
-        for device_hostname in self.services["DT::ROBOT_CONFIGURATION"]:
-            dev = self.services["DT::ROBOT_CONFIGURATION"][device_hostname]
-            if len(dev["txt"]) and "configuration" in dev["txt"]:
-                try:
-                    hostname_to_config[device_hostname] = dev["txt"]["configuration"]
-                except:
-                    pass
-        # prepare table
-        columns = [
-            "Status",  # Booting [yellow], Ready [green]
-            # TODO: Internet check is kind of unstable at this time, disabling it
-            # "Internet",  # No [grey], Yes [green]
-            "Dashboard",  # Down [grey], Up [green]
-            # TODO: Busy is not used at this time, disabling it
-            # "Busy",  # No [grey], Yes [green]
-        ]
-        columns = list(map(lambda c: " %s " % c, columns))
-        header = ["Type", "Model"] + columns + ["Hostname"]
-        data = []
-
-        for device_hostname in list(sorted(hostnames)):
-            # filter by robot type
-            robot_type = hostname_to_type[device_hostname]
-            robot_configuration = hostname_to_config[device_hostname]
-            if self.args.filter_type and robot_type != self.args.filter_type:
-                continue
-            # prepare status list
-            statuses = []
-            for column in columns:
-                text, color, bg_color = column_to_text_and_color(column, device_hostname, self.services)
-                column_txt = fill_cell(text, len(column), color, bg_color)
-                statuses.append(column_txt)
-            # prepare row
-            row = (
-                [device_hostname, robot_type, robot_configuration]
-                + statuses
-                + [str(device_hostname) + ".local"]
-            )
-            data.append(row)
-
-        # print table
-        print("NOTE: Only devices flashed using duckietown-shell-commands v4.1.0+ are supported.\n")
-        print(format_matrix(header, data, "{:^{}}", "{:<{}}", "{:>{}}", "\n", " | "))
+
+async def discover(filter_type: Optional[str] = None):
+    from utils.avahi_utils import DiscoveryEngine
+
+    changed = asyncio.Event()
+    last_table = None
+    async with DiscoveryEngine(on_change=lambda *_: changed.set()) as engine:
+        while True:
+            # redraw only when something changed
+            if dtslogger.level > logging.DEBUG:
+                table = render_fleet(engine.fleet, filter_type)
+                if table != last_table:
+                    # clear terminal
+                    if os.name == "nt":
+                        os.system("cls")
+                    else:
+                        print("\033[H\033[J", end="")
+                    print(table)
+                    last_table = table
+            await changed.wait()
+            changed.clear()
+            # changes come in bursts when many devices show up at once
+            await asyncio.sleep(MIN_REDRAW_INTERVAL_SECS)
 
 
 class DTCommand(DTCommandAbs):
@@ -141,11 +116,13 @@ class DTCommand(DTCommandAbs):
     def command(shell, args):
         prog = "dts fleet discover"
 
-        # try to import zeroconf
+        # make sure zeroconf (with asyncio support) is available
         try:
-            from zeroconf import ServiceBrowser, Zeroconf
+            has_zeroconf = importlib.util.find_spec("zeroconf.asyncio") is not None
         except ImportError:
-            dtslogger.error("{} requires zeroconf. Use pip to install it.")
+            has_zeroconf = False
+        if not has_zeroconf:
+            dtslogger.error(f"{prog} requires zeroconf. Use pip to install it.")
             return
 
         # parse arguments
@@ -162,41 +139,35 @@ class DTCommand(DTCommandAbs):
         parsed = parser.parse_args(args)
 
         # perform discover
-        zeroconf = Zeroconf()
-        listener = DiscoverListener(args=parsed)
-        # FIXME: @afdaniele - wrong type - listener supposed to be ServiceListener
-        #        should DiscoverListener be a subclass of ServiceListener
-        ServiceBrowser(zeroconf, "_duckietown._tcp.local.", listener)
-
-        while True:
-            if dtslogger.level > logging.DEBUG:
-                listener.print()
-            time.sleep(1.0 / REFRESH_HZ)
+        try:
+            asyncio.run(discover(parsed.filter_type))
+        except KeyboardInterrupt:
+            pass
 
 
-def column_to_text_and_color(column, hostname, services):
+def column_to_text_and_color(column, hostname, fleet):
     column = column.strip()
     text, color, bg_color = "ND", "white", "grey"
     #  -> Status
     if column == "Status":
-        if hostname in services["DT::PRESENCE"]:
+        if fleet.has("DT::PRESENCE", hostname):
             text, color, bg_color = "Ready", "white", "green"
-        if hostname in services["DT::BOOTING"]:
+        if fleet.has("DT::BOOTING", hostname):
             text, color, bg_color = "Booting", "white", "yellow"
     #  -> Dashboard
     if column == "Dashboard":
         text, color, bg_color = "Down", "white", "grey"
-        if hostname in services["DT::DASHBOARD"]:
+        if fleet.has("DT::DASHBOARD", hostname):
             text, color, bg_color = "Up", "white", "green"
     #  -> Internet
     if column == "Internet":
         text, color, bg_color = "No", "white", "grey"
-        if hostname in services["DT::ONLINE"]:
+        if fleet.has("DT::ONLINE", hostname):
             text, color, bg_color = "Yes", "white", "green"
     #  -> Busy
     if column == "Busy":
         text, color, bg_color = "No", "white", "grey"
-        if hostname in services["DT::BUSY"]:
+        if fleet.has("DT::BUSY", hostname):
             text, color, bg_color = "Yes", "white", "green"
     # ----------
     return text, color, bg_color
@@ -1,6 +1,8 @@
 import argparse
+import base64
 import copy
 import getpass
+import glob
 import json
 import os
 import pathlib
@@ -8,7 +10,7 @@ import re
 import shutil
 import socket
 import subprocess
-import sys
+import tempfile
 import time
 from collections import namedtuple
 from datetime import datetime
@@ -17,6 +19,7 @@ from typing import List
 
 from math import floor, log2
 
+from dt_data_api.constants import PUBLIC_STORAGE_URL
 from dt_shell import __version__ as shell_version, DTCommandAbs, DTShell, dtslogger
 from utils.cli_utils import ask_confirmation, check_program_dependency
 from utils.duckietown_utils import (
@@ -26,8 +29,7 @@ from utils.duckietown_utils import (
     WIRED_ROBOT_TYPES,
 )
 from utils.exceptions import InvalidUserInput
-from utils.misc_utils import human_time, sudo_open
-from utils.progress_bar import ProgressBar
+from utils.sparse_image_utils import SPARSE_IMAGE_EXTENSION
 from .constants import (
     LIST_DEVICES_CMD,
     TIPS_AND_TRICKS,
@@ -41,7 +43,7 @@ INIT_SD_CARD_VERSION = "2.1.0"  # incremental number, semantic version
 Wifi = namedtuple("Wifi", "name ssid psk username password")
 
 TMP_WORKDIR = "/tmp/duckietown/dts/init_sd_card"
-BLOCK_SIZE = 1024 ** 2
+BLOCK_SIZE = 4 * 1024 ** 2
 SAFE_SD_SIZE_MIN = 16
 SAFE_SD_SIZE_MAX = 64
 DEFAULT_ROBOT_TYPE = "duckiebot"
@@ -50,6 +52,8 @@ COMMAND_DIR = os.path.dirname(os.path.abspath(__file__))
 SUPPORTED_STEPS = ["license", "download", "flash", "verify", "setup"]
 NVIDIA_LICENSE_FILE = os.path.join(COMMAND_DIR, "nvidia-license.txt")
 ROOT_PARTITIONS = ["root", "APP"]
+SPARSE_HOLES_POLICIES = ["skip", "discard", "zeroout"]
+DEFAULT_SPARSE_HOLES = "zeroout"
 
 
 def DISK_IMAGE_VERSION(robot_configuration, experimental=False):
@@ -94,9 +98,9 @@ def BASE_DISK_IMAGE(robot_configuration, experimental=False):
     return board_to_disk_image[board]
 
 
-def DISK_IMAGE_CLOUD_LOCATION(robot_configuration, experimental=False):
+def DISK_IMAGE_CLOUD_LOCATION(robot_configuration, experimental=False, extension="zip"):
     disk_image = BASE_DISK_IMAGE(robot_configuration, experimental)
-    return f"disk_image/{disk_image}.zip"
+    return f"disk_image/{disk_image}.{extension}"
 
 
 class DTCommand(DTCommandAbs):
@@ -106,8 +110,18 @@ class DTCommand(DTCommandAbs):
         # configure parser
         parser.add_argument("--steps", default=",".join(SUPPORTED_STEPS), help="Steps to perform")
         parser.add_argument("--no-steps", default="", help="Steps NOT to perform")
-        parser.add_argument("--hostname", required=True, help="Hostname of the device to flash")
-        parser.add_argument("--device", default=None, help="The SD card device to flash")
+        parser.add_argument(
+            "--hostname",
+            required=True,
+            help="Hostname of the device to flash. Use a comma-separated list (or a single prefix) "
+            "when flashing multiple SD cards at once",
+        )
+        parser.add_argument(
+            "--device",
+            default=None,
+            help="The SD card device to flash. Use a comma-separated list or a glob pattern "
+            "(e.g., /dev/sd[b-e]) to flash multiple SD cards at once",
+        )
         parser.add_argument("--country", default="US", help="2-letter country code (US, CA, CH, etc.)")
         parser.add_argument(
             "--wifi",
@@ -165,14 +179,54 @@ class DTCommand(DTCommandAbs):
             type=int,
             help="(Optional) Size of the SD card you are flashing",
         )
+        parser.add_argument(
+            "--direct-io",
+            default=False,
+            action="store_true",
+            help="(Optional) Bypass the OS page cache (O_DIRECT) while flashing",
+        )
+        parser.add_argument(
+            "--sparse",
+            default=False,
+            action="store_true",
+            help="(Optional) Write only the allocated, non-zero blocks of the disk image",
+        )
+        parser.add_argument(
+            "--holes",
+            default=DEFAULT_SPARSE_HOLES,
+            choices=SPARSE_HOLES_POLICIES,
+            help="(Optional) How to clear the unwritten blocks of the SD card when using --sparse. "
+            "Only 'zeroout' guarantees that the SD card is an exact copy of the disk image",
+        )
+        parser.add_argument(
+            "--stream",
+            default=False,
+            action="store_true",
+            help="(Optional) Stream the disk image from the cloud straight to the SD card "
+            "instead of downloading and extracting it first",
+        )
+        parser.add_argument(
+            "--stream-cache",
+            default=False,
+            action="store_true",
+            help="(Optional) Keep a local copy of the disk image while streaming it",
+        )
+        parser.add_argument(
+            "--sparse-image",
+            default=False,
+            action="store_true",
+            help="(Optional) Use the sparse disk image instead of the ZIP archive, only the "
+            "allocated blocks of the disk image are downloaded and flashed",
+        )
         parser.add_argument(
             "--workdir", default=TMP_WORKDIR, type=str, help="(Optional) temporary working directory to use"
         )
         # parse arguments
         parsed = parser.parse_args(args=args)
-        # validate hostname
-        if not _validate_hostname(parsed.hostname):
-            return
+        # validate hostnames
+        for hostname in parsed.hostname.split(","):
+            if not _validate_hostname(hostname):
+                return
         # default WiFi
         if parsed.wifi is None:
             if parsed.robot_type in WIRED_ROBOT_TYPES:
@@ -246,6 +300,10 @@ class DTCommand(DTCommandAbs):
             if step_name not in step2function:
                 msg = "Cannot find step %r in %s" % (step_name, list(step2function))
                 raise InvalidUserInput(msg)
+        # streaming happens while flashing
+        if parsed.stream and "flash" not in steps:
+            dtslogger.warning("The flag --stream has no effect without the 'flash' step.")
+            parsed.stream = False
         # compile hardware specific disk image name and url
         base_disk_image = BASE_DISK_IMAGE(parsed.robot_configuration, parsed.experimental)
         # compile files destinations
@@ -255,7 +313,9 @@ class DTCommand(DTCommandAbs):
             "robot_configuration": parsed.robot_configuration,
             "disk_zip": in_file("zip"),
             "disk_img": in_file("img"),
+            "disk_simg": in_file(SPARSE_IMAGE_EXTENSION),
             "disk_metadata": in_file("json"),
+            "disk_manifest": in_file("manifest"),
         }
         # notify about licenses
         if "license" not in steps:
@@ -338,7 +398,8 @@ def step_license(_, parsed, __):
 
 def step_download(shell, parsed, data):
     # check if dependencies are met
-    check_program_dependency("unzip")
+    if not parsed.stream:
+        check_program_dependency("unzip")
 
     # clear cache (if requested)
     if parsed.no_cache:
@@ -353,6 +414,19 @@ def step_download(shell, parsed, data):
                 shutil.rmtree(parsed.workdir)
     # create temporary dir
     _run_cmd(["mkdir", "-p", parsed.workdir])
+    # the sparse image is flashed as is, there is nothing to extract
+    if parsed.sparse_image:
+        return _download_sparse_image(shell, parsed, data)
+    # stream the zip while flashing (if nothing is cached)
+    if parsed.stream:
+        if os.path.isfile(data["disk_img"]):
+            dtslogger.info(f"Reusing cached DISK image file [{data['disk_img']}].")
+            return {}
+        if not os.path.isfile(data["disk_zip"]):
+            disk_image = DISK_IMAGE_CLOUD_LOCATION(parsed.robot_configuration, parsed.experimental)
+            dtslogger.info("The ZIP image will be streamed while flashing.")
+            return {"disk_url": PUBLIC_STORAGE_URL.format(bucket="public", object=disk_image)}
+        check_program_dependency("unzip")
     # download zip (if necessary)
     dtslogger.info("Looking for ZIP image file...")
     if not os.path.isfile(data["disk_zip"]):
@@ -375,6 +449,26 @@ def step_download(shell, parsed, data):
     return {}
 
 
+def _download_sparse_image(shell, parsed, data):
+    if os.path.isfile(data["disk_img"]):
+        dtslogger.info(f"Reusing cached DISK image file [{data['disk_img']}].")
+        return {}
+    disk_image = DISK_IMAGE_CLOUD_LOCATION(
+        parsed.robot_configuration, parsed.experimental, SPARSE_IMAGE_EXTENSION
+    )
+    if not os.path.isfile(data["disk_simg"]):
+        if parsed.stream:
+            dtslogger.info("The sparse image will be streamed while flashing.")
+            return {"disk_url": PUBLIC_STORAGE_URL.format(bucket="public", object=disk_image)}
+        dtslogger.info("Downloading sparse image...")
+        shell.include.data.get.command(
+            shell, [], parsed=SimpleNamespace(object=[disk_image], file=[data["disk_simg"]], space="public")
+        )
+    else:
+        dtslogger.info(f"Reusing cached sparse image file [{data['disk_simg']}].")
+    return {"disk_source": data["disk_simg"]}
+
+
 def step_flash(_, parsed, data):
     # check if dependencies are met
     check_program_dependency("sudo")
@@ -440,112 +534,115 @@ def step_flash(_, parsed, data):
                 device = txt
         parsed.device = device
 
-    # check if the device exists
-    if parsed.device.startswith("/dev/"):
-        sd_type = "SD"
-        if not os.path.exists(parsed.device):
-            msg = "Device %s was not found on your system. Please, check." % parsed.device
-            raise InvalidUserInput(msg)
-    else:
-        sd_type = "File"
-        if os.path.exists(parsed.device):
-            msg = f"File {parsed.device} already exists, it will be overwritten."
-            granted = ask_confirmation(msg)
-            if not granted:
-                dtslogger.info("Please retry while specifying a valid device. Bye bye!")
-                exit(4)
+    # get the list of devices to flash and their hostnames
+    targets = _get_targets(parsed)
+    devices = [t.device for t in targets]
+    sd_type = _get_sd_type(devices)
+
+    # check if the devices exist
+    for device in devices:
+        if sd_type == "SD":
+            if not os.path.exists(device):
+                msg = "Device %s was not found on your system. Please, check." % device
+                raise InvalidUserInput(msg)
+        else:
+            if os.path.exists(device):
+                msg = f"File {device} already exists, it will be overwritten."
+                granted = ask_confirmation(msg)
+                if not granted:
+                    dtslogger.info("Please retry while specifying a valid device. Bye bye!")
+                    exit(4)
 
     # unmount all partitions if SD card
     if sd_type == "SD":
-        # noinspection PyBroadException
-        try:
-            dtslogger.info(f"Trying to unmount all partitions from device {parsed.device}")
-            cmd = f"for n in {parsed.device}* ; do umount $n || . ; done"
-            _run_cmd(cmd, shell=True, quiet=True)
-            dtslogger.info("All partitions unmounted.")
-        except BaseException:
-            dtslogger.warn(
-                "An error occurred while unmounting the partitions of your SD card. "
-                "Though this is not critical, you might experience issues with your SD "
-                "card after flashing is complete. If that is the case, make sure to "
-                "unmount all disks from your SD card before flashing the next time."
-            )
+        for device in devices:
+            # noinspection PyBroadException
+            try:
+                dtslogger.info(f"Trying to unmount all partitions from device {device}")
+                cmd = f"for n in {device}* ; do umount $n || . ; done"
+                _run_cmd(cmd, shell=True, quiet=True)
+                dtslogger.info("All partitions unmounted.")
+            except BaseException:
+                dtslogger.warn(
+                    "An error occurred while unmounting the partitions of your SD card. "
+                    "Though this is not critical, you might experience issues with your SD "
+                    "card after flashing is complete. If that is the case, make sure to "
+                    "unmount all disks from your SD card before flashing the next time."
+                )
 
-    # use dd to flash
-    dtslogger.info("Flashing File[{}] -> {}[{}]:".format(data["disk_img"], sd_type, parsed.device))
-    dd_py = os.path.join(pathlib.Path(__file__).parent.absolute(), "dd.py")
-    bsize = str(BLOCK_SIZE)
-    dd_cmd = (["sudo"] if sd_type == "SD" else []) + [
-        dd_py,
-        "--input",
-        data["disk_img"],
-        "--output",
-        parsed.device,
-        "--block-size",
-        bsize,
-    ]
-    _run_cmd(dd_cmd)
+    # use dd to flash (the disk image is read once and written to all the devices)
+    source = data.get("disk_url", None) or data.get("disk_source", None) or data["disk_img"]
+    for target in targets:
+        dtslogger.info(
+            "Flashing File[{}] -> {}[{}] ({}):".format(source, sd_type, target.device, target.hostname)
+        )
+    dd_cmd = _dd_cmd(parsed, data, sd_type, devices, source=source)
+    if source != data["disk_img"]:
+        # decompress while reading, the disk metadata is extracted to the workdir
+        dd_cmd += ["--extract-dir", parsed.workdir]
+    if data.get("disk_url", None):
+        if parsed.stream_cache:
+            dd_cmd += ["--cache", data["disk_img"]]
+    if parsed.sparse:
+        dd_cmd += ["--holes", parsed.holes]
+    if parsed.direct_io:
+        dd_cmd += ["--direct"]
+    failed = _run_dd(dd_cmd, devices)
+    if failed:
+        dtslogger.error("Flashing failed on {}[{}], see the errors above.".format(sd_type, ", ".join(failed)))
+        # the devices that were flashed correctly move on to the next steps
+        targets = [t for t in targets if t.device not in failed]
+        devices = [t.device for t in targets]
+        if not targets:
+            exit(5)
     # ---
-    dtslogger.info("{}[{}] flashed!".format(sd_type, parsed.device))
-    return {"sd_type": sd_type}
+    dtslogger.info("{}[{}] flashed!".format(sd_type, ", ".join(devices)))
+    return {"sd_type": sd_type, "targets": targets, "disk_source": source}
 
 
 def step_verify(_, parsed, data):
-    dtslogger.info("Verifying {}[{}]...".format(data.get("sd_type", ""), parsed.device))
-    buf_size = 16 * 1024
-    # create a progress bar to track the progress
-    pbar = ProgressBar(header="Verifying [ETA: ND]")
-    tbytes = os.stat(data["disk_img"]).st_size
-    nbytes = 0
-    stime = time.time()
-    # compare bytes
-    try:
-        with open(data["disk_img"], "rb") as origin:
-            with sudo_open(parsed.device, "rb") as destination:
-                buffer1 = origin.read(buf_size)
-                while buffer1:
-                    buf1_len = len(buffer1)
-                    buffer2 = destination.read(buf1_len)
-                    buf2_len = len(buffer2)
-                    # check lengths, then content
-                    if buf1_len != buf2_len or buffer1 != buffer2:
-                        raise IOError("Mismatch in range position [{}-{}]".format(nbytes, nbytes + buf1_len))
-                    # update progress bar
-                    nbytes += buf1_len
-                    progress = int(100 * (nbytes / tbytes))
-                    pbar.update(progress)
-                    # compute ETA
-                    if progress > 0:
-                        elapsed = time.time() - stime
-                        eta = (100 - progress) * (elapsed / progress)
-                        pbar.set_header("Verifying [ETA: {}]".format(human_time(eta, True)))
-                    # read another chunk
-                    buffer1 = origin.read(buf_size)
-    except IOError as e:
-        sys.stdout.write("\n")
-        sys.stdout.flush()
-        dtslogger.error(
-            "The verification step failed. Please, try re-flashing.\n" "The error reads:\n\n{}".format(str(e))
-        )
-        exit(5)
-    dtslogger.info("Verified in {}".format(human_time(time.time() - stime)))
+    targets = data.get("targets", None) or _get_targets(parsed)
+    devices = [t.device for t in targets]
+    sd_type = data.get("sd_type", None) or _get_sd_type(devices)
+    dtslogger.info("Verifying {}[{}]...".format(sd_type, ", ".join(devices)))
+    # the flash step stores the digests of the written blocks next to the disk image,
+    # only those blocks are read back from the devices and compared
+    dd_cmd = _dd_cmd(parsed, data, sd_type, devices, source=data.get("disk_source", None)) + ["--verify"]
+    failed = _run_dd(dd_cmd, devices)
+    if failed:
+        msg = "The verification step failed on {}[{}]. Please, try re-flashing."
+        dtslogger.error(msg.format(sd_type, ", ".join(failed)))
+        # only the devices that passed the verification are set up
+        targets = [t for t in targets if t.device not in failed]
+        devices = [t.device for t in targets]
+        if not targets:
+            exit(5)
     # ---
-    dtslogger.info("{}[{}] successfully flashed!".format(data.get("sd_type", ""), parsed.device))
-    return {}
+    dtslogger.info("{}[{}] successfully flashed!".format(sd_type, ", ".join(devices)))
+    return {"targets": targets}
 
 
 def step_setup(shell, parsed, data):
     # check if dependencies are met
-    check_program_dependency("dd")
     check_program_dependency("sudo")
-    check_program_dependency("sync")
+    # each device gets its own hostname
+    targets = data.get("targets", None) or _get_targets(parsed)
+    for target in targets:
+        if len(targets) > 1:
+            dtslogger.info(f"Setting up [{target.device}] as '{target.hostname}'...")
+        _setup_device(shell, parsed, data, target.device, target.hostname)
+    return {}
+
+
+def _setup_device(shell, parsed, data, device, hostname):
     # make a copy of the command parameters and remove wifi passwords
     params = copy.deepcopy(parsed.__dict__)
+    params.update({"device": device, "hostname": hostname})
     wfstr = lambda w: w if ":" not in w else (w.split(":")[0] + ":***")
     params["wifi"] = ",".join(list(map(wfstr, params["wifi"].split(","))))
     # compile data used to format placeholders
     surgery_data = {
-        "hostname": parsed.hostname,
+        "hostname": hostname,
         "robot_type": parsed.robot_type,
         "token": shell.get_dt1_token(),
         "robot_configuration": parsed.robot_configuration,
@@ -586,10 +683,10 @@ def step_setup(shell, parsed, data):
     # get disk image placeholders
     placeholders_version = PLACEHOLDERS_VERSION(parsed.robot_configuration, parsed.experimental)
     placeholders_dir = os.path.join(COMMAND_DIR, "placeholders", f"v{placeholders_version}")
-    # perform surgery
-    dtslogger.info("Performing surgery on the SD card...")
+    # compile surgery
+    blocks = []
     for surgery_bit in surgery_plan:
-        dtslogger.info("Performing surgery on [{partition}]:{path}.".format(**surgery_bit))
+        dtslogger.info("Preparing surgery on [{partition}]:{path}.".format(**surgery_bit))
         # get placeholder info
         surgery_bit["placeholder"] = surgery_bit["placeholder"]
         placeholder_file = os.path.join(placeholders_dir, surgery_bit["placeholder"])
@@ -622,34 +719,18 @@ def step_setup(shell, parsed, data):
             "Injecting {}/{} bytes ({}%) ".format(used_bytes, block_size, block_usage)
             + "into [{partition}]:{path}.".format(**surgery_bit)
         )
-        # apply change
-        dd_cmd = (["sudo"] if data.get("sd_type", "SD") == "SD" else []) + [
-            "dd",
-            "of={}".format(parsed.device),
-            "bs=1",
-            "count={}".format(block_size),
-            "seek={}".format(block_offset),
-            "conv=notrunc",
-        ]
-        # write twice (found to increase success rate)
-        for wpass in range(2):
-            # launch dd
-            dd = subprocess.Popen(dd_cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
-            dtslogger.debug(f"[{wpass + 1}/2] $ {dd_cmd}")
-            # write
-            dd.stdin.write(masked_content)
-            dd.stdin.flush()
-            dd.stdin.close()
-            dd.wait()
-            # flush I/O buffer
-            _run_cmd(["sync"])
+        blocks.append({"offset": block_offset, "content": base64.b64encode(masked_content).decode("ascii")})
+    # perform surgery, all the blocks are written, flushed and read back in a single pass
+    dtslogger.info("Performing surgery on the SD card...")
+    surgery_py = os.path.join(pathlib.Path(__file__).parent.absolute(), "surgery.py")
+    surgery_cmd = (["sudo"] if data.get("sd_type", "SD") == "SD" else []) + [surgery_py, "--output", device]
+    dtslogger.debug("$ %s" % surgery_cmd)
+    # the plan contains secrets (e.g., token), it is passed through stdin
+    surgery = subprocess.run(surgery_cmd, input=json.dumps({"blocks": blocks}).encode("utf-8"))
+    if surgery.returncode != 0:
+        dtslogger.error("The surgery failed. Please, try re-flashing.")
+        exit(7)
     dtslogger.info("Surgery went OK!")
-    # flush I/O buffer
-    dtslogger.info("Flushing I/O buffer...")
-    _run_cmd(["sync"])
-    dtslogger.info("Done!")
-    # ---
-    return {}
 
 
 def _validate_hostname(hostname):
@@ -712,6 +793,78 @@ def _get_wpa_networks(parsed):
     return wpa_networks
 
 
+def _expand_devices(device: str) -> List[str]:
+    devices = []
+    for pattern in map(str.strip, device.split(",")):
+        if not re.search(r"[*?\[]", pattern):
+            devices.append(pattern)
+            continue
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise InvalidUserInput(f"No devices found matching the pattern '{pattern}'.")
+        devices.extend(matches)
+    return devices
+
+
+def _get_targets(parsed) -> List[SimpleNamespace]:
+    if parsed.device is None:
+        raise InvalidUserInput("No device specified. Use the argument --device.")
+    devices = _expand_devices(parsed.device)
+    hostnames = parsed.hostname.split(",")
+    if len(hostnames) == 1 and len(devices) > 1:
+        # a single hostname is used as prefix when flashing multiple devices
+        hostnames = [f"{hostnames[0]}{i + 1}" for i in range(len(devices))]
+    if len(hostnames) != len(devices):
+        raise InvalidUserInput(
+            f"You specified {len(hostnames)} hostnames for {len(devices)} devices. "
+            f"Provide either one hostname per device or a single hostname to use as prefix."
+        )
+    return [SimpleNamespace(device=d, hostname=h) for d, h in zip(devices, hostnames)]
+
+
+def _get_sd_type(devices: List[str]) -> str:
+    sd_types = set(map(lambda d: "SD" if d.startswith("/dev/") else "File", devices))
+    if len(sd_types) > 1:
+        raise InvalidUserInput("You cannot flash SD cards and files at the same time.")
+    return sd_types.pop()
+
+
+def _dd_cmd(parsed, data, sd_type, devices, source=None) -> List[str]:
+    dd_py = os.path.join(pathlib.Path(__file__).parent.absolute(), "dd.py")
+    dd_cmd = (["sudo"] if sd_type == "SD" else []) + [
+        dd_py,
+        "--input",
+        source or data["disk_img"],
+        "--output",
+        *devices,
+        "--block-size",
+        str(BLOCK_SIZE),
+        "--manifest",
+        data["disk_manifest"],
+    ]
+    if parsed.sparse:
+        dd_cmd += ["--sparse"]
+    return dd_cmd
+
+
+def _run_dd(dd_cmd, devices) -> List[str]:
+    """
+    Runs dd.py and returns the devices that failed, all of them if the whole run failed.
+    """
+    with tempfile.TemporaryDirectory(prefix="dts-init-sd-card-") as tmpdir:
+        report = os.path.join(tmpdir, "report.json")
+        try:
+            _run_cmd(dd_cmd + ["--report", report])
+        except subprocess.CalledProcessError:
+            # no report means that dd.py could not even start on the devices
+            if not os.path.isfile(report):
+                return list(devices)
+            with open(report, "rt") as fin:
+                failed = json.load(fin)
+            return [d for d in devices if d in failed] or list(devices)
+    return []
+
+
 def _run_cmd(cmd, get_output=False, shell=False, quiet=False):
     dtslogger.debug("$ %s" % cmd)
     env = copy.deepcopy(os.environ)
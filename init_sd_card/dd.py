@@ -2,10 +2,23 @@
 
 import os
 import sys
+import errno
+import struct
+import fcntl
+import json
+import zlib
+import mmap
 import time
+import queue
+import ctypes
+import ctypes.util
+import hashlib
 import logging
 import argparse
 import pathlib
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig()
 logger = logging.getLogger("dd")
@@ -15,64 +28,1134 @@ sys.path.append(utils_dir)
 
 import progress_bar
 import misc_utils
+import sparse_image_utils
 
+DEFAULT_BLOCK_SIZE = 4 * 1024 ** 2
+DEFAULT_NUM_BUFFERS = 8
+DEFAULT_SYNC_INTERVAL = 64 * 1024 ** 2
+DIRECT_IO_ALIGNMENT = 4096
+PROGRESS_REFRESH_SECS = 0.5
+DEFAULT_HASH_WORKERS = 4
+MANIFEST_VERSION = "1"
+MANIFEST_HASH_ALGORITHM = "blake2b"
+STREAM_READ_SIZE = 1024 ** 2
+STREAM_TIMEOUT_SECS = 30
+DISK_IMAGE_EXTENSION = ".img"
 
-# configure parser
-parser = argparse.ArgumentParser()
-parser.add_argument("-i", "--input", required=True, help="Input device or file")
-parser.add_argument("-o", "--output", required=True, help="Output device or file")
-parser.add_argument("-b", "--block-size", default=1024 ** 2, type=int, help="Block size")
-# parse arguments
-parsed = parser.parse_args()
-
-# make sure source and destination exist
-if not os.path.exists(parsed.input):
-    print(f"Fatal: input `{parsed.input}` not found.")
-if not os.path.exists(parsed.output):
-    print(f"Fatal: output `{parsed.output}` not found.")
-
-# open source and destination
-src_size = os.stat(parsed.input).st_size
-written = 0
-current_progress = 0
-stime = time.time()
-pbar = progress_bar.ProgressBar(header="Flashing [ETA: ND]")
-
-# open resources
-src = open(parsed.input, "rb")
-tgt = open(parsed.output, "wb")
-
-# transfer chunks from source to target
-try:
-    chunk = src.read(parsed.block_size)
-    while chunk:
-        tgt.write(chunk)
-        written += len(chunk)
-        new_progress = int(written / src_size * 100.0)
-        if new_progress != current_progress:
-            # flush buffers and sync before notifying the new progress
-            tgt.flush()
-            os.fsync(tgt.fileno())
-            # update progress and progress bar
-            current_progress = new_progress
-            pbar.update(current_progress)
-            # compute ETA
-            elapsed = time.time() - stime
-            eta = (100 - current_progress) * (elapsed / current_progress)
-            pbar.set_header("Flashing [ETA: {}]".format(misc_utils.human_time(eta, True)))
-        # read next chunk
-        chunk = src.read(parsed.block_size)
-    # flus`h I/O buffer
-    logger.info("Flushing I/O buffer...")
-    os.fsync(tgt.fileno())
-    logger.info("`Done!")
-except KeyboardInterrupt:
-    pass
-finally:
-    # close resources
-    src.close()
-    tgt.close()
-
-# jump to 100% if success
-pbar.update(100)
-logger.info("Flashed in {}".format(misc_utils.human_time(time.time() - stime)))
+# ZIP archive format, see APPNOTE.TXT
+ZIP_LOCAL_FILE_HEADER = struct.Struct("<4sHHHHHIIIHH")
+ZIP_LOCAL_FILE_SIGNATURE = b"PK\x03\x04"
+ZIP_DATA_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+ZIP_ZIP64_EXTRA_ID = 0x0001
+ZIP_FLAG_DATA_DESCRIPTOR = 0x08
+ZIP_METHOD_STORED = 0
+ZIP_METHOD_DEFLATED = 8
+
+# flags for sync_file_range(2), see linux/fs.h
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+# block device ioctls, see linux/fs.h
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127F
+BLK_SECTOR_SIZE = 512
+
+# what to do with the holes of a sparse image
+HOLES_SKIP = "skip"
+HOLES_DISCARD = "discard"
+HOLES_ZEROOUT = "zeroout"
+HOLES_POLICIES = [HOLES_SKIP, HOLES_DISCARD, HOLES_ZEROOUT]
+
+
+def _load_sync_file_range():
+    # sync_file_range is Linux-only and not exposed by the `os` module
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fcn = libc.sync_file_range
+    except (OSError, AttributeError, TypeError):
+        return None
+    fcn.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint]
+    fcn.restype = ctypes.c_int
+    return fcn
+
+
+_sync_file_range = _load_sync_file_range()
+
+
+def _fadvise(fd, offset, length, advice):
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError:
+        # advices are just hints, devices and pipes might not support them
+        pass
+
+
+def _digest(data):
+    # hashlib releases the GIL on large buffers, digests can be computed by multiple threads
+    return hashlib.blake2b(data, digest_size=32).hexdigest()
+
+
+def _open_direct(path, flags, mode=0o644):
+    if hasattr(os, "O_DIRECT"):
+        try:
+            return os.open(path, flags | os.O_DIRECT, mode), True
+        except OSError:
+            # some filesystems (e.g., tmpfs) do not support O_DIRECT
+            logger.warning(f"O_DIRECT not supported on {path}, using buffered I/O.")
+    return os.open(path, flags, mode), False
+
+
+def _clear_direct(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_DIRECT)
+
+
+def _give_to_sudo_user(path):
+    # files created by `sudo dd.py` should belong to the user who invoked sudo
+    uid, gid = os.environ.get("SUDO_UID"), os.environ.get("SUDO_GID")
+    if uid is not None and gid is not None:
+        os.chown(path, int(uid), int(gid))
+
+
+class Manifest:
+    """
+    List of the extents written to the output together with their digests.
+    It is stored next to the disk image and used to verify the flashed device.
+    """
+
+    def __init__(self, image_size, image_mtime, block_size, sparse, extents=None):
+        self.image_size = image_size
+        self.image_mtime = image_mtime
+        self.block_size = block_size
+        self.sparse = sparse
+        self.extents = extents or []
+
+    @property
+    def size(self):
+        return sum(length for _, length, _ in self.extents)
+
+    def add(self, offset, length, digest):
+        self.extents.append((offset, length, digest))
+
+    def matches(self, image, block_size, sparse):
+        stat = os.stat(image)
+        return (
+            self.image_size == stat.st_size
+            and self.image_mtime == stat.st_mtime
+            and self.block_size == block_size
+            and self.sparse == sparse
+        )
+
+    @classmethod
+    def for_image(cls, image, block_size, sparse):
+        stat = os.stat(image)
+        return cls(stat.st_size, stat.st_mtime, block_size, sparse)
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, "rt") as fin:
+                content = json.load(fin)
+        except (OSError, ValueError):
+            return None
+        if content.get("version") != MANIFEST_VERSION or content.get("algorithm") != MANIFEST_HASH_ALGORITHM:
+            return None
+        return cls(
+            content["image"]["size"],
+            content["image"]["mtime"],
+            content["block_size"],
+            content["sparse"],
+            [tuple(e) for e in content["extents"]],
+        )
+
+    def save(self, path):
+        content = {
+            "version": MANIFEST_VERSION,
+            "algorithm": MANIFEST_HASH_ALGORITHM,
+            "image": {"size": self.image_size, "mtime": self.image_mtime},
+            "block_size": self.block_size,
+            "sparse": self.sparse,
+            "extents": sorted(self.extents),
+        }
+        with open(path, "wt") as fout:
+            json.dump(content, fout)
+        _give_to_sudo_user(path)
+
+
+class BufferPool:
+    """
+    Fixed set of page-aligned buffers that are recycled between the reader and the writer.
+    Page alignment (guaranteed by anonymous mmaps) makes the buffers usable with O_DIRECT.
+    """
+
+    def __init__(self, num_buffers, block_size):
+        self._free = queue.Queue()
+        for _ in range(num_buffers):
+            self._free.put(mmap.mmap(-1, block_size))
+
+    def get(self, timeout=None):
+        return self._free.get(timeout=timeout)
+
+    def release(self, buf):
+        self._free.put(buf)
+
+
+class Chunk:
+    """
+    A range of the source image, chunks without a buffer are holes (i.e., all zeros).
+    The same chunk can be shared by multiple consumers, its buffer goes back to the pool
+    once every consumer released it.
+    """
+
+    __slots__ = ["buffer", "offset", "length", "refs"]
+
+    _lock = threading.Lock()
+
+    def __init__(self, buffer, offset, length, refs=1):
+        self.buffer = buffer
+        self.offset = offset
+        self.length = length
+        self.refs = refs
+
+    def release(self, pool):
+        if self.buffer is None:
+            return
+        with Chunk._lock:
+            self.refs -= 1
+            last = self.refs == 0
+        if last:
+            pool.release(self.buffer)
+
+    @property
+    def is_hole(self):
+        return self.buffer is None
+
+    @property
+    def data(self):
+        return memoryview(self.buffer)[: self.length]
+
+
+class Reader(threading.Thread):
+    def __init__(self, path, pool, block_size, outputs, abort, sparse=False, ranges=None, direct=False):
+        super(Reader, self).__init__(daemon=True)
+        self._path = path
+        self._pool = pool
+        self._block_size = block_size
+        self._outputs = outputs
+        self._abort = abort
+        self._sparse = sparse
+        self._ranges = ranges
+        self._direct = direct
+        self._zeros = bytes(block_size)
+        self.size = None
+        self.error = None
+
+    def run(self):
+        fd = None
+        try:
+            if self._direct:
+                fd, self._direct = _open_direct(self._path, os.O_RDONLY)
+            else:
+                fd = os.open(self._path, os.O_RDONLY)
+            _fadvise(fd, 0, 0, getattr(os, "POSIX_FADV_SEQUENTIAL", 0))
+            if self._ranges is not None:
+                # read exactly the given ranges
+                for offset, length in self._ranges:
+                    self._read_extent(fd, offset, offset + length)
+                    if self._abort.is_set():
+                        break
+                return
+            size = self.size = os.fstat(fd).st_size
+            extents = sparse_image_utils.data_extents(fd, size) if self._sparse else [(0, size)]
+            offset = 0
+            for start, end in extents:
+                # whatever lies between two data extents is a hole
+                if start > offset:
+                    self._emit(Chunk(None, offset, start - offset))
+                self._read_extent(fd, start, end)
+                offset = end
+                if self._abort.is_set():
+                    break
+            else:
+                if offset < size:
+                    self._emit(Chunk(None, offset, size - offset))
+        except BaseException as e:
+            self.error = e
+            self._abort.set()
+        finally:
+            if fd is not None:
+                os.close(fd)
+            # end of stream
+            for output in self._outputs:
+                output.put(None)
+
+    def _emit(self, chunk):
+        chunk.refs = len(self._outputs)
+        for output in self._outputs:
+            output.put(chunk)
+
+    def _emit_buffer(self, buf, offset, length):
+        chunk = Chunk(buf, offset, length)
+        if self._sparse and chunk.data == self._zeros[:length]:
+            # unzipped images are not sparse on disk, their free space is made of zero blocks
+            self._pool.release(buf)
+            chunk = Chunk(None, offset, length)
+        self._emit(chunk)
+
+    def _read_extent(self, fd, start, end):
+        offset = start
+        while offset < end and not self._abort.is_set():
+            buf = self._pool.get()
+            length = self._read_into(fd, buf, offset, min(self._block_size, end - offset))
+            if length == 0:
+                self._pool.release(buf)
+                break
+            self._emit_buffer(buf, offset, length)
+            # we will not need these pages again
+            _fadvise(fd, offset, length, getattr(os, "POSIX_FADV_DONTNEED", 0))
+            offset += length
+
+    def _read_into(self, fd, buf, offset, size):
+        view = memoryview(buf)
+        length = 0
+        while length < size:
+            if self._direct:
+                # O_DIRECT reads whole aligned blocks, the exceeding bytes are ignored
+                aligned = -(-(size - length) // DIRECT_IO_ALIGNMENT) * DIRECT_IO_ALIGNMENT
+                try:
+                    n = os.preadv(fd, [view[length : length + aligned]], offset + length)
+                except OSError as e:
+                    if e.errno != errno.EINVAL:
+                        raise
+                    # unaligned offset, fall back to buffered I/O
+                    _clear_direct(fd)
+                    self._direct = False
+                    continue
+            else:
+                n = os.preadv(fd, [view[length:size]], offset + length)
+            if n == 0:
+                break
+            length += n
+        return min(length, size)
+
+
+class _RawStream:
+    """
+    Wraps a file-like object, it allows to push back the bytes read past the end of a ZIP member.
+    """
+
+    def __init__(self, fin):
+        self._fin = fin
+        self._pushback = b""
+        self.consumed = 0
+
+    def read(self, size):
+        if self._pushback:
+            data, self._pushback = self._pushback[:size], self._pushback[size:]
+        else:
+            data = self._fin.read(size)
+        self.consumed += len(data)
+        return data
+
+    def read_exactly(self, size):
+        data = b""
+        while len(data) < size:
+            part = self.read(size - len(data))
+            if not part:
+                raise IOError("Unexpected end of the ZIP archive")
+            data += part
+        return data
+
+    def unread(self, data):
+        self._pushback = data + self._pushback
+        self.consumed -= len(data)
+
+
+class StreamReader(Reader):
+    """
+    Reads a ZIP archive sequentially while it is being downloaded. The disk image member is
+    decompressed on the fly and fanned out to the outputs, all the other members (e.g., the
+    disk image metadata) are extracted to `extract_dir`.
+    """
+
+    def __init__(self, url, pool, block_size, outputs, abort, extract_dir, sparse=False):
+        super(StreamReader, self).__init__(url, pool, block_size, outputs, abort, sparse=sparse)
+        self._extract_dir = extract_dir
+        self._raw = None
+        self._archive_size = None
+        self._image_size = None
+        self._image_found = False
+        self._offset = 0
+
+    @property
+    def size(self):
+        if self._image_size is not None:
+            return self._image_size
+        # the image size is not in the header, estimate it from the compression ratio
+        if not self._archive_size or not self._raw or not self._raw.consumed:
+            return None
+        return int(self._offset * self._archive_size / self._raw.consumed)
+
+    @size.setter
+    def size(self, value):
+        self._image_size = value
+
+    def run(self):
+        try:
+            with urllib.request.urlopen(self._path, timeout=STREAM_TIMEOUT_SECS) as response:
+                length = response.headers.get("Content-Length")
+                self._archive_size = int(length) if length else None
+                self._raw = _RawStream(response)
+                while not self._abort.is_set():
+                    header = self._raw.read(ZIP_LOCAL_FILE_HEADER.size)
+                    if len(header) < ZIP_LOCAL_FILE_HEADER.size or header[:4] != ZIP_LOCAL_FILE_SIGNATURE:
+                        # we reached the central directory
+                        self._raw.unread(header)
+                        break
+                    self._read_member(header)
+            if not self._abort.is_set():
+                if not self._image_found:
+                    raise IOError(f"No disk image found in {self._path}")
+                self._image_size = self._offset
+        except BaseException as e:
+            self.error = e
+            self._abort.set()
+        finally:
+            # end of stream
+            for output in self._outputs:
+                output.put(None)
+
+    def _read_member(self, header):
+        fields = ZIP_LOCAL_FILE_HEADER.unpack(header)
+        _, _, flags, method, _, _, crc, csize, usize, name_len, extra_len = fields
+        name = self._raw.read_exactly(name_len).decode("utf-8")
+        extra = self._raw.read_exactly(extra_len)
+        zip64 = False
+        # ZIP64 archives store the sizes in the extra field
+        while len(extra) >= 4:
+            field_id, field_len = struct.unpack("<HH", extra[:4])
+            field = extra[4 : 4 + field_len]
+            if field_id == ZIP_ZIP64_EXTRA_ID:
+                zip64 = True
+                if usize == 0xFFFFFFFF and len(field) >= 8:
+                    (usize,), field = struct.unpack("<Q", field[:8]), field[8:]
+                if csize == 0xFFFFFFFF and len(field) >= 8:
+                    (csize,) = struct.unpack("<Q", field[:8])
+            extra = extra[4 + field_len :]
+        has_descriptor = bool(flags & ZIP_FLAG_DATA_DESCRIPTOR)
+        if method not in [ZIP_METHOD_STORED, ZIP_METHOD_DEFLATED]:
+            raise IOError(f"Compression method {method} of '{name}' is not supported")
+        if method == ZIP_METHOD_STORED and has_descriptor:
+            raise IOError(f"Cannot stream the uncompressed member '{name}' of unknown size")
+        pieces = self._inflate(method, csize)
+        if name.endswith(DISK_IMAGE_EXTENSION):
+            self._image_found = True
+            if not has_descriptor:
+                self.size = usize
+            actual_crc = self._fill_buffers(pieces)
+        else:
+            actual_crc = self._extract(name, pieces)
+        if self._abort.is_set():
+            return
+        # sizes and checksum might follow the data
+        if has_descriptor:
+            crc = self._raw.read_exactly(4)
+            # the signature of the data descriptor is optional
+            if crc == ZIP_DATA_DESCRIPTOR_SIGNATURE:
+                crc = self._raw.read_exactly(4)
+            (crc,) = struct.unpack("<I", crc)
+            self._raw.read_exactly(16 if zip64 else 8)
+        if actual_crc != crc:
+            raise IOError(f"CRC mismatch for '{name}', the download might be corrupted")
+
+    def _inflate(self, method, csize):
+        if method == ZIP_METHOD_STORED:
+            remaining = csize
+            while remaining > 0:
+                data = self._raw.read(min(STREAM_READ_SIZE, remaining))
+                if not data:
+                    raise IOError("Unexpected end of the ZIP archive")
+                remaining -= len(data)
+                yield data
+            return
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        while not decompressor.eof:
+            data = self._raw.read(STREAM_READ_SIZE)
+            if not data:
+                raise IOError("Unexpected end of the ZIP archive")
+            # bound the output, a few MB of zeros can inflate to GBs
+            out = decompressor.decompress(data, self._block_size)
+            while out:
+                yield out
+                out = decompressor.decompress(decompressor.unconsumed_tail, self._block_size)
+        # give back what belongs to the next member
+        self._raw.unread(decompressor.unused_data)
+
+    def _fill_buffers(self, pieces):
+        crc = 0
+        buf, used = None, 0
+        for piece in pieces:
+            crc = zlib.crc32(piece, crc)
+            view = memoryview(piece)
+            while len(view) and not self._abort.is_set():
+                if buf is None:
+                    buf, used = self._pool.get(), 0
+                n = min(len(view), self._block_size - used)
+                buf[used : used + n] = view[:n]
+                used += n
+                view = view[n:]
+                if used == self._block_size:
+                    self._emit_buffer(buf, self._offset, used)
+                    self._offset += used
+                    buf = None
+            if self._abort.is_set():
+                break
+        if buf is not None:
+            if used > 0 and not self._abort.is_set():
+                self._emit_buffer(buf, self._offset, used)
+                self._offset += used
+            else:
+                self._pool.release(buf)
+        return crc
+
+    def _extract(self, name, pieces):
+        crc = 0
+        path = os.path.join(self._extract_dir, os.path.basename(name))
+        with open(path, "wb") as fout:
+            for piece in pieces:
+                crc = zlib.crc32(piece, crc)
+                fout.write(piece)
+        _give_to_sudo_user(path)
+        logger.info(f"Extracted {path}")
+        return crc
+
+
+class SparseImageReader(Reader):
+    """
+    Reads a sparse image (local or remote), only the stored frames are decompressed and fanned
+    out, everything else is emitted as holes. The files embedded in the header (e.g., the disk
+    image metadata) are extracted to `extract_dir`.
+    """
+
+    def __init__(self, path, pool, block_size, outputs, abort, extract_dir):
+        super(SparseImageReader, self).__init__(path, pool, block_size, outputs, abort, sparse=True)
+        self._extract_dir = extract_dir
+
+    def run(self):
+        try:
+            if _is_url(self._path):
+                fin = urllib.request.urlopen(self._path, timeout=STREAM_TIMEOUT_SECS)
+            else:
+                fin = open(self._path, "rb")
+            with fin:
+                image = sparse_image_utils.SparseImage(fin)
+                self.size = image.image_size
+                self._extract(image.files)
+                offset = 0
+                for start, data in image.frames():
+                    if self._abort.is_set():
+                        break
+                    if start > offset:
+                        self._emit(Chunk(None, offset, start - offset))
+                    self._fill_buffers(start, data)
+                    offset = start + len(data)
+                if not self._abort.is_set() and offset < self.size:
+                    self._emit(Chunk(None, offset, self.size - offset))
+        except BaseException as e:
+            self.error = e
+            self._abort.set()
+        finally:
+            # end of stream
+            for output in self._outputs:
+                output.put(None)
+
+    def _fill_buffers(self, offset, data):
+        view = memoryview(data)
+        while len(view) and not self._abort.is_set():
+            buf = self._pool.get()
+            n = min(len(view), self._block_size)
+            buf[:n] = view[:n]
+            self._emit(Chunk(buf, offset, n))
+            offset += n
+            view = view[n:]
+
+    def _extract(self, files):
+        for name, content in files.items():
+            path = os.path.join(self._extract_dir, os.path.basename(name))
+            with open(path, "wt") as fout:
+                fout.write(content)
+            _give_to_sudo_user(path)
+            logger.info(f"Extracted {path}")
+
+
+class Writer(threading.Thread):
+    def __init__(
+        self,
+        path,
+        pool,
+        inputs,
+        abort,
+        direct=False,
+        sync_interval=DEFAULT_SYNC_INTERVAL,
+        holes=HOLES_ZEROOUT,
+        on_error=None,
+    ):
+        super(Writer, self).__init__(daemon=True)
+        self._path = path
+        self._pool = pool
+        self._inputs = inputs
+        self._abort = abort
+        self._direct = direct
+        self._sync_interval = sync_interval
+        self._holes = holes
+        self._on_error = on_error
+        self._is_block_device = pathlib.Path(path).is_block_device()
+        self._synced_until = 0
+        self._pending_sync = None
+        self._pending_hole = None
+        self._size = 0
+        self.written = 0
+        self.processed = 0
+        self.error = None
+
+    def open(self):
+        flags = os.O_WRONLY | os.O_CREAT
+        if not self._is_block_device:
+            flags |= os.O_TRUNC
+        if self._direct:
+            fd, self._direct = _open_direct(self._path, flags)
+        else:
+            fd = os.open(self._path, flags, 0o644)
+        if not self._is_block_device:
+            _give_to_sudo_user(self._path)
+        return fd
+
+    def run(self):
+        fd = None
+        eos = False
+        try:
+            fd = self.open()
+            while True:
+                chunk = self._inputs.get()
+                if chunk is None:
+                    eos = True
+                    break
+                if chunk.is_hole:
+                    self._add_hole(fd, chunk)
+                    continue
+                try:
+                    if not self._abort.is_set():
+                        self._fill_hole(fd)
+                        self._write(fd, chunk)
+                finally:
+                    chunk.release(self._pool)
+            if not self._abort.is_set():
+                self._fill_hole(fd)
+                if not self._is_block_device:
+                    # trailing holes are not written, make sure the file has the right size
+                    os.ftruncate(fd, self._size)
+                logger.info("Flushing I/O buffer...")
+                os.fsync(fd)
+        except BaseException as e:
+            # this includes failing to open the output
+            self.error = e
+            if self._on_error is not None:
+                self._on_error(self)
+            # other outputs might still be healthy, keep draining the queue so that the reader
+            # does not block on it (nothing is left to drain if the error came after the end of stream)
+            chunk = None if eos else self._inputs.get()
+            while chunk is not None:
+                chunk.release(self._pool)
+                chunk = self._inputs.get()
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def _write(self, fd, chunk):
+        if self._direct and chunk.length % DIRECT_IO_ALIGNMENT != 0:
+            # O_DIRECT cannot write a partial block (this is the tail of the image)
+            _clear_direct(fd)
+            self._direct = False
+        data = chunk.data
+        written = 0
+        while written < chunk.length:
+            written += os.pwrite(fd, data[written:], chunk.offset + written)
+        self.written += chunk.length
+        self.processed += chunk.length
+        end = chunk.offset + chunk.length
+        self._size = max(self._size, end)
+        if end - self._synced_until >= self._sync_interval:
+            self._sync(fd, self._synced_until, end)
+            self._synced_until = end
+
+    def _add_hole(self, fd, chunk):
+        # contiguous holes are merged so that they can be cleared with a single request
+        if self._pending_hole is not None:
+            start, end = self._pending_hole
+            if end == chunk.offset:
+                self._pending_hole = (start, chunk.offset + chunk.length)
+                return
+            self._fill_hole(fd)
+        self._pending_hole = (chunk.offset, chunk.offset + chunk.length)
+
+    def _fill_hole(self, fd):
+        if self._pending_hole is None:
+            return
+        start, end = self._pending_hole
+        self._pending_hole = None
+        # regular files are truncated on open, their holes already read as zeros
+        if self._is_block_device and self._holes != HOLES_SKIP:
+            # ioctls work on whole sectors, the unaligned edges (if any) are written explicitly
+            astart = -(-start // BLK_SECTOR_SIZE) * BLK_SECTOR_SIZE
+            aend = max(astart, end // BLK_SECTOR_SIZE * BLK_SECTOR_SIZE)
+            for zstart, zend in [(start, astart), (aend, end)]:
+                if zend > zstart:
+                    os.pwrite(fd, bytes(zend - zstart), zstart)
+            if aend > astart:
+                request = BLKDISCARD if self._holes == HOLES_DISCARD else BLKZEROOUT
+                fcntl.ioctl(fd, request, struct.pack("QQ", astart, aend - astart))
+        self.processed += end - start
+        self._size = max(self._size, end)
+
+    def _sync(self, fd, start, end):
+        if self._direct:
+            # nothing sits in the page cache
+            return
+        if _sync_file_range is None:
+            os.fdatasync(fd)
+            return
+        # start the writeback of this window without waiting for it...
+        _sync_file_range(fd, start, end - start, SYNC_FILE_RANGE_WRITE)
+        # ...then wait for the previous window to hit the device and drop it from the cache,
+        # this keeps the device busy while bounding the amount of dirty pages in memory
+        if self._pending_sync is not None:
+            pstart, pend = self._pending_sync
+            _sync_file_range(
+                fd,
+                pstart,
+                pend - pstart,
+                SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE | SYNC_FILE_RANGE_WAIT_AFTER,
+            )
+            _fadvise(fd, pstart, pend - pstart, getattr(os, "POSIX_FADV_DONTNEED", 0))
+        self._pending_sync = (start, end)
+
+
+class Digester(threading.Thread):
+    """
+    Computes the digests of the data chunks of a stream, independently of the outputs it is written to.
+    """
+
+    def __init__(self, pool, inputs, manifest):
+        super(Digester, self).__init__(daemon=True)
+        self._pool = pool
+        self._inputs = inputs
+        self._manifest = manifest
+        self.error = None
+
+    def run(self):
+        chunk = self._inputs.get()
+        while chunk is not None:
+            try:
+                if not chunk.is_hole and self.error is None:
+                    self._manifest.add(chunk.offset, chunk.length, _digest(chunk.data))
+            except BaseException as e:
+                # keep draining the queue so that the reader does not block on it
+                self.error = e
+            finally:
+                chunk.release(self._pool)
+            chunk = self._inputs.get()
+
+
+class Verifier(threading.Thread):
+    def __init__(self, pool, inputs, abort, expected, workers=DEFAULT_HASH_WORKERS):
+        super(Verifier, self).__init__(daemon=True)
+        self._pool = pool
+        self._inputs = inputs
+        self._abort = abort
+        self._expected = expected
+        self._workers = workers
+        self._lock = threading.Lock()
+        self.verified = 0
+        self.mismatch = None
+        self.error = None
+
+    def run(self):
+        try:
+            with ThreadPoolExecutor(max_workers=self._workers) as executor:
+                while True:
+                    chunk = self._inputs.get()
+                    if chunk is None:
+                        break
+                    if self._abort.is_set():
+                        chunk.release(self._pool)
+                        continue
+                    executor.submit(self._check, chunk)
+        except BaseException as e:
+            self.error = e
+            self._abort.set()
+
+    def _check(self, chunk):
+        try:
+            expected_length, expected_digest = self._expected[chunk.offset]
+            if chunk.length != expected_length or _digest(chunk.data) != expected_digest:
+                self.mismatch = (chunk.offset, chunk.offset + expected_length)
+                self._abort.set()
+            with self._lock:
+                self.verified += chunk.length
+        except BaseException as e:
+            self.error = e
+            self._abort.set()
+        finally:
+            chunk.release(self._pool)
+
+
+def _monitor(workers, labels, header, get_progress):
+    stime = time.time()
+    multi = len(workers) > 1
+    if multi:
+        pbar = progress_bar.MultiProgressBar(labels)
+    else:
+        pbar = progress_bar.ProgressBar(header=f"{header} [ETA: ND]")
+    while True:
+        alive = [w for w in workers if w.is_alive()]
+        if not alive:
+            break
+        alive[0].join(PROGRESS_REFRESH_SECS)
+        elapsed = time.time() - stime
+        for worker, label in zip(workers, labels):
+            progress = int(get_progress(worker) * 100.0)
+            eta = "ND"
+            if progress > 0:
+                eta = misc_utils.human_time((100 - progress) * (elapsed / progress), True)
+            if not multi:
+                if 0 < progress < 100:
+                    pbar.set_header("{} [ETA: {}]".format(header, eta))
+                    pbar.update(progress)
+                continue
+            if worker.error is not None or getattr(worker, "mismatch", None) is not None:
+                info = "FAILED"
+            elif not worker.is_alive():
+                info = "Done!"
+            else:
+                info = f"[ETA: {eta}]"
+            pbar.update(label, progress, info)
+        if multi:
+            pbar.draw()
+    return pbar
+
+
+def _is_url(source):
+    return source.startswith("http://") or source.startswith("https://")
+
+
+def _has_manifest_source(source):
+    # streamed archives and sparse images are not the disk image, their manifest is built on the fly
+    return not _is_url(source) and not sparse_image_utils.is_sparse_image(source)
+
+
+def flash(
+    source,
+    targets,
+    block_size,
+    num_buffers,
+    direct=False,
+    sync_interval=DEFAULT_SYNC_INTERVAL,
+    sparse=False,
+    holes=HOLES_ZEROOUT,
+    manifest=None,
+    extract_dir=None,
+    cache=None,
+):
+    if direct and block_size % DIRECT_IO_ALIGNMENT != 0:
+        raise ValueError(f"The block size must be a multiple of {DIRECT_IO_ALIGNMENT} when using O_DIRECT")
+    abort = threading.Event()
+    pool = BufferPool(num_buffers, block_size)
+    # the source is read once and every chunk is fanned out to all the targets
+    outputs = list(targets)
+    if cache:
+        # the cache is just another output, it is moved in place only once complete
+        outputs.append(f"{cache}.part")
+    queues = [queue.Queue(maxsize=num_buffers) for _ in outputs]
+    # digests are computed once on the stream itself, they do not depend on which targets fail
+    fanout = queues + ([queue.Queue(maxsize=num_buffers)] if manifest else [])
+    extract_dir = extract_dir or os.path.dirname(os.path.abspath(manifest or cache or "."))
+    if sparse_image_utils.is_sparse_image(source):
+        # only the stored frames are written, the rest of the image is made of holes
+        sparse = True
+        reader = SparseImageReader(source, pool, block_size, fanout, abort, extract_dir)
+        digests = Manifest(None, None, block_size, sparse) if manifest else None
+    elif _is_url(source):
+        # the archive is decompressed while it is downloaded
+        reader = StreamReader(source, pool, block_size, fanout, abort, extract_dir, sparse=sparse)
+        digests = Manifest(None, None, block_size, sparse) if manifest else None
+    else:
+        reader = Reader(source, pool, block_size, fanout, abort, sparse=sparse)
+        digests = Manifest.for_image(source, block_size, sparse) if manifest else None
+
+    # the cache alone is not worth the transfer, stop reading (and downloading) as soon as
+    # no healthy target is left
+    healthy = [len(targets)]
+    healthy_lock = threading.Lock()
+
+    def _on_error(_):
+        with healthy_lock:
+            healthy[0] -= 1
+            if healthy[0] == 0:
+                abort.set()
+
+    writers = [
+        Writer(target, pool, chunks, abort, direct, sync_interval, holes, on_error=_on_error)
+        for target, chunks in zip(targets, queues)
+    ]
+    if cache:
+        writers.append(Writer(outputs[-1], pool, queues[-1], abort, sync_interval=sync_interval))
+    digester = Digester(pool, fanout[-1], digests) if manifest else None
+    stime = time.time()
+    # start transfer
+    for writer in writers:
+        writer.start()
+    if digester is not None:
+        digester.start()
+    reader.start()
+    try:
+        pbar = _monitor(writers, outputs, "Flashing", lambda w: w.processed / (reader.size or float("inf")))
+    except KeyboardInterrupt:
+        abort.set()
+        for writer in writers:
+            writer.join()
+        raise
+    reader.join()
+    if reader.error is not None:
+        raise reader.error
+    if cache:
+        cache_writer = writers.pop()
+        if cache_writer.error is None and not abort.is_set():
+            os.rename(outputs[-1], cache)
+        else:
+            if cache_writer.error is not None:
+                logger.warning(f"Could not cache the disk image to {cache}: {str(cache_writer.error)}")
+            if os.path.isfile(outputs[-1]):
+                os.remove(outputs[-1])
+    failed = [(target, w.error) for target, w in zip(targets, writers) if w.error is not None]
+    if len(failed) == len(writers):
+        raise failed[0][1]
+    healthy_writers = [w for w in writers if w.error is None]
+    # jump to 100% if success
+    if len(outputs) == 1:
+        pbar.update(100)
+    logger.info("Flashed in {}".format(misc_utils.human_time(time.time() - stime)))
+    if sparse:
+        logger.info(
+            "Written {} out of {} (the rest was sparse)".format(
+                misc_utils.human_size(healthy_writers[0].written), misc_utils.human_size(reader.size)
+            )
+        )
+    # store the digests of what we wrote (at least one target succeeded), they will be used for verification
+    if digester is not None:
+        digester.join()
+        if digester.error is not None:
+            logger.warning(f"Could not compute the digests of the disk image: {str(digester.error)}")
+            return failed
+        if not _has_manifest_source(source):
+            digests.image_size = reader.size
+            if cache and os.path.isfile(cache):
+                digests.image_mtime = os.stat(cache).st_mtime
+        digests.save(manifest)
+    return failed
+
+
+def build_manifest(source, block_size, num_buffers, sparse=False, workers=DEFAULT_HASH_WORKERS):
+    manifest = Manifest.for_image(source, block_size, sparse)
+    abort = threading.Event()
+    pool = BufferPool(num_buffers, block_size)
+    chunks = queue.Queue(maxsize=num_buffers)
+    if sparse_image_utils.is_sparse_image(source):
+        extract_dir = os.path.dirname(os.path.abspath(source))
+        reader = SparseImageReader(source, pool, block_size, [chunks], abort, extract_dir)
+    else:
+        reader = Reader(source, pool, block_size, [chunks], abort, sparse=sparse)
+    reader.start()
+
+    def _hash(c):
+        try:
+            manifest.add(c.offset, c.length, _digest(c.data))
+        finally:
+            c.release(pool)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        chunk = chunks.get()
+        while chunk is not None:
+            if not chunk.is_hole:
+                executor.submit(_hash, chunk)
+            chunk = chunks.get()
+    reader.join()
+    if reader.error is not None:
+        raise reader.error
+    return manifest
+
+
+def verify(
+    source, targets, manifest_path, block_size, num_buffers, sparse=False, workers=DEFAULT_HASH_WORKERS
+):
+    manifest = Manifest.load(manifest_path)
+    if manifest is None and _is_url(source):
+        # only the manifest written while streaming describes a streamed image
+        raise IOError(
+            f"The streamed image {source} has no manifest to verify against, "
+            f"flash it again with --stream-cache to keep a local copy of the image."
+        )
+    if manifest is not None and (not os.path.exists(source) or not _has_manifest_source(source)):
+        # the image was streamed and not cached (or flashed from a sparse image), the manifest is all we have
+        pass
+    elif manifest is None or not manifest.matches(source, block_size, sparse):
+        logger.warning(f"No valid manifest found for {source}, computing one now.")
+        manifest = build_manifest(source, block_size, num_buffers, sparse, workers)
+        manifest.save(manifest_path)
+    expected = {offset: (length, digest) for offset, length, digest in manifest.extents}
+    ranges = [(offset, length) for offset, length, _ in sorted(manifest.extents)]
+    readers, verifiers, aborts = [], [], []
+    # devices are verified independently, a mismatch on one does not stop the others
+    for target in targets:
+        abort = threading.Event()
+        aborts.append(abort)
+        # one buffer per hashing worker on top of those in flight
+        pool = BufferPool(num_buffers + workers, block_size)
+        chunks = queue.Queue(maxsize=num_buffers)
+        # read the device directly, the page cache might still hold what we just wrote
+        readers.append(Reader(target, pool, block_size, [chunks], abort, ranges=ranges, direct=True))
+        verifiers.append(Verifier(pool, chunks, abort, expected, workers))
+    stime = time.time()
+    for worker in verifiers + readers:
+        worker.start()
+    try:
+        total = manifest.size or float("inf")
+        pbar = _monitor(verifiers, targets, "Verifying", lambda v: v.verified / total)
+    except KeyboardInterrupt:
+        for abort in aborts:
+            abort.set()
+        raise
+    failed = []
+    for target, reader, verifier in zip(targets, readers, verifiers):
+        reader.join()
+        error = reader.error or verifier.error
+        if verifier.mismatch is not None:
+            error = IOError("Mismatch in range position [{}-{}]".format(*verifier.mismatch))
+        elif error is None and verifier.verified != manifest.size:
+            error = IOError(f"Only {verifier.verified} out of {manifest.size} bytes could be read back")
+        if error is not None:
+            failed.append((target, error))
+    if len(targets) == 1 and not failed:
+        pbar.update(100)
+    logger.info("Verified in {}".format(misc_utils.human_time(time.time() - stime)))
+    return failed
+
+
+if __name__ == "__main__":
+    # configure parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-i",
+        "--input",
+        required=True,
+        help="Input device or file (or sparse image), or URL of a ZIP archive or sparse image to stream",
+    )
+    parser.add_argument("-o", "--output", required=True, nargs="+", help="Output devices or files")
+    parser.add_argument("-b", "--block-size", default=DEFAULT_BLOCK_SIZE, type=int, help="Block size")
+    parser.add_argument(
+        "-n", "--buffers", default=DEFAULT_NUM_BUFFERS, type=int, help="Number of in-flight buffers"
+    )
+    parser.add_argument(
+        "--direct", default=False, action="store_true", help="Bypass the page cache (O_DIRECT) on the output"
+    )
+    parser.add_argument(
+        "--sync-interval",
+        default=DEFAULT_SYNC_INTERVAL,
+        type=int,
+        help="Number of bytes after which the written data is flushed to the output",
+    )
+    parser.add_argument("--manifest", default=None, help="Path to the digests manifest of the input")
+    parser.add_argument(
+        "--extract-dir", default=None, help="Where to extract the other members of a streamed archive"
+    )
+    parser.add_argument(
+        "--cache", default=None, help="Where to keep a copy of the disk image of a streamed archive"
+    )
+    parser.add_argument(
+        "--verify",
+        default=False,
+        action="store_true",
+        help="Verify the output against the manifest instead of flashing it",
+    )
+    parser.add_argument(
+        "--sparse",
+        default=False,
+        action="store_true",
+        help="Write only the allocated, non-zero extents of the input",
+    )
+    parser.add_argument(
+        "--holes",
+        default=HOLES_ZEROOUT,
+        choices=HOLES_POLICIES,
+        help="How to clear the holes of a sparse input on a block device",
+    )
+    parser.add_argument(
+        "--report", default=None, help="Where to write the list (JSON) of the outputs that failed"
+    )
+    # parse arguments
+    parsed = parser.parse_args()
+
+    # make sure source and destination exist
+    # a streamed image that was not cached can still be verified against its manifest
+    streamed = parsed.verify and parsed.manifest is not None and os.path.isfile(parsed.manifest)
+    if not _is_url(parsed.input) and not streamed and not os.path.exists(parsed.input):
+        print(f"Fatal: input `{parsed.input}` not found.")
+        exit(1)
+    for output in parsed.output:
+        if output.startswith("/dev/") and not os.path.exists(output):
+            print(f"Fatal: output `{output}` not found.")
+            exit(1)
+
+    if parsed.verify and parsed.manifest is None:
+        print("Fatal: the argument --manifest is required when using --verify.")
+        exit(1)
+
+    try:
+        if parsed.verify:
+            failures = verify(
+                parsed.input,
+                parsed.output,
+                parsed.manifest,
+                parsed.block_size,
+                max(2, parsed.buffers),
+                sparse=parsed.sparse,
+            )
+        else:
+            failures = flash(
+                parsed.input,
+                parsed.output,
+                parsed.block_size,
+                max(2, parsed.buffers),
+                direct=parsed.direct,
+                sync_interval=parsed.sync_interval,
+                sparse=parsed.sparse,
+                holes=parsed.holes,
+                manifest=parsed.manifest,
+                extract_dir=parsed.extract_dir,
+                cache=parsed.cache,
+            )
+    except KeyboardInterrupt:
+        exit(130)
+    except IOError as e:
+        print(f"Fatal: {str(e)}")
+        exit(5)
+    # report failed outputs
+    for output, error in failures:
+        print(f"Fatal: {output}: {str(error)}")
+    if parsed.report:
+        with open(parsed.report, "wt") as fout:
+            json.dump([output for output, _ in failures], fout)
+    exit(5 if failures else 0)
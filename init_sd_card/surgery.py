@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import base64
+import logging
+import argparse
+
+logging.basicConfig()
+logger = logging.getLogger("surgery")
+
+MAX_WRITE_ATTEMPTS = 2
+
+
+def _write_blocks(fd, blocks):
+    for offset, content in blocks:
+        written = 0
+        while written < len(content):
+            written += os.pwrite(fd, content[written:], offset + written)
+
+
+def _check_blocks(fd, blocks):
+    # drop the cached pages so that the content is read back from the device
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+    return [(offset, content) for offset, content in blocks if os.pread(fd, len(content), offset) != content]
+
+
+def apply(device, blocks):
+    """
+    Writes all the given (offset, content) blocks to the device, flushes them once and
+    reads them back. Blocks that do not match are written again.
+    """
+    fd = os.open(device, os.O_RDWR)
+    try:
+        pending = blocks
+        for attempt in range(MAX_WRITE_ATTEMPTS):
+            _write_blocks(fd, pending)
+            os.fsync(fd)
+            pending = _check_blocks(fd, pending)
+            if not pending:
+                return []
+            logger.warning(f"[{attempt + 1}/{MAX_WRITE_ATTEMPTS}] {len(pending)} blocks did not stick.")
+        return pending
+    finally:
+        os.close(fd)
+
+
+if __name__ == "__main__":
+    # configure parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", required=True, help="Output device or file")
+    # parse arguments
+    parsed = parser.parse_args()
+
+    if not os.path.exists(parsed.output):
+        print(f"Fatal: output `{parsed.output}` not found.")
+        exit(1)
+
+    # the surgery plan is given through stdin as it contains secrets (e.g., token, wifi passwords)
+    plan = json.load(sys.stdin)
+    blocks = [(b["offset"], base64.b64decode(b["content"])) for b in plan["blocks"]]
+
+    failed = apply(parsed.output, blocks)
+    for offset, content in failed:
+        print(f"Fatal: mismatch in range position [{offset}-{offset + len(content)}]")
+    exit(5 if failed else 0)
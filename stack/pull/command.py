@@ -3,10 +3,17 @@ import os
 import pathlib
 
 import yaml
+from docker.errors import NotFound
 
 from dt_shell import DTCommandAbs, DTShell, dtslogger
 from utils.avahi_utils import wait_for_service
-from utils.docker_utils import DEFAULT_MACHINE, get_endpoint_architecture, get_registry_to_use, pull_image
+from utils.docker_utils import (
+    DEFAULT_MACHINE,
+    get_endpoint_architecture,
+    get_registry_to_use,
+    ImagePullError,
+    pull_images,
+)
 from utils.misc_utils import sanitize_hostname
 from utils.multi_command_utils import MultiCommand
 
@@ -73,10 +80,18 @@ class DTCommand(DTCommandAbs):
         # pull images
         with open(stack_file, "r") as fin:
             stack_content = yaml.safe_load(fin)
+        images = []
         for service in stack_content["services"].values():
             image_name = service["image"].replace("${ARCH}", endpoint_arch)
             image_name = image_name.replace("${REGISTRY}", registry_to_use)
-            dtslogger.info(f"Pulling image `{image_name}`...")
-            pull_image(image_name, parsed.machine)
+            images.append(image_name)
+        try:
+            pull_images(images, parsed.machine)
+        except NotFound as e:
+            dtslogger.error(f"Image not found on registry '{registry_to_use}'. Aborting.\n{str(e)}")
+            return False
+        except ImagePullError as e:
+            dtslogger.error(f"Could not pull the images of the stack. Aborting.\n{str(e)}")
+            return False
         # ---
         print("<------")
@@ -14,7 +14,8 @@ from utils.docker_utils import (
     DEFAULT_MACHINE,
     get_endpoint_architecture,
     get_registry_to_use,
-    pull_image,
+    ImagePullError,
+    pull_images,
 )
 from utils.misc_utils import sanitize_hostname
 from utils.multi_command_utils import MultiCommand
@@ -104,16 +105,20 @@ class DTCommand(DTCommandAbs):
         if parsed.pull:
             with open(stack_file, "r") as fin:
                 stack_content = yaml.safe_load(fin)
+            images = []
             for service in stack_content["services"].values():
                 image_name = service["image"].replace("${ARCH}", endpoint_arch)
                 image_name = image_name.replace("${REGISTRY}", registry_to_use)
-                dtslogger.info(f"Pulling image `{image_name}`...")
-                try:
-                    pull_image(image_name, parsed.machine)
-                except NotFound:
-                    msg = f"Image '{image_name}' not found on registry '{registry_to_use}'. Aborting."
-                    dtslogger.error(msg)
-                    return False
+                images.append(image_name)
+            try:
+                pull_images(images, parsed.machine)
+            except NotFound as e:
+                msg = f"Image not found on registry '{registry_to_use}'. Aborting.\n{str(e)}"
+                dtslogger.error(msg)
+                return False
+            except ImagePullError as e:
+                dtslogger.error(f"Could not pull the images of the stack. Aborting.\n{str(e)}")
+                return False
         # print info
         dtslogger.info(f"Running stack [{stack}]...")
         print("------>")
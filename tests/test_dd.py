@@ -0,0 +1,91 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "init_sd_card"))
+
+import dd
+
+FLASH_TIMEOUT_SECS = 30
+BLOCK_SIZE = 64 * 1024
+
+
+def _flash_in_thread(*args, **kwargs):
+    # a hanging flash must fail the test, not hang the suite
+    outcome = {}
+
+    def _target():
+        try:
+            outcome["result"] = dd.flash(*args, **kwargs)
+        except BaseException as e:
+            outcome["error"] = e
+
+    worker = threading.Thread(target=_target, daemon=True)
+    worker.start()
+    worker.join(FLASH_TIMEOUT_SECS)
+    return worker.is_alive(), outcome
+
+
+class TestFlash(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self._tmpdir.name, "disk.img")
+        with open(self.source, "wb") as fout:
+            fout.write(os.urandom(16 * BLOCK_SIZE + 123))
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _target(self, name):
+        return os.path.join(self._tmpdir.name, name)
+
+    def test_flash(self):
+        target = self._target("out.img")
+        hung, outcome = _flash_in_thread(self.source, [target], BLOCK_SIZE, 4)
+        self.assertFalse(hung)
+        self.assertEqual(outcome.get("result"), [])
+        with open(self.source, "rb") as fsrc, open(target, "rb") as fout:
+            self.assertEqual(fsrc.read(), fout.read())
+
+    def test_final_sync_fails(self):
+        # the error comes after the end of the stream was consumed, nothing is left to drain
+        with mock.patch.object(dd.os, "fsync", side_effect=OSError("fsync failed")):
+            hung, outcome = _flash_in_thread(self.source, [self._target("out.img")], BLOCK_SIZE, 4)
+        self.assertFalse(hung, "flash() did not return")
+        self.assertIsInstance(outcome.get("error"), OSError)
+
+    def test_one_of_many_outputs_fails(self):
+        good, bad = self._target("good.img"), self._target("missing/bad.img")
+        hung, outcome = _flash_in_thread(self.source, [good, bad], BLOCK_SIZE, 4)
+        self.assertFalse(hung)
+        self.assertEqual([target for target, _ in outcome.get("result", [])], [bad])
+        with open(self.source, "rb") as fsrc, open(good, "rb") as fout:
+            self.assertEqual(fsrc.read(), fout.read())
+
+    def test_manifest_when_first_output_fails(self):
+        good, bad = self._target("good.img"), self._target("missing/bad.img")
+        manifest = self._target("disk.manifest")
+        hung, outcome = _flash_in_thread(self.source, [bad, good], BLOCK_SIZE, 4, manifest=manifest)
+        self.assertFalse(hung)
+        self.assertEqual([target for target, _ in outcome.get("result", [])], [bad])
+        # the healthy target is verified against the digests computed while flashing
+        with mock.patch.object(dd, "build_manifest", side_effect=AssertionError("manifest rebuilt")):
+            self.assertEqual(dd.verify(self.source, [good], manifest, BLOCK_SIZE, 4), [])
+
+
+class TestVerify(unittest.TestCase):
+    def test_streamed_image_without_manifest(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            manifest = os.path.join(tmpdir, "missing.manifest")
+            target = os.path.join(tmpdir, "out.img")
+            with open(target, "wb") as fout:
+                fout.write(bytes(BLOCK_SIZE))
+            with self.assertRaisesRegex(IOError, "--stream-cache"):
+                dd.verify("https://example.com/disk.zip", [target], manifest, BLOCK_SIZE, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import importlib.util
+import os
+import sys
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+HAS_DEPENDENCIES = all(importlib.util.find_spec(m) is not None for m in ["dt_shell", "docker"])
+
+
+@unittest.skipUnless(HAS_DEPENDENCIES, "dt_shell and docker are needed to load the devel commands")
+class TestSyncMachines(unittest.TestCase):
+    def setUp(self):
+        from devel.sync import command
+
+        self.command = command
+        self._tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _sync(self, machine):
+        parsed = SimpleNamespace(workdir=self._tmpdir.name, machine=machine, mount=True)
+        with mock.patch.object(self.command, "RemoteSync") as remote_sync, mock.patch.object(
+            self.command, "check_program_dependency"
+        ):
+            with self.assertRaises(SystemExit) as context:
+                self.command.DTCommand.command(None, [], parsed=parsed)
+        # nothing was synced
+        remote_sync.assert_not_called()
+        return context.exception.code
+
+    def test_no_machine(self):
+        self.assertEqual(self._sync(None), 2)
+
+    def test_local_machine(self):
+        # this is what `devel run --sync` passes when -H/--machine is not given
+        from utils.docker_utils import DEFAULT_MACHINE
+
+        self.assertEqual(self._sync(DEFAULT_MACHINE), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
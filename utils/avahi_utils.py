@@ -1,78 +1,218 @@
+import asyncio
+import functools
 import json
 import time
-from types import SimpleNamespace
-from zeroconf import ServiceBrowser, Zeroconf
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from zeroconf import ServiceStateChange
+from zeroconf.asyncio import AsyncServiceBrowser, AsyncServiceInfo, AsyncZeroconf
 
 from dt_shell import dtslogger
 
+DUCKIETOWN_SERVICE_TYPE = "_duckietown._tcp.local."
+RESOLVE_TIMEOUT_MS = 3000
+# how many services can be resolved at the same time
+RESOLVE_CONCURRENCY = 32
+
+
+@dataclass
+class FleetService:
+    name: str
+    hostname: str
+    port: Optional[int]
+    txt: dict
+    last_seen: float
+
+
+class FleetModel:
+    """
+    Services discovered on the network, indexed both by hostname and by service name.
+    """
+
+    def __init__(self):
+        self._by_hostname: Dict[str, Dict[str, FleetService]] = {}
+        self._by_service: Dict[str, Dict[str, FleetService]] = {}
+        # incremented every time the model changes
+        self.version = 0
+
+    def update(self, service: FleetService) -> bool:
+        """
+        Adds or refreshes a service, returns whether the model changed.
+        """
+        current = self.get(service.name, service.hostname)
+        if current is not None and (current.port, current.txt) == (service.port, service.txt):
+            current.last_seen = service.last_seen
+            return False
+        self._by_hostname.setdefault(service.hostname, {})[service.name] = service
+        self._by_service.setdefault(service.name, {})[service.hostname] = service
+        self.version += 1
+        return True
+
+    def remove(self, name: str, hostname: str) -> Optional[FleetService]:
+        service = self._by_service.get(name, {}).pop(hostname, None)
+        if service is None:
+            return None
+        self._by_hostname[hostname].pop(name, None)
+        if not self._by_hostname[hostname]:
+            del self._by_hostname[hostname]
+        self.version += 1
+        return service
+
+    def get(self, name: str, hostname: str) -> Optional[FleetService]:
+        return self._by_service.get(name, {}).get(hostname)
+
+    def has(self, name: str, hostname: str) -> bool:
+        return self.get(name, hostname) is not None
+
+    def txt(self, name: str, hostname: str) -> dict:
+        service = self.get(name, hostname)
+        return service.txt if service is not None else {}
+
+    def hostnames(self, services: Optional[List[str]] = None) -> List[str]:
+        if services is None:
+            return sorted(self._by_hostname)
+        hostnames: Set[str] = set()
+        for name in services:
+            hostnames.update(self._by_service.get(name, {}))
+        return sorted(hostnames)
+
+    def services(self, hostname: str) -> Dict[str, FleetService]:
+        return dict(self._by_hostname.get(hostname, {}))
+
+    def last_seen(self, hostname: str) -> Optional[float]:
+        services = self._by_hostname.get(hostname)
+        return max(s.last_seen for s in services.values()) if services else None
+
+
+def parse_service_name(sname: str) -> Tuple[Optional[str], Optional[str]]:
+    name = sname.replace(f".{DUCKIETOWN_SERVICE_TYPE}", "")
+    service_parts = name.split("::")
+    if len(service_parts) != 3 or service_parts[0] != "DT":
+        return None, None
+    return "{}::{}".format(service_parts[0], service_parts[1]), service_parts[2]
+
+
+def _parse_txt(properties: dict) -> dict:
+    # Duckietown services carry a JSON object as the only TXT key
+    try:
+        return json.loads(list(properties.keys())[0].decode("utf-8")) if len(properties) else dict()
+    except (ValueError, AttributeError):
+        return dict()
+
+
+class DiscoveryEngine:
+    """
+    Browses the Duckietown services announced on the network and keeps a FleetModel up to date.
+    Services are resolved concurrently, the callback `on_change(service, present)` is called within
+    the event loop every time the model changes.
+    """
+
+    def __init__(self, on_change: Optional[Callable[[FleetService, bool], None]] = None):
+        self.fleet = FleetModel()
+        self._on_change = on_change
+        self._aiozc: Optional[AsyncZeroconf] = None
+        self._browser: Optional[AsyncServiceBrowser] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        # resolves in progress, by (service name, hostname)
+        self._pending: Dict[Tuple[str, str], asyncio.Future] = {}
+
+    async def start(self):
+        self._semaphore = asyncio.Semaphore(RESOLVE_CONCURRENCY)
+        self._aiozc = AsyncZeroconf()
+        self._browser = AsyncServiceBrowser(
+            self._aiozc.zeroconf, [DUCKIETOWN_SERVICE_TYPE], handlers=[self._on_service_state_change]
+        )
+
+    async def stop(self):
+        tasks = list(self._pending.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._browser is not None:
+            await self._browser.async_cancel()
+        if self._aiozc is not None:
+            await self._aiozc.async_close()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *_):
+        await self.stop()
+
+    def _notify(self, service: FleetService, present: bool):
+        if self._on_change is not None:
+            self._on_change(service, present)
+
+    # NOTE: zeroconf calls the handlers with keyword arguments, the names of the arguments matter
+    def _on_service_state_change(self, zeroconf, service_type: str, name: str, state_change):
+        # this runs within the event loop, it must not block
+        service_name, hostname = parse_service_name(name)
+        dtslogger.debug(f"Zeroconf:{state_change.name} (name={service_name}, hostname={hostname})")
+        if not service_name:
+            return
+        key = (service_name, hostname)
+        # a resolve still in progress would add back a departed service (or an outdated one)
+        pending = self._pending.pop(key, None)
+        if pending is not None:
+            pending.cancel()
+        if state_change is ServiceStateChange.Removed:
+            service = self.fleet.remove(service_name, hostname)
+            if service is not None:
+                self._notify(service, False)
+            return
+        # resolve the service (TXT, port) in the background
+        task = asyncio.ensure_future(self._resolve(service_type, name, service_name, hostname))
+        self._pending[key] = task
+        task.add_done_callback(functools.partial(self._forget, key))
+
+    def _forget(self, key: Tuple[str, str], task: asyncio.Future):
+        if self._pending.get(key) is task:
+            del self._pending[key]
+
+    async def _resolve(self, service_type: str, sname: str, service_name: str, hostname: str):
+        info = AsyncServiceInfo(service_type, sname)
+        async with self._semaphore:
+            try:
+                resolved = await info.async_request(self._aiozc.zeroconf, RESOLVE_TIMEOUT_MS)
+            except Exception as e:
+                dtslogger.debug(f"Could not resolve service {sname}. Reason: {str(e)}")
+                resolved = False
+        # a service that cannot be resolved still tells us that the device is there
+        service = FleetService(
+            name=service_name,
+            hostname=hostname,
+            port=info.port if resolved else None,
+            txt=_parse_txt(info.properties) if resolved and info.properties else dict(),
+            last_seen=time.time(),
+        )
+        dtslogger.debug(f"Zeroconf:RESOLVED (name={service_name}, hostname={hostname}, data={service.txt})")
+        if self.fleet.update(service):
+            self._notify(service, True)
+
 
 def wait_for_service(target_service: str, target_hostname: str = None, timeout: int = 10):
-    # define callbacks
-    workspace = SimpleNamespace(service=target_service, hostname=target_hostname, data=None)
+    return asyncio.run(_wait_for_service(target_service, target_hostname, timeout))
+
 
-    def cb(service: str, hostname: str, data: dict):
-        if target_service == service and target_hostname == hostname:
-            workspace.data = data
-            workspace.service = service
-            workspace.hostname = hostname
+async def _wait_for_service(target_service: str, target_hostname: Optional[str], timeout: int):
+    found: List[FleetService] = []
+    event = asyncio.Event()
+
+    def cb(service: FleetService, present: bool):
+        if not present or service.name != target_service:
+            return
+        if target_hostname is None or service.hostname == target_hostname:
+            found.append(service)
+            event.set()
 
     # perform discover
-    zeroconf = Zeroconf()
-    listener = DiscoverListener(service_in_callback=cb)
-    ServiceBrowser(zeroconf, "_duckietown._tcp.local.", listener)
-    # wait
-    stime = time.time()
-    while workspace.data is None:
-        time.sleep(0.5)
-        if (timeout > 0) and (time.time() - stime > timeout):
+    async with DiscoveryEngine(on_change=cb):
+        try:
+            await asyncio.wait_for(event.wait(), timeout if timeout > 0 else None)
+        except asyncio.TimeoutError:
             msg = f"No devices matched the search criteria (service={target_service}, hostname={target_hostname})."
-            zeroconf.close()
             raise TimeoutError(msg)
-    zeroconf.close()
     # ---
-    return workspace.service, workspace.hostname, workspace.data
-
-
-class DiscoverListener:
-    def __init__(self, service_in_callback=None, service_out_callback=None):
-        self.service_in_callback = service_in_callback
-        self.service_out_callback = service_out_callback
-
-    def _process_service(self, zeroconf, type, sname):
-        name = sname.replace("._duckietown._tcp.local.", "")
-        service_parts = name.split("::")
-        if len(service_parts) != 3 or service_parts[0] != "DT":
-            return None, None, dict()
-        name = "{}::{}".format(service_parts[0], service_parts[1])
-        hostname = service_parts[2]
-        txt = dict()
-        try:
-            sinfo = zeroconf.get_service_info(type, sname)
-            txt = (
-                json.loads(list(sinfo.properties.keys())[0].decode("utf-8"))
-                if len(sinfo.properties)
-                else dict()
-            )
-        except:
-            pass
-        return name, hostname, txt
-
-    def remove_service(self, zeroconf, type, sname):
-        name, hostname, txt = self._process_service(zeroconf, type, sname)
-        dtslogger.debug(f"Zeroconf:SERVICE_OUT (name={name}, hostname={hostname}, data={txt})")
-        if not name:
-            return
-        if self.service_out_callback:
-            self.service_out_callback(name, hostname, txt)
-
-    def add_service(self, zeroconf, type, sname):
-        name, hostname, txt = self._process_service(zeroconf, type, sname)
-        dtslogger.debug(f"Zeroconf:SERVICE_IN (name={name}, hostname={hostname}, data={txt})")
-        if not name:
-            return
-        if self.service_in_callback:
-            self.service_in_callback(name, hostname, txt)
-
-    def update_service(self, *args, **kwargs):
-        # TODO: implement this
-        pass
+    return found[0].name, found[0].hostname, found[0].txt
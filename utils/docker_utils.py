@@ -1,21 +1,35 @@
+import atexit
+import collections
+import copy
+import hashlib
+import json
 import os
 import platform
 import re
 import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from os.path import expanduser
-from typing import Tuple
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
 
 import docker
+import requests
 from docker import DockerClient
-from docker.errors import NotFound
+from docker.errors import APIError, NotFound
+from docker.utils import parse_repository_tag
 
 from dt_shell import dtslogger
 from dt_shell.config import ShellConfig
 from dt_shell.env_checks import check_docker_environment
 from duckietown_docker_utils import ENV_REGISTRY
 from utils.cli_utils import start_command_in_subprocess
+from utils.misc_utils import human_size, human_time, sanitize_hostname
 from utils.networking_utils import get_duckiebot_ip
-from utils.progress_bar import ProgressBar
+from utils.progress_bar import MultiProgressBar, ProgressBar
 
 RPI_GUI_TOOLS = "duckietown/rpi-gui-tools:master18"
 RPI_DUCKIEBOT_BASE = "duckietown/rpi-duckiebot-base:master18"
@@ -25,6 +39,16 @@ RPI_ROS_KINETIC_ROSCORE = "duckietown/rpi-ros-kinetic-roscore:master18"
 SLIMREMOTE_IMAGE = "duckietown/duckietown-slimremote:testing"
 DEFAULT_DOCKER_TCP_PORT = "2375"
 DEFAULT_API_TIMEOUT = 240
+TRANSFER_CHUNK_SIZE = 1024 ** 2
+PROGRESS_REFRESH_SECS = 0.25
+DEFAULT_PULL_WORKERS = 3
+PULL_RETRIES = 3
+PULL_RETRY_BACKOFF_SECS = 2
+TRANSIENT_PULL_ERROR_PATTERN = re.compile(
+    r"timeout|timed out|connection reset|connection refused|unexpected EOF|TLS handshake|"
+    r"toomanyrequests|too many requests|50[234]",
+    re.IGNORECASE,
+)
 
 DEFAULT_MACHINE = "unix:///var/run/docker.sock"
 DEFAULT_REGISTRY = "docker.io"
@@ -38,6 +62,24 @@ Docker Endpoint:
   Total Memory: {MemTotal}
   CPUs: {NCPU}
 """
+ENDPOINT_INFO_CACHE_FILE = os.path.join(expanduser("~"), ".dt-shell", "cache", "docker_endpoints.json")
+ENDPOINT_INFO_TTL_SECS = 24 * 60 * 60
+ENDPOINT_INFO_KEYS = [
+    "ID",
+    "Name",
+    "OperatingSystem",
+    "KernelVersion",
+    "OSType",
+    "Architecture",
+    "MemTotal",
+    "NCPU",
+]
+_endpoint_info_lock = threading.Lock()
+_endpoint_info_memo: Dict[str, dict] = {}
+_clients: Dict[Tuple[str, int], DockerClient] = {}
+_clients_metrics: Dict[str, dict] = {}
+_clients_logins = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
 
 
 def get_registry_to_use() -> str:
@@ -68,11 +110,73 @@ def get_docker_auth_from_env() -> Tuple[str, str]:
     return registry_username, registry_token
 
 
+def _endpoint_url(endpoint=None) -> str:
+    if endpoint is None:
+        return os.environ.get("DOCKER_HOST", DEFAULT_MACHINE)
+    if isinstance(endpoint, DockerClient):
+        return endpoint.api.base_url
+    return sanitize_docker_baseurl(endpoint)
+
+
+def _load_endpoint_info_cache() -> dict:
+    try:
+        with open(ENDPOINT_INFO_CACHE_FILE, "rt") as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_endpoint_info_cache(cache: dict):
+    tmp_file = f"{ENDPOINT_INFO_CACHE_FILE}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(ENDPOINT_INFO_CACHE_FILE), exist_ok=True)
+        with open(tmp_file, "wt") as fout:
+            json.dump(cache, fout, indent=4, sort_keys=True)
+        os.replace(tmp_file, ENDPOINT_INFO_CACHE_FILE)
+    except OSError as e:
+        dtslogger.debug(f"Could not write the Docker endpoints cache. Reason: {str(e)}")
+
+
+def get_endpoint_info(endpoint=None, refresh: bool = False) -> dict:
+    """
+    Returns the subset ENDPOINT_INFO_KEYS of `docker info` for the given endpoint.
+    Answers are memoized within the process and cached on disk for ENDPOINT_INFO_TTL_SECS, keyed by
+    endpoint URL and engine ID. Every fresh answer is checked against the cached engine ID, the info of
+    an engine that is not behind the endpoint anymore (e.g., a reflashed robot) is dropped.
+    """
+    url = _endpoint_url(endpoint)
+    if not refresh:
+        with _endpoint_info_lock:
+            info = _endpoint_info_memo.get(url)
+            if info is None:
+                for entry in _load_endpoint_info_cache().values():
+                    if entry.get("url") == url and time.time() - entry["time"] < ENDPOINT_INFO_TTL_SECS:
+                        dtslogger.debug(f"Using cached info for Docker endpoint {url}.")
+                        info = _endpoint_info_memo[url] = entry["info"]
+                        break
+        if info is not None:
+            return dict(info)
+    info = get_client(endpoint).info()
+    if "ServerErrors" in info:
+        return info
+    info = {key: info.get(key) for key in ENDPOINT_INFO_KEYS}
+    key = f"{url}#{info['ID']}"
+    with _endpoint_info_lock:
+        cache = _load_endpoint_info_cache()
+        # a single engine is behind an endpoint at any given time
+        for stale in [k for k, entry in cache.items() if k != key and (entry.get("url") == url or k == url)]:
+            dtslogger.debug(f"The Docker engine at {url} changed, dropping its cached info.")
+            del cache[stale]
+        cache[key] = {"url": url, "id": info["ID"], "time": time.time(), "info": info}
+        _save_endpoint_info_cache(cache)
+        _endpoint_info_memo[url] = info
+    return dict(info)
+
+
 def get_endpoint_ncpus(epoint=None):
-    client = get_client(epoint)
     epoint_ncpus = 1
     try:
-        epoint_ncpus = client.info()["NCPU"]
+        epoint_ncpus = get_endpoint_info(epoint)["NCPU"]
         dtslogger.debug(f"NCPU set to {epoint_ncpus}.")
     except BaseException:
         dtslogger.warning(
@@ -85,12 +189,8 @@ def get_endpoint_ncpus(epoint=None):
 def get_endpoint_architecture(hostname=None, port=DEFAULT_DOCKER_TCP_PORT):
     from utils.dtproject_utils import CANONICAL_ARCH
 
-    client = (
-        docker.from_env()
-        if hostname is None
-        else docker.DockerClient(base_url=sanitize_docker_baseurl(hostname, port))
-    )
-    epoint_arch = client.info()["Architecture"]
+    endpoint = None if hostname is None else sanitize_docker_baseurl(hostname, port)
+    epoint_arch = get_endpoint_info(endpoint)["Architecture"]
     if epoint_arch not in CANONICAL_ARCH:
         dtslogger.error(f"Architecture {epoint_arch} not supported!")
         exit(1)
@@ -106,31 +206,66 @@ def sanitize_docker_baseurl(baseurl: str, port=DEFAULT_DOCKER_TCP_PORT):
         return f"tcp://{baseurl}:{port}"
 
 
-def get_client(endpoint=None):
-    if endpoint is None:
-        client = docker.from_env(timeout=DEFAULT_API_TIMEOUT)
-    else:
-        # create client
-        client = (
-            endpoint
-            if isinstance(endpoint, docker.DockerClient)
-            else docker.DockerClient(base_url=sanitize_docker_baseurl(endpoint), timeout=DEFAULT_API_TIMEOUT)
-        )
+def _count_request(base_url: str):
+    def _hook(response, *_, **__):
+        with _clients_lock:
+            metrics = _clients_metrics.setdefault(
+                base_url, {"requests": 0, "errors": 0, "time": 0.0, "clients": 0}
+            )
+            metrics["requests"] += 1
+            metrics["errors"] += int(response.status_code >= 400)
+            metrics["time"] += response.elapsed.total_seconds()
 
-    # FIXME: AFD to review
-    # AC: Note the client is not registry-specific, don't try to login here.
-    # AC: not the place to do it - note that we also would need to login to multiple registries in some cases
-    # (try to) login
-    # try:
-    #     _login_client(client, registry=registry)
-    # except BaseException:
-    #     dtslogger.warning(f"An error occurred while trying to login to Docker registry {registry!r}.")
-    # # ---
+    return _hook
+
+
+def get_client(endpoint=None, timeout: int = DEFAULT_API_TIMEOUT) -> DockerClient:
+    """
+    Returns the Docker client for the given endpoint. Clients are shared within the process,
+    one per (base_url, timeout), so that they reuse the same connection pool and login state.
+    """
+    if isinstance(endpoint, DockerClient):
+        return endpoint
+    base_url = _endpoint_url(endpoint)
+    key = (base_url, timeout)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            if endpoint is None:
+                # from_env also picks up the TLS configuration of the environment
+                client = docker.from_env(timeout=timeout)
+            else:
+                client = docker.DockerClient(base_url=base_url, timeout=timeout)
+            # the low-level client is a requests' Session, count the requests it makes
+            client.api.hooks["response"].append(_count_request(base_url))
+            _clients[key] = client
+            _clients_metrics.setdefault(base_url, {"requests": 0, "errors": 0, "time": 0.0, "clients": 0})
+            _clients_metrics[base_url]["clients"] += 1
     return client
 
 
+def get_clients_metrics() -> Dict[str, dict]:
+    """
+    Returns, for every Docker endpoint used by this process, the number of clients created and the
+    number of requests made, failed and the time spent waiting for them.
+    """
+    with _clients_lock:
+        return copy.deepcopy(_clients_metrics)
+
+
+def _log_clients_metrics():
+    for base_url, metrics in get_clients_metrics().items():
+        dtslogger.debug(
+            f"Docker endpoint {base_url}: {metrics['requests']} requests ({metrics['errors']} failed) "
+            f"in {metrics['time']:.2f}s over {metrics['clients']} client(s)"
+        )
+
+
+atexit.register(_log_clients_metrics)
+
+
 def get_remote_client(duckiebot_ip: str, port: str = DEFAULT_DOCKER_TCP_PORT) -> DockerClient:
-    client = docker.DockerClient(base_url=f"tcp://{duckiebot_ip}:{port}")
+    client = get_client(sanitize_docker_baseurl(duckiebot_ip, port))
     # FIXME: AFD to review
     try:
         env_username, env_password = get_docker_auth_from_env()
@@ -193,57 +328,272 @@ def login_client(client: DockerClient, shell_config: ShellConfig, registry: str,
 
 def _login_client(client: DockerClient, registry: str, username: str, password: str, raise_on_error: bool):
     """Raises CouldNotLogin"""
+    # shared clients keep their login state, there is no need to login again
+    logins = _clients_logins.setdefault(client, set())
+    if (registry, username, password) in logins:
+        dtslogger.debug(f"Already logged in to {registry} as {username!r}.")
+        return
     password_hidden = hide_string(password)
     dtslogger.info(f"Logging in to {registry} as {username!r} with secret {password_hidden!r}`")
     res = client.login(username=username, password=password, registry=registry, reauth=True)
     dtslogger.debug(f"login response: {res}")
     # Status': 'Login Succeeded'
     if res.get("Status", None) == "Login Succeeded":
-        pass
+        logins.add((registry, username, password))
     else:
         if raise_on_error:
             raise CouldNotLogin(f"Could not login to {registry!r}: {res}")
     # TODO: check for error
 
 
-# TODO quick hack to make this work - duplication of code above bad
 def get_endpoint_architecture_from_ip(duckiebot_ip, *, port: str = DEFAULT_DOCKER_TCP_PORT) -> str:
-    from utils.dtproject_utils import CANONICAL_ARCH
+    return get_endpoint_architecture(duckiebot_ip, port=port)
 
-    client = get_remote_client(duckiebot_ip=duckiebot_ip, port=port)
-    epoint_arch = client.info()["Architecture"]
-    if epoint_arch not in CANONICAL_ARCH:
-        dtslogger.error(f"Architecture {epoint_arch} not supported!")
-        exit(1)
-    return CANONICAL_ARCH[epoint_arch]
 
+class ImageProgress(object):
+    """
+    Aggregates the per-layer `progressDetail` of a pull or push stream into bytes transferred,
+    bytes extracted (pull only), throughput and ETA.
+    """
+
+    def __init__(self, image: str, action: str = "pull"):
+        self.image = image
+        self.action = action
+        self.layers: Dict[str, dict] = {}
+        self.started = time.time()
+        self._first_byte = None
+        self._first_extracted = None
+
+    def _layer(self, layer_id: str) -> dict:
+        if layer_id not in self.layers:
+            self.layers[layer_id] = {
+                "total": 0,
+                "transferred": 0,
+                "extracted": 0,
+                "done": False,
+                "skip": False,
+            }
+        return self.layers[layer_id]
+
+    def update(self, line: dict) -> bool:
+        """
+        Consumes one line of the stream, returns whether the progress changed.
+        """
+        if "id" not in line or "status" not in line:
+            return False
+        layer = self._layer(line["id"])
+        status = line["status"]
+        detail = line.get("progressDetail") or {}
+        now = time.time()
+        if status in ["Downloading", "Pushing"] and "current" in detail:
+            layer["total"] = detail.get("total") or layer["total"]
+            layer["transferred"] = detail["current"]
+            self._first_byte = self._first_byte or now
+        elif status == "Extracting" and "current" in detail:
+            layer["total"] = detail.get("total") or layer["total"]
+            layer["transferred"] = layer["total"]
+            layer["extracted"] = detail["current"]
+            self._first_extracted = self._first_extracted or now
+        elif status in ["Download complete", "Verifying Checksum"]:
+            layer["transferred"] = layer["total"]
+        elif status in ["Pull complete", "Pushed"]:
+            layer["transferred"] = layer["extracted"] = layer["total"]
+            layer["done"] = True
+        elif status in ["Already exists", "Layer already exists"] or status.startswith("Mounted from"):
+            # nothing to transfer for this layer
+            layer["done"] = layer["skip"] = True
+        else:
+            return False
+        return True
 
-def pull_image(image: str, endpoint: str = None, progress=True):
+    @property
+    def total_bytes(self) -> int:
+        return sum(layer["total"] for layer in self.layers.values() if not layer["skip"])
+
+    @property
+    def transferred_bytes(self) -> int:
+        return sum(layer["transferred"] for layer in self.layers.values() if not layer["skip"])
+
+    @property
+    def extracted_bytes(self) -> int:
+        return sum(layer["extracted"] for layer in self.layers.values() if not layer["skip"])
+
+    @property
+    def percentage(self) -> float:
+        if not self.layers:
+            return 0.0
+        fractions = []
+        for layer in self.layers.values():
+            if layer["done"]:
+                fractions.append(1.0)
+                continue
+            total = max(1, layer["total"])
+            if self.action == "pull":
+                # downloading and extracting weigh the same
+                fractions.append(0.5 * (layer["transferred"] + layer["extracted"]) / total)
+            else:
+                fractions.append(layer["transferred"] / total)
+        return 100.0 * sum(fractions) / len(fractions)
+
+    @staticmethod
+    def _rate(nbytes: int, since: Optional[float]) -> float:
+        if since is None:
+            return 0.0
+        return nbytes / max(0.001, time.time() - since)
+
+    @property
+    def throughput(self) -> float:
+        return self._rate(self.transferred_bytes, self._first_byte)
+
+    @property
+    def extraction_throughput(self) -> float:
+        return self._rate(self.extracted_bytes, self._first_extracted)
+
+    @property
+    def eta(self) -> Optional[float]:
+        rate = self.throughput
+        if rate <= 0:
+            return None
+        remaining = (self.total_bytes - self.transferred_bytes) / rate
+        if self.action == "pull":
+            erate = self.extraction_throughput or rate
+            remaining = max(remaining, (self.total_bytes - self.extracted_bytes) / erate)
+        return max(0.0, remaining)
+
+    def summary(self) -> str:
+        parts = [
+            f"{human_size(self.transferred_bytes, precision=1)}/{human_size(self.total_bytes, precision=1)}",
+            f"{human_size(self.throughput, precision=1)}/s",
+        ]
+        if self.action == "pull" and self._first_extracted is not None:
+            parts.append(f"extracting {human_size(self.extraction_throughput, precision=1)}/s")
+        eta = self.eta
+        if eta is not None:
+            parts.append(f"ETA {human_time(eta, compact=True)}")
+        return " | ".join(parts)
+
+
+def _progress_bar_callback(pbar: ProgressBar):
+    last = [0.0]
+
+    def _callback(progress: ImageProgress):
+        # redraw at most a few times per second
+        if time.time() - last[0] < PROGRESS_REFRESH_SECS:
+            return
+        last[0] = time.time()
+        # more layers might show up, the bar is completed once the stream is over
+        pbar.update(min(99.0, progress.percentage), progress.summary())
+
+    return _callback
+
+
+def pull_image(image: str, endpoint: str = None, progress=True, callback=None) -> ImageProgress:
+    """
+    Pulls an image, `callback` (if given) is called with an ImageProgress every time the progress changes.
+    """
     client = get_client(endpoint)
-    layers = set()
-    pulled = set()
+    status = ImageProgress(image, "pull")
     pbar = ProgressBar() if progress else None
+    callbacks = [c for c in [callback, _progress_bar_callback(pbar) if progress else None] if c]
     for line in client.api.pull(image, stream=True, decode=True):
-        if "id" not in line or "status" not in line:
+        if "error" in line:
+            raise ImagePullError(f"Cannot pull image {image}:\n{line['error']}")
+        if not status.update(line):
             continue
-        layer_id = line["id"]
-        layers.add(layer_id)
-        if line["status"] in ["Already exists", "Pull complete"]:
-            pulled.add(layer_id)
-        # update progress bar
-        if progress:
-            percentage = max(0.0, min(1.0, len(pulled) / max(1.0, len(layers)))) * 100.0
-            pbar.update(percentage)
+        for c in callbacks:
+            c(status)
     if progress:
-        pbar.done()
+        pbar.update(100, status.summary())
+    dtslogger.debug(f"Pulled {image}: {status.summary()}")
+    return status
 
 
-def push_image(image: str, endpoint=None, progress=True) -> str:
+class ImagePullError(Exception):
+    pass
+
+
+def _is_transient_error(error: BaseException) -> bool:
+    if isinstance(error, NotFound):
+        return False
+    if isinstance(error, APIError) and error.status_code is not None:
+        return error.status_code >= 500 or error.status_code == 429
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    return TRANSIENT_PULL_ERROR_PATTERN.search(str(error)) is not None
+
+
+def pull_images(
+    images: List[Union[str, Tuple[str, Any]]],
+    endpoint=None,
+    workers: int = DEFAULT_PULL_WORKERS,
+    retries: int = PULL_RETRIES,
+    progress=True,
+) -> Dict[Tuple[str, str], ImageProgress]:
+    """
+    Pulls many images at once. Images are either names, pulled on `endpoint`, or (name, endpoint) pairs.
+    Duplicates are pulled once, at most `workers` images are pulled at the same time on each endpoint.
+    Layers shared by images being pulled together are downloaded only once by the engine.
+    Transient errors (e.g., registry timeouts, 5xx, rate limits) are retried with exponential backoff,
+    the first error that persists is raised once all the other pulls are over.
+    """
+    jobs = collections.OrderedDict()
+    for item in images:
+        image, image_endpoint = (item, endpoint) if isinstance(item, str) else item
+        jobs.setdefault((_endpoint_url(image_endpoint), image), image_endpoint)
+    if not jobs:
+        return {}
+    endpoints = sorted({url for url, _ in jobs})
+    labels = {key: key[1] if len(endpoints) == 1 else f"{key[1]} @ {key[0]}" for key in jobs}
+    pbar = MultiProgressBar(labels.values()) if progress else None
+    lock = threading.Lock()
+    last_draw = [0.0]
+
+    def _report(key, percentage, info, force=False):
+        if pbar is None:
+            return
+        with lock:
+            pbar.update(labels[key], percentage, f"({info})")
+            if force or time.time() - last_draw[0] >= PROGRESS_REFRESH_SECS:
+                pbar.draw()
+                last_draw[0] = time.time()
+
+    def _pull(key):
+        _, image = key
+        for attempt in range(retries + 1):
+            try:
+                if pbar is None:
+                    dtslogger.info(f"Pulling image `{image}`...")
+                status = pull_image(
+                    image,
+                    jobs[key],
+                    progress=False,
+                    callback=lambda s: _report(key, min(99.0, s.percentage), s.summary()),
+                )
+                _report(key, 100, f"done, {human_size(status.total_bytes, precision=1)}", force=True)
+                return status
+            except BaseException as e:
+                if attempt >= retries or not _is_transient_error(e):
+                    _report(key, 0, "failed", force=True)
+                    raise
+                delay = PULL_RETRY_BACKOFF_SECS * 2 ** attempt
+                dtslogger.debug(f"Error pulling `{image}`, retrying in {delay}s. The error reads:\n{e}")
+                _report(key, 0, f"retrying in {delay}s ({attempt + 1}/{retries})", force=True)
+                time.sleep(delay)
+
+    # one pool per endpoint, a busy endpoint does not hold back the others
+    executors = {url: ThreadPoolExecutor(max_workers=max(1, workers)) for url in endpoints}
+    futures = collections.OrderedDict((key, executors[key[0]].submit(_pull, key)) for key in jobs)
+    for executor in executors.values():
+        executor.shutdown(wait=True)
+    return {key: future.result() for key, future in futures.items()}
+
+
+def push_image(image: str, endpoint=None, progress=True, callback=None) -> str:
     client = get_client(endpoint)
 
-    layers = set()
-    pushed = set()
+    status = ImageProgress(image, "push")
     pbar = ProgressBar() if progress else None
+    callbacks = [c for c in [callback, _progress_bar_callback(pbar) if progress else None] if c]
     final_digest = None
     for line in client.api.push(*image.split(":"), stream=True, decode=True):
         if "error" in line:
@@ -260,16 +610,12 @@ def push_image(image: str, endpoint=None, progress=True) -> str:
                 print(line["status"])
                 continue
             continue
-        layer_id = line["id"]
-        layers.add(layer_id)
-        if line["status"] in ["Layer already exists", "Pushed"]:
-            pushed.add(layer_id)
-        # update progress bar
-        if progress:
-            percentage = max(0.0, min(1.0, len(pushed) / max(1.0, len(layers)))) * 100.0
-            pbar.update(percentage)
+        if not status.update(line):
+            continue
+        for c in callbacks:
+            c(status)
     if progress:
-        pbar.done()
+        pbar.update(100, status.summary())
     if final_digest is None:
         msg = "Expected to get final digest, but none arrived "
         dtslogger.warning(msg)
@@ -278,10 +624,128 @@ def push_image(image: str, endpoint=None, progress=True) -> str:
     return final_digest
 
 
+def _chain_ids(diff_ids: List[str]) -> List[str]:
+    # a layer is identified by its content and by all the layers below it
+    chain_ids = []
+    for diff_id in diff_ids:
+        if chain_ids:
+            diff_id = "sha256:" + hashlib.sha256(f"{chain_ids[-1]} {diff_id}".encode("utf-8")).hexdigest()
+        chain_ids.append(diff_id)
+    return chain_ids
+
+
+def _endpoint_chain_ids(client: DockerClient) -> Set[str]:
+    chain_ids = set()
+    for summary in client.api.images():
+        try:
+            attrs = client.api.inspect_image(summary["Id"])
+        except NotFound:
+            continue
+        chain_ids.update(_chain_ids(attrs.get("RootFS", {}).get("Layers", [])))
+    return chain_ids
+
+
+class _ChunksReader(object):
+    # file-like view over a generator of bytes
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def transfer_image(image: str, origin=None, destination=None, progress=True) -> int:
+    """
+    Copies an image from the origin to the destination Docker engine, like
+    `docker save | docker load` would, but without sending the layers the destination already has.
+    Returns the number of bytes sent to the destination.
+    """
+    origin_client = get_client(origin)
+    destination_client = get_client(destination)
+    image_attrs = origin_client.api.inspect_image(image)
+    image_id, diff_ids = image_attrs["Id"], image_attrs["RootFS"]["Layers"]
+    # the destination might have the very same image, under a different name
+    try:
+        destination_client.api.inspect_image(image_id)
+        repository, tag = parse_repository_tag(image)
+        destination_client.api.tag(image_id, repository, tag or "latest")
+        dtslogger.info(f"The destination already has the image {image}.")
+        return 0
+    except NotFound:
+        pass
+    # a layer can be skipped only if all the layers below it are on the destination as well
+    present = _endpoint_chain_ids(destination_client)
+    skip = 0
+    for chain_id in _chain_ids(diff_ids):
+        if chain_id not in present:
+            break
+        skip += 1
+    with tempfile.TemporaryDirectory(prefix="dts-transfer-") as tmpdir:
+        with tarfile.open(fileobj=_ChunksReader(origin_client.api.get_image(image)), mode="r|") as tar:
+            tar.extractall(tmpdir)
+        with open(os.path.join(tmpdir, "manifest.json"), "rt") as fin:
+            layers = json.load(fin)[0]["Layers"]
+        # the engine does not read the layers it already has, they can be left out of the archive
+        skipped = set(layers[:skip])
+        sizes = {layer: os.path.getsize(os.path.join(tmpdir, layer)) for layer in layers}
+        total = sum(os.path.getsize(os.path.join(root, f)) for root, _, fs in os.walk(tmpdir) for f in fs)
+        to_send = total - sum(sizes[layer] for layer in skipped)
+        dtslogger.info(
+            f"Transferring {human_size(to_send)} of {human_size(total)}, "
+            f"{len(skipped)}/{len(layers)} layers are already on the destination."
+        )
+        read_fd, write_fd = os.pipe()
+        errors = []
+
+        def _archive():
+            try:
+                with os.fdopen(write_fd, "wb") as fout, tarfile.open(fileobj=fout, mode="w|") as tar:
+                    for entry in sorted(os.listdir(tmpdir)):
+                        tar.add(
+                            os.path.join(tmpdir, entry),
+                            arcname=entry,
+                            filter=lambda info: None if info.name in skipped else info,
+                        )
+            except BaseException as e:
+                errors.append(e)
+
+        def _chunks():
+            sent = 0
+            pbar = ProgressBar() if progress else None
+            with os.fdopen(read_fd, "rb") as fin:
+                while True:
+                    chunk = fin.read(TRANSFER_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sent += len(chunk)
+                    if progress:
+                        pbar.update(min(100.0, 100.0 * sent / max(1, to_send)))
+                    yield chunk
+            if progress:
+                pbar.done()
+
+        writer = threading.Thread(target=_archive, daemon=True)
+        writer.start()
+        for line in destination_client.api.load_image(_chunks()):
+            if "error" in line:
+                raise Exception(f"Cannot load image {image} on the destination:\n{line['error']}")
+        writer.join()
+        if errors:
+            raise errors[0]
+    return to_send
+
+
 def push_image_to_duckiebot(image_name, hostname):
-    # If password required, we need to configure with sshpass
-    command = f"docker save {image_name} | gzip | pv | ssh -C duckie@{hostname}.local docker load"
-    subprocess.check_output(["/bin/sh", "-c", command])
+    transfer_image(image_name, destination=sanitize_hostname(hostname))
 
 
 def logs_for_container(client, container_id):
@@ -1,20 +1,20 @@
+import configparser
 import copy
-import json
 import os
 import random
 import re
 import subprocess
 import traceback
+import zlib
 from types import SimpleNamespace
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 
-import docker
-import requests
 import yaml
 from docker.errors import APIError, ImageNotFound
 
 from dt_shell import UserError
-from utils.docker_utils import sanitize_docker_baseurl
+from utils.docker_utils import get_client
+from utils.registry_utils import RemoteImage, get_registry_client
 
 REQUIRED_METADATA_KEYS = {"*": ["TYPE_VERSION"], "1": ["TYPE", "VERSION"], "2": ["TYPE", "VERSION"]}
 
@@ -79,42 +79,66 @@ TEMPLATE_TO_LAUNCHFILE = {
 
 DISTRO_KEY = {"1": "MAJOR", "2": "DISTRO"}
 
-DOCKER_HUB_API_URL = {
-    "token": "https://auth.docker.io/token?scope=repository:{image}:pull&service=registry.docker.io",
-    "digest": "https://registry-1.docker.io/v2/{image}/manifests/{tag}",
-    "inspect": "https://registry-1.docker.io/v2/{image}/blobs/{digest}",
-}
+# projects, keyed by path
+_projects: Dict[str, "DTProject"] = {}
+
+# git metadata of the projects, keyed by (path, mtime of HEAD, mtime of the current branch, mtime of index)
+_repo_info_cache: Dict[tuple, dict] = {}
 
 
 class DTProject:
+    """
+    Adapters are lazy, the metadata of a project is loaded the first time it is needed and reloaded only
+    when the files it comes from change. This makes instances cheap to create and safe to share, see
+    `get_project`.
+    """
+
     def __init__(self, path: str):
-        self._adapters = []
-        self._repository = None
-        # use `fs` adapter by default
         self._path = os.path.abspath(path)
-        self._adapters.append("fs")
+        self._project_info = None
+        self._project_info_key = None
+        self._configurations = None
+        self._configurations_key = None
+
+    @property
+    def _dtproject(self) -> dict:
         # use `dtproject` adapter (required)
-        self._project_info = self._get_project_info(self._path)
-        self._type = self._project_info["TYPE"]
-        self._type_version = self._project_info["TYPE_VERSION"]
-        self._version = self._project_info["VERSION"]
-        self._adapters.append("dtproject")
+        key = _mtime(os.path.join(self._path, ".dtproject"))
+        if self._project_info is None or key != self._project_info_key:
+            self._project_info = self._get_project_info(self._path)
+            self._project_info_key = key
+        return self._project_info
+
+    @property
+    def _repository(self) -> Optional[SimpleNamespace]:
         # use `git` adapter if available
-        if os.path.isdir(os.path.join(self._path, ".git")):
-            repo_info = self._get_repo_info(self._path)
-            self._repository = SimpleNamespace(
-                name=repo_info["REPOSITORY"],
-                sha=repo_info["SHA"],
-                detached=repo_info["BRANCH"] == "HEAD",
-                branch=repo_info["BRANCH"],
-                head_version=repo_info["VERSION.HEAD"],
-                closest_version=repo_info["VERSION.CLOSEST"],
-                repository_url=repo_info["ORIGIN.URL"],
-                repository_page=repo_info["ORIGIN.HTTPS.URL"],
-                index_nmodified=repo_info["INDEX_NUM_MODIFIED"],
-                index_nadded=repo_info["INDEX_NUM_ADDED"],
-            )
-            self._adapters.append("git")
+        if not os.path.isdir(os.path.join(self._path, ".git")):
+            return None
+        repo_info = self._get_repo_info(self._path)
+        return SimpleNamespace(
+            name=repo_info["REPOSITORY"],
+            sha=repo_info["SHA"],
+            detached=repo_info["BRANCH"] == "HEAD",
+            branch=repo_info["BRANCH"],
+            head_version=repo_info["VERSION.HEAD"],
+            closest_version=repo_info["VERSION.CLOSEST"],
+            repository_url=repo_info["ORIGIN.URL"],
+            repository_page=repo_info["ORIGIN.HTTPS.URL"],
+            index_nmodified=repo_info["INDEX_NUM_MODIFIED"],
+            index_nadded=repo_info["INDEX_NUM_ADDED"],
+        )
+
+    @property
+    def _type(self):
+        return self._dtproject["TYPE"]
+
+    @property
+    def _type_version(self):
+        return self._dtproject["TYPE_VERSION"]
+
+    @property
+    def _version(self):
+        return self._dtproject["VERSION"]
 
     @property
     def path(self):
@@ -162,7 +186,11 @@ class DTProject:
 
     @property
     def adapters(self):
-        return copy.copy(self._adapters)
+        # `fs` adapter is always used, `dtproject` adapter is required
+        adapters = ["fs", "dtproject"]
+        if os.path.isdir(os.path.join(self._path, ".git")):
+            adapters.append("git")
+        return adapters
 
     def is_release(self):
         if not self.is_clean():
@@ -277,13 +305,17 @@ class DTProject:
                 "types v2. Your project does not support them."
             )
         # ---
-        configurations = {}
-        if self._type_version == "2":
-            configurations_file = os.path.join(self._path, "configurations.yaml")
-            if os.path.isfile(configurations_file):
-                configurations = _parse_configurations(configurations_file)
+        configurations_file = os.path.join(self._path, "configurations.yaml")
+        key = (self._type_version, _mtime(configurations_file))
+        if self._configurations is None or key != self._configurations_key:
+            configurations = {}
+            if self._type_version == "2":
+                if os.path.isfile(configurations_file):
+                    configurations = _parse_configurations(configurations_file)
+            self._configurations = configurations
+            self._configurations_key = key
         # ---
-        return configurations
+        return copy.deepcopy(self._configurations)
 
     def configuration(self, name: str) -> dict:
         configurations = self.configurations()
@@ -324,7 +356,7 @@ class DTProject:
         registry: str,
         version: str
     ):
-        client = _docker_client(endpoint)
+        client = get_client(endpoint)
         image_name = self.image(arch=arch, owner=owner, version=version, registry=registry)
         try:
             image = client.images.get(image_name)
@@ -341,7 +373,7 @@ class DTProject:
         registry: str,
         version: str
     ):
-        client = _docker_client(endpoint)
+        client = get_client(endpoint)
         image_name = self.image(arch=arch, owner=owner, version=version, registry=registry)
         try:
             image = client.images.get(image_name)
@@ -349,11 +381,25 @@ class DTProject:
         except (APIError, ImageNotFound):
             return None
 
-    def remote_image_metadata(self, arch: str, owner: str, registry: str):
+    def remote_image_metadata(self, arch: str, owner: str, registry: str, version: Optional[str] = None):
         assert_canonical_arch(arch)
         image = f"{registry}/{owner}/{self.name}"
-        tag = f"{self.version_name}-{arch}"
-        return self.inspect_remote_image(image, tag)
+        tag = f"{version or self.version_name}-{arch}"
+        return self.inspect_remote_image(image, tag, arch=arch)
+
+    def remote_images(
+        self, archs: List[str], owner: str, registry: str, version: Optional[str] = None
+    ) -> Dict[str, Optional[RemoteImage]]:
+        """
+        Inspects the remote images of the project for the given architectures all at once.
+        Returns {arch: RemoteImage}, images that do not exist (or cannot be inspected) map to None.
+        """
+        for arch in archs:
+            assert_canonical_arch(arch)
+        image = f"{registry}/{owner}/{self.name}"
+        tags = {arch: f"{version or self.version_name}-{arch}" for arch in archs}
+        remote = get_registry_client().inspect_many([(image, tags[arch], arch) for arch in archs])
+        return {arch: remote[(image, tags[arch], arch)] for arch in archs}
 
     @staticmethod
     def _get_project_info(path):
@@ -395,71 +441,32 @@ class DTProject:
 
     @staticmethod
     def _get_repo_info(path):
-        sha = _run_cmd(["git", "-C", f'"{path}"', "rev-parse", "HEAD"])[0]
-        branch = _run_cmd(["git", "-C", f'"{path}"', "rev-parse", "--abbrev-ref", "HEAD"])[0]
-        head_tag = _run_cmd(
-            [
-                "git",
-                "-C",
-                f'"{path}"',
-                "describe",
-                "--exact-match",
-                "--tags",
-                "HEAD",
-                "2>/dev/null",
-                "||",
-                ":",
-            ]
+        gitdir = os.path.join(path, ".git")
+        # a new commit moves the branch, a checkout moves HEAD, staging/committing rewrites the index
+        key = (
+            path,
+            _mtime(os.path.join(gitdir, "HEAD")),
+            _mtime(os.path.join(gitdir, _read_symbolic_ref(gitdir) or "HEAD")),
+            _mtime(os.path.join(gitdir, "index")),
         )
-        head_tag = head_tag[0] if head_tag else "ND"
-        closest_tag = _run_cmd(["git", "-C", f'"{path}"', "tag"])
-        closest_tag = closest_tag[-1] if closest_tag else "ND"
-        origin_url = _run_cmd(["git", "-C", f'"{path}"', "config", "--get", "remote.origin.url"])[0]
-        if origin_url.endswith(".git"):
-            origin_url = origin_url[:-4]
-        if origin_url.endswith("/"):
-            origin_url = origin_url[:-1]
-        repo = origin_url.split("/")[-1]
-        # get info about current git INDEX
-        porcelain = ["git", "-C", f'"{path}"', "status", "--porcelain"]
-        modified = _run_cmd(porcelain + ["--untracked-files=no"])
-        nmodified = len(modified)
-        added = _run_cmd(porcelain)
-        # we are not counting files with .resolved extension
-        added = list(filter(lambda f: not f.endswith(".resolved"), added))
-        nadded = len(added)
-        # return info
-        return {
-            "REPOSITORY": repo,
-            "SHA": sha,
-            "BRANCH": branch,
-            "VERSION.HEAD": head_tag,
-            "VERSION.CLOSEST": closest_tag,
-            "ORIGIN.URL": origin_url,
-            "ORIGIN.HTTPS.URL": _remote_url_to_https(origin_url),
-            "INDEX_NUM_MODIFIED": nmodified,
-            "INDEX_NUM_ADDED": nadded,
-        }
+        if key not in _repo_info_cache:
+            _repo_info_cache[key] = _read_repo_info(path)
+        return copy.deepcopy(_repo_info_cache[key])
 
     @staticmethod
-    def inspect_remote_image(image, tag):
-        res = requests.get(DOCKER_HUB_API_URL["token"].format(image=image)).json()
-        token = res["token"]
-        # ---
-        res = requests.get(
-            DOCKER_HUB_API_URL["digest"].format(image=image, tag=tag),
-            headers={
-                "Accept": "application/vnd.docker.distribution.manifest.v2+json",
-                "Authorization": "Bearer {0}".format(token),
-            },
-        ).text
-        digest = json.loads(res)["config"]["digest"]
-        # ---
-        res = requests.get(
-            DOCKER_HUB_API_URL["inspect"].format(image=image, tag=tag, digest=digest),
-            headers={"Authorization": "Bearer {0}".format(token)},
-        ).json()
-        return res
+    def inspect_remote_image(image, tag, arch: Optional[str] = None):
+        return get_registry_client().image_config(image, tag, arch=arch)
+
+
+def get_project(path: str) -> DTProject:
+    """
+    Returns the DTProject instance for the given path, the same instance is shared by all the commands
+    executed within the same process (e.g., `devel build` -> `devel info` -> `devel push`).
+    """
+    path = os.path.abspath(path)
+    if path not in _projects:
+        _projects[path] = DTProject(path)
+    return _projects[path]
 
 
 def assert_canonical_arch(arch):
@@ -500,6 +507,173 @@ def _remote_url_to_https(remote_url):
     return remote_url
 
 
+def _mtime(path: str) -> Optional[float]:
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _read_symbolic_ref(gitdir: str) -> Optional[str]:
+    try:
+        with open(os.path.join(gitdir, "HEAD"), "rt") as fin:
+            head = fin.read().strip()
+    except OSError:
+        return None
+    return head[5:].strip() if head.startswith("ref:") else None
+
+
+def _read_tags(gitdir: str) -> Dict[str, Tuple[str, Optional[str]]]:
+    """
+    Returns the tags of a repository as {name: (sha, peeled_sha)}, the peeled SHA is the commit an
+    annotated tag points to (the tag's own SHA for lightweight tags), if known.
+    """
+    tags = {}
+    # packed refs first, loose refs take precedence
+    try:
+        with open(os.path.join(gitdir, "packed-refs"), "rt") as fin:
+            # with the (fully-)peeled trait, packed tags with no peeled line are lightweight tags
+            peeled = False
+            last = None
+            for line in fin:
+                line = line.strip()
+                if line.startswith("# pack-refs with:"):
+                    traits = line.split(":", 1)[1].split()
+                    peeled = "peeled" in traits or "fully-peeled" in traits
+                    continue
+                if line.startswith("^") and last is not None:
+                    tags[last] = (tags[last][0], line[1:])
+                    continue
+                last = None
+                parts = line.split(" ", 1)
+                if len(parts) == 2 and parts[1].startswith("refs/tags/"):
+                    last = parts[1][len("refs/tags/") :]
+                    tags[last] = (parts[0], parts[0] if peeled else None)
+    except OSError:
+        pass
+    tags_dir = os.path.join(gitdir, "refs", "tags")
+    for root, _, files in os.walk(tags_dir):
+        for fname in files:
+            fpath = os.path.join(root, fname)
+            try:
+                with open(fpath, "rt") as fin:
+                    tags[os.path.relpath(fpath, tags_dir).replace(os.sep, "/")] = (fin.read().strip(), None)
+            except OSError:
+                continue
+    return tags
+
+
+def _peel_tags(path: str, gitdir: str, tags: Dict[str, Tuple[str, Optional[str]]]) -> Dict[str, str]:
+    """
+    Returns the commit each tag points to as {name: peeled_sha}.
+    """
+    peeled, unknown = {}, []
+    for name, (sha, peeled_sha) in tags.items():
+        peeled_sha = peeled_sha or _peel_loose_tag(gitdir, sha)
+        if peeled_sha is None:
+            unknown.append(name)
+        else:
+            peeled[name] = peeled_sha
+    if not unknown:
+        return peeled
+    # the objects are packed, let git peel all the tags at once
+    refs = subprocess.check_output(["git", "-C", path, "show-ref", "--tags", "-d"], universal_newlines=True)
+    for line in refs.split("\n"):
+        parts = line.split(" ", 1)
+        if len(parts) != 2 or not parts[1].startswith("refs/tags/"):
+            continue
+        name = parts[1][len("refs/tags/") :]
+        if name.endswith("^{}"):
+            peeled[name[:-3]] = parts[0]
+        else:
+            peeled.setdefault(name, parts[0])
+    return peeled
+
+
+def _peel_loose_tag(gitdir: str, sha: str) -> Optional[str]:
+    # annotated tags point to a tag object, the tag object points to the commit
+    try:
+        with open(os.path.join(gitdir, "objects", sha[:2], sha[2:]), "rb") as fin:
+            data = zlib.decompress(fin.read())
+        header, _, body = data.partition(b"\0")
+        if not header.startswith(b"tag "):
+            return sha
+        return body.split(b"\n", 1)[0].split(b" ", 1)[1].decode("utf-8")
+    except (OSError, zlib.error, IndexError):
+        # the object is packed
+        return None
+
+
+def _read_origin_url(path: str, gitdir: str) -> str:
+    config = configparser.ConfigParser(strict=False, interpolation=None)
+    try:
+        config.read(os.path.join(gitdir, "config"))
+        return config.get('remote "origin"', "url")
+    except (configparser.Error, UnicodeDecodeError):
+        # includes, URL rewrites and the like are left to git
+        return _run_cmd(["git", "-C", f'"{path}"', "config", "--get", "remote.origin.url"])[0]
+
+
+def _read_repo_info(path: str) -> dict:
+    gitdir = os.path.join(path, ".git")
+    # branch, SHA and index state come from a single `git status`, which is not allowed to refresh
+    # (i.e., rewrite) the index, that would invalidate the cache
+    status = subprocess.check_output(
+        ["git", "--no-optional-locks", "-C", path, "status", "--porcelain=v2", "--branch"],
+        universal_newlines=True,
+    )
+    sha, branch = "ND", "HEAD"
+    nmodified = nadded = 0
+    for line in status.split("\n"):
+        if line.startswith("# branch.oid "):
+            sha = line[len("# branch.oid ") :]
+            sha = "ND" if sha == "(initial)" else sha
+        elif line.startswith("# branch.head "):
+            branch = line[len("# branch.head ") :]
+            branch = "HEAD" if branch == "(detached)" else branch
+        elif line[:2] in ["1 ", "2 ", "u ", "? "]:
+            # renames carry the original path after a TAB
+            fpath = line.split("\t", 1)[0]
+            if line[0] != "?":
+                nmodified += 1
+            # we are not counting files with .resolved extension
+            if not fpath.endswith(".resolved"):
+                nadded += 1
+    # tags
+    tags = _read_tags(gitdir)
+    closest_tag = sorted(tags)[-1] if tags else "ND"
+    head_tags = []
+    # only the tags that do not point to HEAD directly need peeling
+    others = {name: tag for name, tag in tags.items() if tag[0] != sha}
+    peeled = _peel_tags(path, gitdir, others) if others and sha != "ND" else {}
+    for name, (tag_sha, _) in tags.items():
+        if tag_sha == sha:
+            head_tags.append((False, name))
+        elif peeled.get(name) == sha:
+            head_tags.append((True, name))
+    # annotated tags win over lightweight tags
+    head_tag = sorted(head_tags)[-1][1] if head_tags else "ND"
+    # origin
+    origin_url = _read_origin_url(path, gitdir)
+    if origin_url.endswith(".git"):
+        origin_url = origin_url[:-4]
+    if origin_url.endswith("/"):
+        origin_url = origin_url[:-1]
+    repo = origin_url.split("/")[-1]
+    # return info
+    return {
+        "REPOSITORY": repo,
+        "SHA": sha,
+        "BRANCH": branch,
+        "VERSION.HEAD": head_tag,
+        "VERSION.CLOSEST": closest_tag,
+        "ORIGIN.URL": origin_url,
+        "ORIGIN.HTTPS.URL": _remote_url_to_https(origin_url),
+        "INDEX_NUM_MODIFIED": nmodified,
+        "INDEX_NUM_ADDED": nadded,
+    }
+
+
 def _run_cmd(cmd):
     cmd = " ".join(cmd)
     return [line for line in subprocess.check_output(cmd, shell=True).decode("utf-8").split("\n") if line]
@@ -512,11 +686,3 @@ def _parse_configurations(config_file: str) -> dict:
         raise ValueError("The configurations file must have a root key 'version'.")
     if configurations_content["version"] == "1.0":
         return configurations_content["configurations"]
-
-
-def _docker_client(endpoint):
-    return (
-        endpoint
-        if isinstance(endpoint, docker.DockerClient)
-        else docker.DockerClient(base_url=sanitize_docker_baseurl(endpoint))
-    )
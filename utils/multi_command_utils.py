@@ -6,8 +6,8 @@ import sys
 import time
 import traceback
 from itertools import product
-from threading import Thread
-from typing import List, Tuple, Any, Type
+from threading import Lock, Thread, local
+from typing import List, Tuple, Any, Type, Optional, TextIO
 from collections import OrderedDict
 
 from dt_shell import DTCommandAbs, DTShell, dtslogger
@@ -140,3 +140,107 @@ class MultiCommand(object):
                 dtslogger.error(f'Error parsing multi-arg value "{domain}".')
                 return []
             return skeleton(values)
+
+
+class _PrefixedStream(object):
+    def __init__(self, prefix: str, target: TextIO, lock: Lock, log: Optional[TextIO] = None):
+        self._prefix = prefix
+        self._target = target
+        self._lock = lock
+        self._log = log
+        self._buffer = ""
+
+    def write(self, data: str):
+        self._buffer += data
+        *lines, self._buffer = re.split(r"(?<=[\n\r])", self._buffer)
+        if lines:
+            self._emit(lines)
+        return len(data)
+
+    def flush(self):
+        if self._buffer:
+            self._emit([self._buffer + "\n"])
+            self._buffer = ""
+
+    def _emit(self, lines: List[str]):
+        with self._lock:
+            for line in lines:
+                # lines that clear themselves (e.g., progress bars) are not worth interleaving
+                if line.endswith("\r"):
+                    continue
+                self._target.write(f"{self._prefix}{line}")
+                if self._log is not None:
+                    self._log.write(line)
+            self._target.flush()
+
+
+class _ThreadRoutedStream(object):
+    def __init__(self, default: TextIO, streams: local):
+        self._default = default
+        self._streams = streams
+
+    def _stream(self) -> TextIO:
+        return getattr(self._streams, "stream", None) or self._default
+
+    def write(self, data: str):
+        return self._stream().write(data)
+
+    def flush(self):
+        self._stream().flush()
+
+    def __getattr__(self, item):
+        # everything else (e.g., fileno, isatty, encoding) comes from the real stream
+        return getattr(self._default, item)
+
+
+class _PrefixFilter(logging.Filter):
+    def __init__(self, prefixes: dict):
+        super(_PrefixFilter, self).__init__()
+        self._prefixes = prefixes
+
+    def filter(self, record):
+        prefix = self._prefixes.get(record.threadName)
+        if prefix and not getattr(record, "_prefixed", False):
+            record.msg = f"{prefix}{record.msg}"
+            record._prefixed = True
+        return True
+
+
+class ThreadedOutput(object):
+    """
+    Routes stdout and the log records of each worker thread to its own stream, prefixed
+    with the name of the worker. The output of every worker is also kept in its log file, if given.
+    Unlike MultiCommand, the output of the other threads is not affected.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._streams = local()
+        self._prefixes = {}
+        self._filter = _PrefixFilter(self._prefixes)
+        self._stdout = None
+
+    def __enter__(self):
+        self._stdout = sys.stdout
+        sys.stdout = _ThreadRoutedStream(self._stdout, self._streams)
+        dtslogger.addFilter(self._filter)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        dtslogger.removeFilter(self._filter)
+        sys.stdout = self._stdout
+
+    def thread(self, name: str, target, args=(), log: Optional[TextIO] = None) -> Thread:
+        prefix = f"[{name}] "
+        stream = _PrefixedStream(prefix, self._stdout, self._lock, log)
+
+        def _run():
+            self._streams.stream = stream
+            try:
+                target(*args)
+            finally:
+                stream.flush()
+
+        worker = Thread(target=_run, name=f"{name}-{id(stream)}")
+        self._prefixes[worker.name] = prefix
+        return worker
@@ -1,8 +1,9 @@
 import sys
+import threading
 
 import math
 
-__all__ = ["ProgressBar"]
+__all__ = ["ProgressBar", "MultiProgressBar", "StatusLines"]
 
 
 class ProgressBar:
@@ -11,15 +12,16 @@ class ProgressBar:
         self._buffer = buf
         self._header = header
         self._last_value = -1
+        self._last_info = None
         self._scale = max(0.0, min(1.0, scale))
         self._max = int(math.ceil(100 * self._scale))
 
     def set_header(self, header):
         self._header = header
 
-    def update(self, percentage):
+    def update(self, percentage, info=None):
         percentage_int = int(max(0, min(100, percentage)))
-        if percentage_int == self._last_value:
+        if percentage_int == self._last_value and info == self._last_info:
             return
         percentage = int(math.ceil(percentage * self._scale))
         if self._finished:
@@ -33,6 +35,8 @@ class ProgressBar:
         pbar += " " * (self._max - percentage - 1)
         # this ends the progress bar
         pbar += "] {:d}%".format(percentage_int)
+        if info:
+            pbar += f" {info}"
         # print
         self._buffer.write(pbar)
         self._buffer.flush()
@@ -44,6 +48,78 @@ class ProgressBar:
             self._buffer.flush()
             self._finished = True
         self._last_value = percentage_int
+        self._last_info = info
 
     def done(self):
         self.update(100)
+
+
+class MultiProgressBar:
+    """
+    Keeps one progress bar per line, lines are redrawn in place on every call to `draw`.
+    """
+
+    def __init__(self, labels, scale=0.5, buf=sys.stdout):
+        self._buffer = buf
+        self._labels = list(labels)
+        self._values = {label: 0 for label in self._labels}
+        self._infos = {label: "" for label in self._labels}
+        self._scale = max(0.0, min(1.0, scale))
+        self._max = int(math.ceil(100 * self._scale))
+        self._label_width = max([len(label) for label in self._labels] + [0])
+        self._drawn = False
+
+    def update(self, label, percentage, info=None):
+        self._values[label] = int(max(0, min(100, percentage)))
+        if info is not None:
+            self._infos[label] = info
+
+    def draw(self):
+        # move back to the first line
+        if self._drawn:
+            self._buffer.write(f"\x1b[{len(self._labels)}A")
+        for label in self._labels:
+            percentage = self._values[label]
+            done = int(math.ceil(percentage * self._scale))
+            pbar = "=" * done + (">" if done < self._max else "")
+            pbar = pbar.ljust(self._max)
+            line = f"{label.ljust(self._label_width)}: [{pbar}] {percentage:d}% {self._infos[label]}"
+            self._buffer.write(f"\x1b[2K{line}\n")
+        self._buffer.flush()
+        self._drawn = True
+
+
+class StatusLines:
+    """
+    Keeps one status line per label, lines are redrawn in place when a status changes.
+    When the output is not a terminal, every change is printed on a new line instead.
+    """
+
+    def __init__(self, labels, buf=sys.stdout):
+        self._buffer = buf
+        self._labels = list(labels)
+        self._status = {label: "" for label in self._labels}
+        self._label_width = max([len(label) for label in self._labels] + [0])
+        self._interactive = hasattr(buf, "isatty") and buf.isatty()
+        self._lock = threading.Lock()
+        self._drawn = False
+
+    def update(self, label, status):
+        with self._lock:
+            if self._status[label] == status:
+                return
+            self._status[label] = status
+            if self._interactive:
+                self._draw()
+            else:
+                self._buffer.write(f"{label.ljust(self._label_width)}: {status}\n")
+                self._buffer.flush()
+
+    def _draw(self):
+        # move back to the first line
+        if self._drawn:
+            self._buffer.write(f"\x1b[{len(self._labels)}A")
+        for label in self._labels:
+            self._buffer.write(f"\x1b[2K{label.ljust(self._label_width)}: {self._status[label]}\n")
+        self._buffer.flush()
+        self._drawn = True
@@ -0,0 +1,377 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from os.path import expanduser
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+import requests
+
+from dt_shell import dtslogger
+from utils.docker_utils import DEFAULT_REGISTRY
+
+DOCKER_HUB_API_HOST = "registry-1.docker.io"
+REGISTRY_API_TIMEOUT = (5, 30)
+DEFAULT_LOOKUP_WORKERS = 8
+REGISTRY_CACHE_DIR = os.path.join(expanduser("~"), ".dt-shell", "cache", "registry")
+# tokens are considered expired a little earlier than they are
+TOKEN_EXPIRATION_MARGIN_SECS = 10
+# tokens with no explicit lifetime are valid for 60 seconds (as per Docker Registry v2 specs)
+TOKEN_DEFAULT_LIFETIME_SECS = 60
+
+MEDIA_TYPE_MANIFEST_V2 = "application/vnd.docker.distribution.manifest.v2+json"
+MEDIA_TYPE_MANIFEST_LIST = "application/vnd.docker.distribution.manifest.list.v2+json"
+MEDIA_TYPE_OCI_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+MEDIA_TYPE_OCI_INDEX = "application/vnd.oci.image.index.v1+json"
+MANIFEST_ACCEPT = ", ".join(
+    [MEDIA_TYPE_MANIFEST_V2, MEDIA_TYPE_OCI_MANIFEST, MEDIA_TYPE_MANIFEST_LIST, MEDIA_TYPE_OCI_INDEX]
+)
+
+# docker arch -> OCI platform (architecture, variant)
+ARCH_TO_PLATFORM = {
+    "amd64": ("amd64", None),
+    "arm32v7": ("arm", "v7"),
+    "arm64v8": ("arm64", None),
+}
+
+CHALLENGE_PATTERN = re.compile(r'(\w+)="([^"]*)"')
+DIGEST_PATTERN = re.compile(r"^sha256:[0-9a-f]{64}$")
+
+
+class RegistryError(Exception):
+    pass
+
+
+@dataclass
+class RemoteImage:
+    image: str
+    tag: str
+    # digest of the manifest the tag points to (it can be a manifest list)
+    digest: str
+    # digest of the image config, i.e., the ID the image gets once pulled
+    config_digest: str
+    config: dict
+
+    @property
+    def labels(self) -> Dict[str, str]:
+        return self.config.get("config", {}).get("Labels") or {}
+
+
+def parse_image_name(image: str, registry: Optional[str] = None) -> Tuple[str, str]:
+    """
+    Splits an image name (without tag) into (registry, repository).
+    An explicit registry in the name wins over the given default registry.
+    """
+    parts = image.split("/", 1)
+    if len(parts) == 2 and ("." in parts[0] or ":" in parts[0] or parts[0] == "localhost"):
+        registry, repository = parts
+    else:
+        repository = image
+    registry = registry or DEFAULT_REGISTRY
+    if registry in ["docker.io", "index.docker.io", "registry-1.docker.io"]:
+        registry = DEFAULT_REGISTRY
+        # official images live under `library/`
+        if "/" not in repository:
+            repository = f"library/{repository}"
+    return registry, repository
+
+
+def _api_url(registry: str) -> str:
+    host = DOCKER_HUB_API_HOST if registry == DEFAULT_REGISTRY else registry
+    return f"https://{host}/v2"
+
+
+class RegistryClient(object):
+    """
+    Thin client for the Docker Registry HTTP API v2.
+    All requests go through the same HTTP session. Bearer tokens are kept in memory until they
+    expire, manifests and config blobs are content-addressed, so they are cached on disk by digest.
+    Tags are mutable, resolving a tag costs one HEAD request (not counted against the Docker Hub pull
+    rate limit).
+    """
+
+    def __init__(self, cache_dir: str = REGISTRY_CACHE_DIR, timeout=REGISTRY_API_TIMEOUT):
+        self._cache_dir = cache_dir
+        self._timeout = timeout
+        self._session = requests.Session()
+        self._lock = threading.Lock()
+        # {registry: {realm, service}}
+        self._challenges: Dict[str, Optional[dict]] = {}
+        # {(registry, scope): (token, expiration)}
+        self._tokens: Dict[Tuple[str, str], Tuple[str, float]] = {}
+        # concurrent lookups wait for each other instead of racing for the same challenge/token
+        self._key_locks: Dict[Hashable, threading.Lock] = {}
+
+    def _key_lock(self, key: Hashable) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    # tokens
+
+    def _token(self, registry: str, repository: str, refresh: bool = False) -> Optional[str]:
+        scope = f"repository:{repository}:pull"
+        with self._key_lock((registry, scope)):
+            with self._lock:
+                challenge = self._challenges.get(registry)
+                token, expiration = self._tokens.get((registry, scope), (None, 0))
+            if token is not None and not refresh and time.time() < expiration:
+                return token
+            if challenge is None:
+                # registries that do not require authentication
+                return None
+            params = {"scope": scope}
+            if challenge.get("service"):
+                params["service"] = challenge["service"]
+            dtslogger.debug(f"Requesting a token to {challenge['realm']} for {scope}...")
+            res = self._session.get(challenge["realm"], params=params, timeout=self._timeout)
+            if res.status_code != 200:
+                raise RegistryError(f"Could not get a token for {scope} ({res.status_code}): {res.text}")
+            data = res.json()
+            token = data.get("token") or data.get("access_token")
+            lifetime = int(data.get("expires_in", TOKEN_DEFAULT_LIFETIME_SECS))
+            with self._lock:
+                expiration = time.time() + lifetime - TOKEN_EXPIRATION_MARGIN_SECS
+                self._tokens[(registry, scope)] = (token, expiration)
+            return token
+
+    def _authenticate(self, registry: str, repositories: List[str]):
+        """
+        Gets a single token valid for all the given repositories of a registry.
+        """
+        with self._key_lock(registry):
+            if registry not in self._challenges:
+                # the base endpoint answers with the authentication challenge
+                res = self._session.get(f"{_api_url(registry)}/", timeout=self._timeout)
+                challenge = res.headers.get("WWW-Authenticate", "")
+                with self._lock:
+                    if res.status_code == 401 and challenge.lower().startswith("bearer "):
+                        self._challenges[registry] = dict(CHALLENGE_PATTERN.findall(challenge))
+                    else:
+                        self._challenges[registry] = None
+        challenge = self._challenges[registry]
+        if challenge is None:
+            return
+        scopes = [f"repository:{repository}:pull" for repository in sorted(set(repositories))]
+        params = {"scope": scopes}
+        if challenge.get("service"):
+            params["service"] = challenge["service"]
+        dtslogger.debug(f"Requesting a token to {challenge['realm']} for {len(scopes)} repositories...")
+        res = self._session.get(challenge["realm"], params=params, timeout=self._timeout)
+        if res.status_code != 200:
+            raise RegistryError(f"Could not get a token for {registry} ({res.status_code}): {res.text}")
+        data = res.json()
+        token = data.get("token") or data.get("access_token")
+        lifetime = int(data.get("expires_in", TOKEN_DEFAULT_LIFETIME_SECS))
+        with self._lock:
+            expiration = time.time() + lifetime - TOKEN_EXPIRATION_MARGIN_SECS
+            for scope in scopes:
+                self._tokens[(registry, scope)] = (token, expiration)
+
+    def _request(self, method: str, registry: str, repository: str, path: str, headers: dict = None):
+        if registry not in self._challenges:
+            # the first request to a registry tells us how to authenticate, only one thread finds out
+            with self._key_lock(registry):
+                return self._do_request(method, registry, repository, path, headers)
+        return self._do_request(method, registry, repository, path, headers)
+
+    def _do_request(self, method: str, registry: str, repository: str, path: str, headers: dict = None):
+        url = f"{_api_url(registry)}/{repository}/{path}"
+        headers = dict(headers or {})
+        refresh = False
+        for _ in range(2):
+            if registry in self._challenges:
+                token = self._token(registry, repository, refresh=refresh)
+                if token is not None:
+                    headers["Authorization"] = f"Bearer {token}"
+            res = self._session.request(method, url, headers=headers, timeout=self._timeout)
+            if res.status_code != 401:
+                if registry not in self._challenges:
+                    with self._lock:
+                        self._challenges[registry] = None
+                return res
+            # learn how this registry wants us to authenticate, then try again
+            challenge = res.headers.get("WWW-Authenticate", "")
+            if not challenge.lower().startswith("bearer "):
+                break
+            with self._lock:
+                self._challenges[registry] = dict(CHALLENGE_PATTERN.findall(challenge))
+            refresh = True
+        raise RegistryError(f"Not authorized to access {registry}/{repository}")
+
+    # on-disk cache
+
+    def _cache_file(self, kind: str, digest: str) -> str:
+        algorithm, _, value = digest.partition(":")
+        return os.path.join(self._cache_dir, kind, algorithm, value)
+
+    def _cache_load(self, kind: str, digest: str) -> Optional[dict]:
+        try:
+            with open(self._cache_file(kind, digest), "rb") as fin:
+                return json.loads(fin.read())
+        except (OSError, ValueError):
+            return None
+
+    def _cache_store(self, kind: str, digest: str, content: bytes):
+        # only content that matches its digest makes it to the cache
+        if not DIGEST_PATTERN.match(digest) or f"sha256:{hashlib.sha256(content).hexdigest()}" != digest:
+            return
+        fpath = self._cache_file(kind, digest)
+        tmp_file = f"{fpath}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(fpath), exist_ok=True)
+            with open(tmp_file, "wb") as fout:
+                fout.write(content)
+            os.replace(tmp_file, fpath)
+        except OSError as e:
+            dtslogger.debug(f"Could not write the registry cache. Reason: {str(e)}")
+
+    # API
+
+    def resolve(self, image: str, tag: str, registry: Optional[str] = None) -> str:
+        """
+        Returns the digest of the manifest the given tag points to.
+        """
+        registry, repository = parse_image_name(image, registry)
+        res = self._request(
+            "HEAD", registry, repository, f"manifests/{tag}", headers={"Accept": MANIFEST_ACCEPT}
+        )
+        if res.status_code == 404:
+            raise RegistryError(f"Image {registry}/{repository}:{tag} not found")
+        if res.status_code != 200:
+            raise RegistryError(f"Could not resolve {registry}/{repository}:{tag} ({res.status_code})")
+        digest = res.headers.get("Docker-Content-Digest")
+        if digest is None:
+            # some registries do not return the digest on HEAD, fetch the manifest by tag instead
+            res = self._request(
+                "GET", registry, repository, f"manifests/{tag}", headers={"Accept": MANIFEST_ACCEPT}
+            )
+            digest = f"sha256:{hashlib.sha256(res.content).hexdigest()}"
+            self._cache_store("manifests", digest, res.content)
+        return digest
+
+    def manifest(self, image: str, reference: str, registry: Optional[str] = None) -> dict:
+        """
+        Returns the manifest of an image given a tag or a digest.
+        """
+        digest = reference if DIGEST_PATTERN.match(reference) else self.resolve(image, reference, registry)
+        manifest = self._cache_load("manifests", digest)
+        if manifest is not None:
+            return manifest
+        registry, repository = parse_image_name(image, registry)
+        res = self._request(
+            "GET", registry, repository, f"manifests/{digest}", headers={"Accept": MANIFEST_ACCEPT}
+        )
+        if res.status_code != 200:
+            raise RegistryError(f"Could not fetch manifest {digest} of {registry}/{repository}")
+        self._cache_store("manifests", digest, res.content)
+        return res.json()
+
+    def blob(self, image: str, digest: str, registry: Optional[str] = None) -> dict:
+        """
+        Returns a JSON blob (e.g., the image config) given its digest.
+        """
+        blob = self._cache_load("blobs", digest)
+        if blob is not None:
+            return blob
+        registry, repository = parse_image_name(image, registry)
+        res = self._request("GET", registry, repository, f"blobs/{digest}")
+        if res.status_code != 200:
+            raise RegistryError(f"Could not fetch blob {digest} of {registry}/{repository}")
+        self._cache_store("blobs", digest, res.content)
+        return res.json()
+
+    def inspect(
+        self, image: str, tag: str, registry: Optional[str] = None, arch: Optional[str] = None
+    ) -> RemoteImage:
+        """
+        Returns digests and config of an image (the config is the same object `docker inspect` shows
+        under `Config`, plus history and rootfs) without pulling it.
+        Multi-arch images are resolved to the given arch.
+        """
+        digest = self.resolve(image, tag, registry)
+        manifest = self.manifest(image, digest, registry)
+        if manifest.get("mediaType") in [MEDIA_TYPE_MANIFEST_LIST, MEDIA_TYPE_OCI_INDEX] or (
+            "manifests" in manifest
+        ):
+            manifest = self.manifest(image, _select_platform(manifest, arch), registry)
+        if "config" not in manifest:
+            raise RegistryError(f"Unsupported manifest format for {image}:{tag}")
+        config_digest = manifest["config"]["digest"]
+        config = self.blob(image, config_digest, registry)
+        return RemoteImage(image, tag, digest, config_digest, config)
+
+    def image_config(
+        self, image: str, tag: str, registry: Optional[str] = None, arch: Optional[str] = None
+    ) -> dict:
+        return self.inspect(image, tag, registry, arch).config
+
+    def inspect_many(
+        self,
+        images: Sequence[Tuple],
+        registry: Optional[str] = None,
+        workers: int = DEFAULT_LOOKUP_WORKERS,
+    ) -> Dict[Tuple[str, str, Optional[str]], Optional[RemoteImage]]:
+        """
+        Inspects many images at once. Images are given as (image, tag) or (image, tag, arch) tuples,
+        the result is keyed by (image, tag, arch) (arch is None when not given), images that cannot be
+        inspected map to None. Lookups run concurrently and share the HTTP session and the tokens.
+        """
+
+        def _inspect(ref: Tuple) -> Optional[RemoteImage]:
+            image, tag, arch = ref
+            try:
+                return self.inspect(image, tag, registry, arch)
+            except (RegistryError, requests.RequestException, ValueError) as e:
+                dtslogger.debug(f"Cannot inspect remote image {image}:{tag}. Reason: {str(e)}")
+                return None
+
+        # the same image can be requested for different architectures
+        refs: List[Tuple] = list(dict.fromkeys((tuple(ref) + (None,))[:3] for ref in images))
+        if not refs:
+            return {}
+        # one token for all the repositories of a registry
+        repositories: Dict[str, List[str]] = {}
+        for ref in refs:
+            ref_registry, repository = parse_image_name(ref[0], registry)
+            repositories.setdefault(ref_registry, []).append(repository)
+        for ref_registry, repos in repositories.items():
+            try:
+                self._authenticate(ref_registry, repos)
+            except (RegistryError, requests.RequestException, ValueError) as e:
+                # every lookup will get its own token
+                dtslogger.debug(f"Cannot authenticate with {ref_registry}. Reason: {str(e)}")
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(refs)))) as executor:
+            results = list(executor.map(_inspect, refs))
+        return dict(zip(refs, results))
+
+
+def _select_platform(index: dict, arch: Optional[str]) -> str:
+    entries = index.get("manifests", [])
+    if not entries:
+        raise RegistryError("Empty manifest list")
+    if arch is not None:
+        architecture, variant = ARCH_TO_PLATFORM.get(arch, (arch, None))
+        for entry in entries:
+            platform = entry.get("platform", {})
+            if platform.get("architecture") == architecture and (
+                variant is None or platform.get("variant") == variant
+            ):
+                return entry["digest"]
+        raise RegistryError(f"No image available for arch {arch}")
+    return entries[0]["digest"]
+
+
+_client: Optional[RegistryClient] = None
+_client_lock = threading.Lock()
+
+
+def get_registry_client() -> RegistryClient:
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = RegistryClient()
+        return _client
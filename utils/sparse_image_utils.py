@@ -0,0 +1,238 @@
+import collections
+import errno
+import json
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__all__ = [
+    "SPARSE_IMAGE_EXTENSION",
+    "SPARSE_IMAGE_COMPRESSIONS",
+    "SparseImage",
+    "data_extents",
+    "is_sparse_image",
+    "write_sparse_image",
+]
+
+# Layout of a sparse image:
+#
+#   MAGIC | header length (uint32) | header (JSON) | frame | frame | ... | end frame
+#
+# where every frame is a compressed run of non-zero blocks of the disk image,
+#
+#   offset (uint64) | uncompressed length (uint32) | compressed length (uint32) | crc32 (uint32) | data
+#
+# and the end frame is a frame of length zero. Whatever is not covered by a frame is zero.
+SPARSE_IMAGE_EXTENSION = "simg"
+SPARSE_IMAGE_MAGIC = b"DTSIMG\r\n"
+SPARSE_IMAGE_VERSION = 1
+SPARSE_IMAGE_HEADER_LENGTH = struct.Struct("<I")
+SPARSE_IMAGE_FRAME = struct.Struct("<QIII")
+SPARSE_IMAGE_COMPRESSIONS = ["zlib", "zstd"]
+DEFAULT_SPARSE_BLOCK_SIZE = 4096
+DEFAULT_FRAME_SIZE = 4 * 1024 ** 2
+DEFAULT_WORKERS = os.cpu_count() or 4
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def is_sparse_image(path):
+    return path.endswith(f".{SPARSE_IMAGE_EXTENSION}")
+
+
+def data_extents(fd, size):
+    """
+    Yields the (start, end) ranges of a file that contain data, holes can only contain zeros.
+    Filesystems that do not support SEEK_DATA report the whole file as data.
+    """
+    if not hasattr(os, "SEEK_DATA"):
+        yield 0, size
+        return
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # no more data past `offset`
+                return
+            if e.errno == errno.EINVAL and offset == 0:
+                yield 0, size
+                return
+            raise
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield start, end
+        offset = end
+
+
+def _compressor(compression):
+    if compression == "zlib":
+        return lambda data: zlib.compress(data, ZLIB_LEVEL)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError("The Python package 'zstandard' is needed for zstd compressed images")
+        return lambda data: zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    raise ValueError(f"Unknown compression '{compression}'")
+
+
+def _decompressor(compression):
+    if compression == "zlib":
+        return zlib.decompress
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError("The Python package 'zstandard' is needed for zstd compressed images")
+        return lambda data: zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f"Unknown compression '{compression}'")
+
+
+def _mapped_runs(fin, size, frame_size, block_size):
+    # yields (offset, data) for every run of non-zero blocks, runs are at most `frame_size` long
+    zeros = bytes(frame_size)
+    fd = fin.fileno()
+    for start, end in data_extents(fd, size):
+        offset = start
+        while offset < end:
+            chunk = os.pread(fd, min(frame_size, end - offset), offset)
+            if not chunk:
+                break
+            if chunk != zeros[: len(chunk)]:
+                view = memoryview(chunk)
+                run_start = None
+                for i in range(0, len(chunk), block_size):
+                    block = view[i : i + block_size]
+                    if block == zeros[: len(block)]:
+                        if run_start is not None:
+                            yield offset + run_start, chunk[run_start:i]
+                            run_start = None
+                    elif run_start is None:
+                        run_start = i
+                if run_start is not None:
+                    yield offset + run_start, chunk[run_start:]
+            offset += len(chunk)
+
+
+def write_sparse_image(
+    image,
+    destination,
+    files=None,
+    compression="zlib",
+    workers=DEFAULT_WORKERS,
+    frame_size=DEFAULT_FRAME_SIZE,
+    block_size=DEFAULT_SPARSE_BLOCK_SIZE,
+):
+    """
+    Stores the non-zero blocks of a disk image as independently compressed frames, frames are
+    compressed in parallel. The given (small) files are embedded in the header.
+    Returns the number of bytes of the disk image that were stored.
+    """
+    compress = _compressor(compression)
+
+    def _frame(data):
+        return zlib.crc32(data), compress(data)
+
+    mapped = 0
+    with open(image, "rb") as fin, open(f"{destination}.part", "wb") as fout:
+        size = os.fstat(fin.fileno()).st_size
+        embedded = {}
+        for path in files or []:
+            with open(path, "rt") as f:
+                embedded[os.path.basename(path)] = f.read()
+        header = json.dumps(
+            {
+                "version": SPARSE_IMAGE_VERSION,
+                "image_size": size,
+                "block_size": block_size,
+                "frame_size": frame_size,
+                "compression": compression,
+                "files": embedded,
+            }
+        ).encode("utf-8")
+        fout.write(SPARSE_IMAGE_MAGIC + SPARSE_IMAGE_HEADER_LENGTH.pack(len(header)) + header)
+        # frames are written in order, only a bounded number of them is in flight
+        pending = collections.deque()
+
+        def _flush(limit):
+            while len(pending) > limit:
+                offset, length, future = pending.popleft()
+                crc, data = future.result()
+                fout.write(SPARSE_IMAGE_FRAME.pack(offset, length, len(data), crc))
+                fout.write(data)
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for offset, data in _mapped_runs(fin, size, frame_size, block_size):
+                pending.append((offset, len(data), executor.submit(_frame, data)))
+                mapped += len(data)
+                _flush(2 * workers)
+            _flush(0)
+        fout.write(SPARSE_IMAGE_FRAME.pack(0, 0, 0, 0))
+    os.replace(f"{destination}.part", destination)
+    return mapped
+
+
+class SparseImage:
+    """
+    Reads a sparse image sequentially from a file-like object (e.g., a file or an HTTP response).
+    Frames are decompressed in parallel and returned in order.
+    """
+
+    def __init__(self, fin, workers=DEFAULT_WORKERS):
+        self._fin = fin
+        self._workers = max(1, workers)
+        self.consumed = 0
+        magic = self._read_exactly(len(SPARSE_IMAGE_MAGIC))
+        if magic != SPARSE_IMAGE_MAGIC:
+            raise IOError("Not a sparse disk image")
+        (length,) = SPARSE_IMAGE_HEADER_LENGTH.unpack(self._read_exactly(SPARSE_IMAGE_HEADER_LENGTH.size))
+        header = json.loads(self._read_exactly(length).decode("utf-8"))
+        if header["version"] != SPARSE_IMAGE_VERSION:
+            raise IOError(f"Sparse disk image version {header['version']} is not supported")
+        self.image_size = header["image_size"]
+        self.block_size = header["block_size"]
+        self.frame_size = header["frame_size"]
+        self.files = header["files"]
+        self._decompress = _decompressor(header["compression"])
+
+    def _read_exactly(self, size):
+        data = b""
+        while len(data) < size:
+            part = self._fin.read(size - len(data))
+            if not part:
+                raise IOError("Unexpected end of the sparse disk image")
+            data += part
+        self.consumed += len(data)
+        return data
+
+    def _raw_frames(self):
+        while True:
+            frame = self._read_exactly(SPARSE_IMAGE_FRAME.size)
+            offset, length, clength, crc = SPARSE_IMAGE_FRAME.unpack(frame)
+            if length == 0:
+                return
+            yield offset, length, crc, self._read_exactly(clength)
+
+    def _frame(self, offset, length, crc, data):
+        data = self._decompress(data)
+        if len(data) != length or zlib.crc32(data) != crc:
+            raise IOError(f"Corrupted frame at offset {offset}, the download might be corrupted")
+        return data
+
+    def frames(self):
+        """
+        Yields (offset, data) for every stored run of blocks, in increasing offset order.
+        """
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            for offset, length, crc, data in self._raw_frames():
+                pending.append((offset, executor.submit(self._frame, offset, length, crc, data)))
+                while len(pending) > 2 * self._workers:
+                    offset, future = pending.popleft()
+                    yield offset, future.result()
+            while pending:
+                offset, future = pending.popleft()
+                yield offset, future.result()